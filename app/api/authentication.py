@@ -38,6 +38,11 @@ def login_user():
             return flask.jsonify(constants.api.AUTH_FAILURE), constants.api.AUTH_FAILURE_CODE
     except UserDoesNotExistException:
         return flask.jsonify(constants.api.NONEXISTENT_USER_FAILURE), constants.api.NONEXISTENT_USER_FAILURE_CODE
+    except PasswordHashingOverloadedException:
+        return (
+            flask.jsonify(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE),
+            constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE,
+        )
 
     login(
         user=database.user.get_user_by_username(data['username']),
@@ -1,5 +1,6 @@
 import flask
 from flask_login import current_user
+from flask_login import login_user
 from modern_paste import app
 
 import config
@@ -14,6 +15,8 @@ import database.attachment
 import database.paste
 import database.user
 import util.cryptography
+import util.paste_unlock
+import util.upload
 
 
 @app.route(PasteSubmitURI.path, methods=['POST'])
@@ -50,8 +53,9 @@ def submit_paste():
         )
 
     try:
-        new_paste = database.paste.create_new_paste(
+        new_paste, new_attachments = database.paste.create_new_paste_with_attachments(
             contents=data.get('contents'),
+            attachments=data.get('attachments', []),
             user_id=current_user.user_id if current_user.is_authenticated else None,
             expiry_time=data.get('expiry_time'),
             title=data.get('title'),
@@ -66,16 +70,6 @@ def submit_paste():
                 [uri in flask.request.referrer for uri in [HomeURI.full_uri(), PastePostInterfaceURI.full_uri()]]
             ),
         )
-        new_attachments = [
-            database.attachment.create_new_attachment(
-                paste_id=new_paste.paste_id,
-                file_name=attachment.get('name'),
-                file_size=attachment.get('size'),
-                mime_type=attachment.get('mime_type'),
-                file_data=attachment.get('data'),
-            )
-            for attachment in data.get('attachments', [])
-        ]
         resp_data = new_paste.as_dict().copy()
         resp_data['deactivation_token'] = new_paste.deactivation_token
         resp_data['attachments'] = [
@@ -87,6 +81,109 @@ def submit_paste():
             for attachment in new_attachments
         ]
         return flask.jsonify(resp_data), constants.api.SUCCESS_CODE
+    except PasswordHashingOverloadedException:
+        return (
+            flask.jsonify(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE),
+            constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE,
+        )
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+@app.route(PasteAttachmentUploadURI.path, methods=['POST'])
+def upload_paste_attachment():
+    """
+    Endpoint for adding attachments to an existing paste, streamed straight to disk as they are uploaded.
+    The request body is either the raw data of a single attachment, whose name is specified by the file_name parameter
+    and whose MIME type is the Content-Type of the request, or a multipart/form-data body of one or more files. Since the
+    body is not JSON, all parameters are supplied in the query string.
+    The user can add attachments to a paste in the same two ways as deactivating it: (1) Supply the paste's deactivation
+    token in the request, or (2) Be currently logged in, and own the paste.
+    """
+    args = flask.request.args
+    if not config.ENABLE_PASTE_ATTACHMENTS:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE),
+            constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE_CODE,
+        )
+
+    is_multipart = flask.request.mimetype == 'multipart/form-data'
+    boundary = flask.request.mimetype_params.get('boundary')
+    if not args.get('paste_id') or (is_multipart and not boundary) or (not is_multipart and not args.get('file_name')):
+        return flask.jsonify(constants.api.INCOMPLETE_PARAMS_FAILURE), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+
+    # A request body or a single raw attachment that is too large is rejected before any of it is read; otherwise,
+    # uploads are aborted as soon as the body or an attachment exceeds its maximum size
+    max_size = config.MAX_ATTACHMENT_SIZE * 1000 * 1000 if config.MAX_ATTACHMENT_SIZE > 0 else None
+    max_upload_size = config.MAX_ATTACHMENT_UPLOAD_SIZE * 1000 * 1000 if config.MAX_ATTACHMENT_UPLOAD_SIZE > 0 else None
+    if max_upload_size is not None and (flask.request.content_length or 0) > max_upload_size:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE_CODE,
+        )
+    if max_size is not None and not is_multipart and (flask.request.content_length or 0) > max_size:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE,
+        )
+
+    try:
+        if not current_user.is_authenticated and config.AUTH_METHOD == 'local' and args.get('api_key'):
+            login_user(database.user.get_user_by_api_key(args['api_key'], active_only=True))
+    except UserDoesNotExistException:
+        return flask.jsonify(constants.api.AUTH_FAILURE), constants.api.AUTH_FAILURE_CODE
+
+    try:
+        paste = database.paste.get_paste_by_id(
+            util.cryptography.get_decid(args['paste_id']),
+            active_only=True,
+            include_contents=False,
+        )
+        if not ((current_user.is_authenticated and current_user.user_id == paste.user_id) or args.get('deactivation_token') == paste.deactivation_token):
+            fail_msg = 'User does not own requested paste' if current_user.is_authenticated else 'Deactivation token is invalid'
+            return flask.jsonify({
+                constants.api.RESULT: constants.api.RESULT_FAULURE,
+                constants.api.MESSAGE: fail_msg,
+                constants.api.FAILURE: 'auth_failure',
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            }), constants.api.AUTH_FAILURE_CODE
+
+        if is_multipart:
+            files = util.upload.iter_multipart_files(flask.request.stream, boundary, max_size=max_upload_size)
+        else:
+            files = [(
+                args['file_name'],
+                flask.request.mimetype,
+                util.upload.iter_chunks(flask.request.stream, max_size=max_upload_size),
+            )]
+        # All attachments of the request are added at once, so that none of them are added if the request fails
+        new_attachments = []
+        for new_attachment, digest in database.attachment.create_new_attachments_from_stream(
+            paste_id=paste.paste_id,
+            files=files,
+            max_size=max_size,
+        ):
+            attachment_dict = new_attachment.as_dict()
+            attachment_dict['sha256'] = digest
+            new_attachments.append(attachment_dict)
+        return flask.jsonify({
+            constants.api.RESULT: constants.api.RESULT_SUCCESS,
+            constants.api.MESSAGE: None,
+            'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            'attachments': new_attachments,
+        }), constants.api.SUCCESS_CODE
+    except AttachmentTooLargeException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE,
+        )
+    except AttachmentUploadTooLargeException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE_CODE,
+        )
+    except (PasteDoesNotExistException, InvalidIDException):
+        return flask.jsonify(constants.api.NONEXISTENT_PASTE_FAILURE), constants.api.NONEXISTENT_PASTE_FAILURE_CODE
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
@@ -149,6 +246,11 @@ def set_paste_password():
         }), constants.api.SUCCESS_CODE
     except (PasteDoesNotExistException, InvalidIDException):
         return flask.jsonify(constants.api.NONEXISTENT_PASTE_FAILURE), constants.api.NONEXISTENT_PASTE_FAILURE_CODE
+    except PasswordHashingOverloadedException:
+        return (
+            flask.jsonify(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE),
+            constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE,
+        )
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
@@ -161,8 +263,9 @@ def paste_details():
     """
     data = flask.request.get_json()
     try:
-        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(data['paste_id']), active_only=True)
-        attachments = database.attachment.get_attachments_for_paste(util.cryptography.get_decid(data['paste_id']), active_only=True)
+        paste_id = util.cryptography.get_decid(data['paste_id'])
+        paste = database.paste.get_paste_by_id(paste_id, active_only=True)
+        attachments = database.attachment.get_attachments_for_paste(paste_id, active_only=True)
         paste_details_dict = paste.as_dict()
         paste_details_dict['poster_username'] = 'Anonymous'
         paste_details_dict['attachments'] = [
@@ -172,12 +275,25 @@ def paste_details():
         if paste.user_id:
             poster = database.user.get_user_by_id(paste.user_id)
             paste_details_dict['poster_username'] = poster.username
-        if not paste.password_hash or (data.get('password') and paste.password_hash == util.cryptography.secure_hash(data.get('password'))):
+        # An unlock token issued when the password was last supplied is checked first, as it is much cheaper to check
+        if not paste.password_hash or database.paste.check_paste_unlock_token(
+            paste,
+            util.paste_unlock.get_request_token(paste.paste_id, data.get(util.paste_unlock.TOKEN_PARAMETER)),
+        ):
             return flask.jsonify({
                 constants.api.RESULT: constants.api.RESULT_SUCCESS,
                 constants.api.MESSAGE: None,
                 'details': paste_details_dict,
             }), constants.api.SUCCESS_CODE
+        if data.get('password') and database.paste.check_paste_password(paste, data.get('password')):
+            unlock_token = database.paste.get_paste_unlock_token(paste)
+            resp = flask.jsonify({
+                constants.api.RESULT: constants.api.RESULT_SUCCESS,
+                constants.api.MESSAGE: None,
+                'details': paste_details_dict,
+                util.paste_unlock.TOKEN_PARAMETER: unlock_token,
+            })
+            return util.paste_unlock.set_response_token(resp, paste.paste_id, unlock_token), constants.api.SUCCESS_CODE
         else:
             return flask.jsonify({
                 constants.api.RESULT: constants.api.RESULT_FAULURE,
@@ -187,6 +303,11 @@ def paste_details():
             }), constants.api.AUTH_FAILURE_CODE
     except (PasteDoesNotExistException, UserDoesNotExistException, InvalidIDException):
         return flask.jsonify(constants.api.NONEXISTENT_PASTE_FAILURE), constants.api.NONEXISTENT_PASTE_FAILURE_CODE
+    except PasswordHashingOverloadedException:
+        return (
+            flask.jsonify(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE),
+            constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE,
+        )
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
@@ -198,51 +319,92 @@ def pastes_for_user():
     Get all pastes for the currently logged in user.
     """
     try:
+        include_contents = bool((flask.request.get_json(silent=True) or {}).get('include_contents'))
         return flask.jsonify({
             constants.api.RESULT: constants.api.RESULT_SUCCESS,
             constants.api.MESSAGE: None,
-            'pastes': [
-                paste.as_dict()
-                for paste in database.paste.get_all_pastes_for_user(current_user.user_id, active_only=True)
-            ],
+            'pastes': _paste_dicts(
+                database.paste.get_all_pastes_for_user(
+                    current_user.user_id,
+                    active_only=True,
+                    include_contents=include_contents,
+                ),
+                include_contents,
+            ),
         }), constants.api.SUCCESS_CODE
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
 
 @app.route(RecentPastesURI.path, methods=['POST'])
-@require_form_args(['page_num', 'num_per_page'])
+@require_form_args(['num_per_page'])
 def recent_pastes():
     """
-    Get details for the most recent pastes.
+    Get details for the most recent pastes, either by page number or following a cursor.
     """
+    data = flask.request.get_json()
+    if data.get('page_num') is None and data.get('cursor') is None:
+        return flask.jsonify(constants.api.INCOMPLETE_PARAMS_FAILURE), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+
     try:
-        data = flask.request.get_json()
+        include_contents = bool(data.get('include_contents'))
+        pastes = database.paste.get_recent_pastes(
+            data.get('page_num'),
+            data['num_per_page'],
+            include_contents=include_contents,
+            cursor=data.get('cursor'),
+        )
         return flask.jsonify({
             constants.api.RESULT: constants.api.RESULT_SUCCESS,
             constants.api.MESSAGE: None,
-            'pastes': [
-                paste.as_dict() for paste in database.paste.get_recent_pastes(data['page_num'], data['num_per_page'])
-            ],
+            'pastes': _paste_dicts(pastes, include_contents),
+            'next_cursor': database.paste.get_recent_pastes_cursor(pastes[-1]) if pastes else None,
         }), constants.api.SUCCESS_CODE
+    except InvalidCursorException:
+        return flask.jsonify(constants.api.INVALID_CURSOR_FAILURE), constants.api.INVALID_CURSOR_FAILURE_CODE
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
 
 @app.route(TopPastesURI.path, methods=['POST'])
-@require_form_args(['page_num', 'num_per_page'])
+@require_form_args(['num_per_page'])
 def top_pastes():
     """
-    Get details for the top pastes.
+    Get details for the top pastes, either by page number or following a cursor.
     """
+    data = flask.request.get_json()
+    if data.get('page_num') is None and data.get('cursor') is None:
+        return flask.jsonify(constants.api.INCOMPLETE_PARAMS_FAILURE), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+
     try:
-        data = flask.request.get_json()
+        include_contents = bool(data.get('include_contents'))
+        pastes = database.paste.get_top_pastes(
+            data.get('page_num'),
+            data['num_per_page'],
+            include_contents=include_contents,
+            cursor=data.get('cursor'),
+        )
         return flask.jsonify({
             constants.api.RESULT: constants.api.RESULT_SUCCESS,
             constants.api.MESSAGE: None,
-            'pastes': [
-                paste.as_dict() for paste in database.paste.get_top_pastes(data['page_num'], data['num_per_page'])
-            ],
+            'pastes': _paste_dicts(pastes, include_contents),
+            'next_cursor': database.paste.get_top_pastes_cursor(pastes[-1]) if pastes else None,
         }), constants.api.SUCCESS_CODE
+    except InvalidCursorException:
+        return flask.jsonify(constants.api.INVALID_CURSOR_FAILURE), constants.api.INVALID_CURSOR_FAILURE_CODE
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+def _paste_dicts(pastes, include_contents):
+    """
+    Represent a list of pastes as dictionaries, as by models.Paste.as_dict, encrypting their IDs together.
+
+    :param pastes: List of instances of models.Paste
+    :param include_contents: True to include the full contents of each paste
+    :return: List of dictionaries of paste properties, in the same order
+    """
+    return [
+        paste.as_dict(include_contents=include_contents, id_repr=id_repr)
+        for paste, id_repr in zip(pastes, util.cryptography.get_id_reprs(paste.paste_id for paste in pastes))
+    ]
@@ -56,6 +56,11 @@ def create_new_user():
             constants.api.MESSAGE: 'Email address {email_addr} is invalid'.format(email_addr=data.get('email')),
             constants.api.FAILURE: 'invalid_email_failure',
         }), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+    except PasswordHashingOverloadedException:
+        return (
+            flask.jsonify(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE),
+            constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE,
+        )
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
@@ -98,6 +103,11 @@ def update_user_details():
             constants.api.MESSAGE: 'Email address {email_addr} is invalid'.format(email_addr=data.get('email')),
             constants.api.FAILURE: 'invalid_email_failure',
         }), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+    except PasswordHashingOverloadedException:
+        return (
+            flask.jsonify(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE),
+            constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE,
+        )
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
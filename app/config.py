@@ -29,10 +29,102 @@ ENABLE_PASTE_ATTACHMENTS = True
 # Set this to 0 for an unlimited file size.
 MAX_ATTACHMENT_SIZE = 0
 
+# Allow only attachment upload requests below a certain total size, in MB
+# This bounds the whole body of a request to the attachment upload API endpoint, which may contain several attachments,
+# each of which is also bound by MAX_ATTACHMENT_SIZE. Set this to 0 for an unlimited request size.
+MAX_ATTACHMENT_UPLOAD_SIZE = 0
+
 # Location to store paste attachments
 # Please use an absolute path and ensure that it is writable by www-data.
+# Attachments are stored in its blobs/ subdirectory, named by the SHA-256 digest of their contents, so that identical
+# attachments are only stored once. Attachments uploaded by earlier versions remain in a subdirectory per paste. Both
+# are fanned out into two levels of subdirectories named by hexadecimal prefixes of their hash.
 ATTACHMENTS_DIR = '/var/www/modern-paste-attachments'
 
+# Number of threads of each application process writing attachment files concurrently
+# The attachments submitted along with a paste are written in parallel, by at most this many threads shared by all
+# requests of the process.
+ATTACHMENT_WRITE_THREADS = 4
+
+# Let the web server send attachment files
+# By default, attachment files are streamed to the client by the app. Set this to 'X-Sendfile' (e.g. Apache with
+# mod_xsendfile) or 'X-Accel-Redirect' (nginx) to have the web server send them instead, without involving the app.
+# For X-Accel-Redirect, ATTACHMENTS_ACCEL_REDIRECT_PREFIX must be an internal location of the web server that serves
+# the contents of ATTACHMENTS_DIR, e.g. in nginx:
+#     location /attachments-internal/ { internal; alias /var/www/modern-paste-attachments/; }
+ATTACHMENTS_SENDFILE_HEADER = None
+ATTACHMENTS_ACCEL_REDIRECT_PREFIX = '/attachments-internal'
+
+# Where to store attachment blobs
+# By default, blobs are stored in ATTACHMENTS_DIR ('local'). Set this to 's3' to store them in the
+# ATTACHMENTS_S3_BUCKET bucket of an S3-compatible object store instead, under keys starting with ATTACHMENTS_S3_PREFIX.
+# ATTACHMENTS_S3_ENDPOINT_URL is the URL of the object store, e.g. 'http://localhost:9000' for MinIO, or None for Amazon
+# S3. Credentials are read from the environment, as by the AWS CLI. This requires the boto3 Python package, listed in
+# requirements-optional.txt. Blobs already stored are not moved when this is changed, and attachments uploaded by
+# earlier versions always remain in ATTACHMENTS_DIR.
+ATTACHMENTS_STORAGE_BACKEND = 'local'
+ATTACHMENTS_S3_BUCKET = None
+ATTACHMENTS_S3_PREFIX = 'blobs/'
+ATTACHMENTS_S3_ENDPOINT_URL = None
+ATTACHMENTS_S3_REGION = None
+
+# Redirect attachment downloads to the object store
+# If ATTACHMENTS_STORAGE_BACKEND is 's3', downloads of attachments are redirected to presigned URLs of the object store,
+# valid for this many seconds, so that attachments never pass through the app. The object store then answers range
+# requests itself. Set this to None to stream attachments through the app instead.
+ATTACHMENTS_S3_PRESIGNED_URL_TTL = 300
+
+# Attachment compression
+# If True, new text-like attachments (text/*, JSON, XML, JavaScript, YAML, etc.) that are at least
+# ATTACHMENT_COMPRESSION_THRESHOLD bytes large are stored gzip-compressed, if that actually makes them smaller. They
+# are served as is, with Content-Encoding: gzip, to clients that accept gzip, and decompressed on the fly for other
+# clients. Attachments already stored are not converted when this is changed.
+ENABLE_ATTACHMENT_COMPRESSION = False
+ATTACHMENT_COMPRESSION_THRESHOLD = 1024
+
+# Choose to cache pastes in memory
+# If True, each application process keeps up to PASTE_CACHE_SIZE recently requested pastes in memory, so that repeated
+# views of popular pastes don't each require a database query. Cached pastes are kept for at most PASTE_CACHE_TTL
+# seconds, or until the paste expires, whichever comes first. A paste that is deactivated or modified is evicted
+# immediately from the cache of the process that changed it; the TTL bounds how long other processes may keep it.
+# Password-protected pastes are never cached, so that a changed password takes effect in every process immediately.
+ENABLE_PASTE_CACHE = False
+PASTE_CACHE_SIZE = 1024
+PASTE_CACHE_TTL = 60
+
+# Shared paste cache
+# Optionally set this to a Redis URL, e.g. 'redis://localhost:6379/0', to additionally share cached pastes between all
+# application processes. Evictions are then immediately visible to every process. This requires the redis Python
+# package, listed in requirements-optional.txt, and is only used if ENABLE_PASTE_CACHE is True. Leave this as None to
+# only cache pastes in-process.
+PASTE_CACHE_REDIS_URL = None
+
+# Paste view counting
+# Rather than writing every paste view to the database as it happens, each application process counts views in memory
+# and writes them in batches: at least every PASTE_VIEW_FLUSH_INTERVAL seconds, and as soon as views for
+# PASTE_VIEW_FLUSH_THRESHOLD distinct pastes are pending. If a process crashes, at most its pending views are lost.
+# Set PASTE_VIEW_FLUSH_INTERVAL to 0 to write every view to the database immediately.
+PASTE_VIEW_FLUSH_INTERVAL = 10
+PASTE_VIEW_FLUSH_THRESHOLD = 1000
+
+# Top pastes leaderboard
+# The TOP_PASTES_LEADERBOARD_SIZE most viewed active pastes are tracked in a separate table that is updated as views are
+# counted, so that listing top pastes doesn't require sorting all pastes by their views. Pages beyond the leaderboard
+# are still queried by sorting. Views of pastes that rank below a full leaderboard don't touch it. The leaderboard is
+# built by build/build_database.py --create and build/migrate_database.py --migrate, fills up as pastes are viewed, and
+# is rebuilt whenever inactive pastes are scrubbed. Set this to 0 to disable the leaderboard.
+TOP_PASTES_LEADERBOARD_SIZE = 1000
+
+# Paste contents compression
+# If True, the contents of new pastes that are at least PASTE_COMPRESSION_THRESHOLD bytes long are stored compressed
+# with PASTE_COMPRESSION_CODEC (one of 'zlib', 'bz2', or 'lzma'), and transparently decompressed when they are read.
+# Contents are only stored compressed if that actually makes them smaller, and identical contents are only stored
+# once, however many pastes share them. Existing pastes can be converted in the background by
+# database.paste.convert_paste_contents(), which also decompresses contents again if this is disabled.
+ENABLE_PASTE_COMPRESSION = False
+PASTE_COMPRESSION_THRESHOLD = 1024
+PASTE_COMPRESSION_CODEC = 'zlib'
+
 # Database host
 # Optionally change the host on which the MySQL server is running; defaults to the same server hosting the site.
 DATABASE_HOST = 'localhost'
@@ -82,6 +174,50 @@ ID_ENCRYPTION_KEY = '43d0acab8bad477f'
 # AES iv for CBC block cipher operation, advice as per key gen above
 ID_ENCRYPTION_IV = 'b7bc6c40e5cc8162'
 
+# Scheme of encrypted IDs
+# This is only relevant if USE_ENCRYPTED_IDS above is True. 'aes' IDs are AES-encrypted with ID_ENCRYPTION_KEY and
+# ID_ENCRYPTION_IV, e.g. h0GZ19np17iT~CtpuIH3Nc. 'permutation' IDs are 11 base62 characters, e.g. 4kBYp2ZqW0x, computed
+# by a permutation of the 64-bit numbers keyed by ID_ENCRYPTION_KEY: they are half as long, and cheaper to compute.
+# Changing the scheme changes the URLs of all pastes. While ACCEPT_LEGACY_ENCRYPTED_IDS is True, 'aes' IDs, e.g. in
+# links shared before the scheme was changed to 'permutation', keep being accepted.
+ENCRYPTED_ID_SCHEME = 'aes'
+ACCEPT_LEGACY_ENCRYPTED_IDS = True
+
+# Password hashing
+# Passwords of users and of password-protected pastes are hashed with PASSWORD_HASHER: 'pbkdf2_sha256', with
+# PASSWORD_PBKDF2_ITERATIONS iterations, or 'scrypt', with the cost parameters PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, and
+# PASSWORD_SCRYPT_P. Each hash records its algorithm, parameters, and random salt, so these can be changed at any time:
+# existing hashes, including the unsalted hashes of earlier versions, keep being verified, and are replaced with hashes
+# of the current settings the next time their password is entered correctly.
+PASSWORD_HASHER = 'pbkdf2_sha256'
+PASSWORD_PBKDF2_ITERATIONS = 100000
+PASSWORD_SCRYPT_N = 16384
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+
+# Password hashing processes
+# If PASSWORD_HASHING_PROCESSES is greater than 0, each application process hashes and checks passwords in a pool of
+# this many worker processes, rather than in the thread handling the request, so that a burst of logins doesn't stall
+# its other requests. At most PASSWORD_HASHING_MAX_PENDING passwords may be waiting for or being hashed at a time, and
+# each must be hashed within PASSWORD_HASHING_TIMEOUT seconds, including the wait: otherwise, the request fails right
+# away with a 503 error, rather than piling up.
+PASSWORD_HASHING_PROCESSES = 0
+PASSWORD_HASHING_MAX_PENDING = 32
+PASSWORD_HASHING_TIMEOUT = 5
+# The worker processes are started by running a Python interpreter, which is the one running the application by default.
+# When the application is embedded in the web server, e.g. by mod_wsgi, that is the web server's own binary instead, so
+# set this to the absolute path of the Python interpreter of the application's environment, e.g.
+# '/modern-paste/venv/bin/python3'. Leave this as None otherwise.
+PASSWORD_HASHING_PYTHON_EXECUTABLE = None
+
+# Unlock tokens of password-protected pastes
+# Once the password of a password-protected paste has been supplied, the client is issued a signed unlock token, valid
+# for this many seconds, which grants access to the paste in place of its password, so that the password doesn't have
+# to be hashed again for each request. Tokens are sent as a cookie, and returned by the paste details API endpoint and in
+# the X-Paste-Unlock-Token header of raw paste views, e.g. for scripts, which can pass them as the unlock_token
+# parameter instead. Changing the paste's password invalidates its tokens. Set this to 0 to disable unlock tokens.
+PASTE_UNLOCK_TOKEN_TTL = 3600
+
 # Flask session secret key
 # IMPORTANT NOTE: Open up a Python terminal, and replace the below with the output of os.urandom(32)
 # This secret key should be different for every installation of Modern Paste.
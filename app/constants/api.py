@@ -80,6 +80,27 @@ PASTE_ATTACHMENT_TOO_LARGE_FAILURE = {
 }
 PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE = 414
 
+PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'The attachment upload is too large. The maximum allowable size is {max_size} MB.'.format(max_size=config.MAX_ATTACHMENT_UPLOAD_SIZE),
+    FAILURE: 'paste_attachment_upload_too_large_failure',
+}
+PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE_CODE = 413
+
+INVALID_CURSOR_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'The pagination cursor is invalid',
+    FAILURE: 'invalid_cursor_failure',
+}
+INVALID_CURSOR_FAILURE_CODE = 400
+
+PASSWORD_HASHING_OVERLOADED_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'The server is handling too many passwords at the moment. Please try again later.',
+    FAILURE: 'password_hashing_overloaded_failure',
+}
+PASSWORD_HASHING_OVERLOADED_FAILURE_CODE = 503
+
 UNDEFINED_FAILURE = {
     RESULT: RESULT_FAULURE,
     MESSAGE: 'Undefined server-side failure',
@@ -1,15 +1,61 @@
+import base64
+import binascii
+import collections
+import concurrent.futures
+import contextlib
 import errno
+import functools
+import glob
+import hashlib
 import os
+import shutil
+import tempfile
+import time
 
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 
 import config
 import database.paste
 import models
+import util.compression
+import util.storage
 from modern_paste import session
 from util.exception import *
 
 
+# Suffix of the name of attachment files storing the raw contents of the attachment
+# Attachments uploaded before attachments were stored raw are stored base64-encoded, in files named without this suffix.
+RAW_FILE_SUFFIX = '.raw'
+
+# Name of the directory in config.ATTACHMENTS_DIR storing the attachment blobs, named by the hash of their contents,
+# when they are stored locally
+BLOB_DIR_NAME = 'blobs'
+
+# Name of the directory in config.ATTACHMENTS_DIR storing a directory per paste, for the attachments uploaded before
+# attachments were stored by content
+PASTE_DIR_NAME = 'pastes'
+
+# Suffix of the key of blobs stored gzip-compressed, appended to their content hash
+# Text-like attachments are stored compressed if config.ENABLE_ATTACHMENT_COMPRESSION is set; each blob is stored in
+# only one variant, which every attachment referencing it records as its content_encoding.
+GZIP_BLOB_SUFFIX = '.gz'
+
+# Local blobs and per-paste directories are fanned out into levels of subdirectories, as by util.storage.shard_path.
+# Earlier versions stored them directly in config.ATTACHMENTS_DIR/blobs and config.ATTACHMENTS_DIR, respectively; they
+# are still found there until they are moved by shard_attachment_paths.
+
+
+# Pool of threads writing attachment files, shared by all requests of this process
+attachment_file_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.ATTACHMENT_WRITE_THREADS,
+    thread_name_prefix='attachment-file',
+)
+
+
 def create_new_attachment(paste_id, file_name, file_size, mime_type, file_data):
     """
     Create a new database entry for an attachment with the given file_name, associated with a particular paste ID.
@@ -22,58 +68,590 @@ def create_new_attachment(paste_id, file_name, file_size, mime_type, file_data):
     :return: An instance of models.Attachment describing this attachment entry
     :raises PasteDoesNotExistException: If the associated paste does not exist
     """
-    # Add an entry into the database describing this file
-    new_attachment = models.Attachment(
-        paste_id=paste_id,
-        file_name=secure_filename(file_name),
-        file_size=file_size,
-        mime_type=mime_type,
+    store_blob = functools.partial(_store_attachment_file, paste_id, file_data, mime_type)
+    content_hash, _, is_created = store_blob()
+    return _commit_new_attachments(
+        paste_id,
+        [(file_name, file_size, mime_type, content_hash, store_blob)],
+        [content_hash] if is_created else [],
+    )[0]
+
+
+def create_new_attachment_from_stream(paste_id, file_name, mime_type, chunks, max_size=None):
+    """
+    Create a new attachment from its raw data, streamed in chunks. Each chunk is written to disk as soon as it arrives,
+    so the attachment is never held in memory as a whole, and its size and hash are computed along the way.
+
+    :param paste_id: Paste ID to associate with this attachment
+    :param file_name: Raw name of the file
+    :param mime_type: MIME type of the file
+    :param chunks: Iterable of byte strings, making up the raw data of the attachment
+    :param max_size: Maximum allowed size of the attachment in bytes, or None for no limit
+    :return: A tuple of the models.Attachment instance describing this attachment entry, and the hexadecimal SHA-256
+             digest of the attachment's data
+    :raises PasteDoesNotExistException: If the associated paste does not exist
+    :raises AttachmentTooLargeException: If the attachment is larger than max_size bytes, in which case nothing is stored
+    """
+    return create_new_attachments_from_stream(paste_id, [(file_name, mime_type, chunks)], max_size)[0]
+
+
+def create_new_attachments_from_stream(paste_id, files, max_size=None):
+    """
+    Create several new attachments from their raw data, each streamed in chunks, as create_new_attachment_from_stream
+    does. The data of each attachment is spooled to a temporary file as it arrives, and all attachments are only added
+    once all of them have been read, in a single transaction, so that either all of them are added or none of them are.
+
+    :param paste_id: Paste ID to associate with these attachments
+    :param files: Iterable of tuples of the raw file name, the MIME type, and an iterable of the byte strings making up
+                  the raw data of each attachment, e.g. as generated by util.upload.iter_multipart_files
+    :param max_size: Maximum allowed size of each attachment in bytes, or None for no limit
+    :return: A list of tuples of the models.Attachment instance describing each attachment entry, and the hexadecimal
+             SHA-256 digest of the attachment's data, in the same order
+    :raises PasteDoesNotExistException: If the associated paste does not exist
+    :raises AttachmentTooLargeException: If any attachment is larger than max_size bytes, in which case nothing is stored
+    """
+    # This will throw PasteDoesNotExistException if the paste ID does not exist or is invalid
+    database.paste.get_paste_by_id(paste_id, active_only=True, include_contents=False)
+
+    with contextlib.ExitStack() as spooled_files:
+        attachments = []
+        for file_name, mime_type, chunks in files:
+            file_size, content_hash, store_blob = spooled_files.enter_context(
+                _spool_attachment_chunks(chunks, max_size, mime_type),
+            )
+            attachments.append((file_name, file_size, mime_type, content_hash, store_blob))
+        new_attachments = _commit_new_attachments(paste_id, attachments)
+    return [
+        (new_attachment, content_hash)
+        for new_attachment, (_, _, _, content_hash, _) in zip(new_attachments, attachments)
+    ]
+
+
+def _commit_new_attachments(paste_id, attachments, created_hashes=()):
+    """
+    Add new attachments to the database in a single transaction. Once their blobs are referenced, each blob is stored
+    again if it is no longer stored, e.g. because it was removed since it was first stored; see ensure_attachment_file.
+    If the attachments can't be added, the blobs' files that were created for them are removed again.
+
+    :param paste_id: Paste ID to associate with these attachments
+    :param attachments: List of tuples of the raw file name, size, MIME type, content hash, and a function storing the
+                        blob of each attachment, which returns a tuple as _write_attachment_blob does
+    :param created_hashes: Content hashes of the blobs whose files were already created for these attachments
+    :return: A list of models.Attachment instances describing the attachment entries, in the same order
+    """
+    created_hashes = set(created_hashes)
+    rows = [
+        (paste_id, file_name, file_size, mime_type, content_hash, None)
+        for file_name, file_size, mime_type, content_hash, _ in attachments
+    ]
+    try:
+        try:
+            new_attachments = add_attachments(rows)
+        except IntegrityError:
+            # The same data was concurrently stored by another transaction, so its blob can now be referenced
+            session.rollback()
+            new_attachments = add_attachments(rows)
+        for new_attachment, (_, _, _, content_hash, store_blob) in zip(new_attachments, attachments):
+            new_attachment.content_encoding, is_created = _ensure_attachment_blob(content_hash, store_blob)
+            if is_created:
+                created_hashes.add(content_hash)
+        session.commit()
+    except:
+        session.rollback()
+        if created_hashes:
+            remove_attachment_blob_files(created_hashes)
+        raise
+    return new_attachments
+
+
+def add_attachment(paste_id, file_name, file_size, mime_type, content_hash, content_encoding=None):
+    """
+    Add an entry for an attachment whose blob has already been stored, along with a reference to the blob, within the
+    current transaction.
+
+    :param paste_id: Paste ID to associate with this attachment
+    :param file_name: Raw name of the file
+    :param file_size: Size of the file in bytes
+    :param mime_type: MIME type of the file
+    :param content_hash: Hexadecimal SHA-256 digest of the file's data, identifying its blob
+    :param content_encoding: Content coding of the stored blob, e.g. 'gzip', or None if it is stored raw
+    :return: An instance of models.Attachment describing this attachment entry
+    :raises IntegrityError: If the same blob is recorded concurrently by another transaction
+    """
+    return add_attachments([(paste_id, file_name, file_size, mime_type, content_hash, content_encoding)])[0]
+
+
+def add_attachments(attachments):
+    """
+    Add entries for several attachments whose blobs have already been stored, along with references to their blobs,
+    within the current transaction. The references are added with a constant number of queries, however many
+    attachments there are.
+
+    :param attachments: List of tuples of the paste ID, raw file name, size, MIME type, content hash, and content
+                        encoding of each attachment, as for add_attachment
+    :return: A list of models.Attachment instances describing the attachment entries, in the same order
+    :raises IntegrityError: If any of the same blobs are recorded concurrently by another transaction
+    """
+    _reference_attachment_blobs(content_hash for _, _, _, _, content_hash, _ in attachments)
+    new_attachments = [
+        models.Attachment(
+            paste_id=paste_id,
+            file_name=secure_filename(file_name),
+            file_size=file_size,
+            mime_type=mime_type,
+            content_hash=content_hash,
+            content_encoding=content_encoding,
+        )
+        for paste_id, file_name, file_size, mime_type, content_hash, content_encoding in attachments
+    ]
+    session.add_all(new_attachments)
+    return new_attachments
+
+
+def _reference_attachment_blobs(content_hashes):
+    """
+    Add references to the attachment blobs with the specified content hashes, within the current transaction. The
+    reference counts of existing blobs are atomically incremented; blobs that are not referenced yet are then recorded
+    with their number of references.
+
+    :param content_hashes: Iterable of the hexadecimal SHA-256 digests of the blobs' data, with one entry per reference
+    :raises IntegrityError: If the same blob is recorded concurrently by another transaction
+    """
+    ref_deltas = collections.Counter(content_hashes)
+    if not ref_deltas:
+        return
+    # The referenced blobs stay locked until the transaction ends, so that their files can't be removed by
+    # remove_attachment_blob_files in the meantime
+    models.AttachmentBlob.query.filter(
+        models.AttachmentBlob.content_hash.in_(list(ref_deltas)),
+    ).update(
+        {models.AttachmentBlob.ref_count: models.AttachmentBlob.ref_count + case(
+            ref_deltas,
+            value=models.AttachmentBlob.content_hash,
+            else_=0,
+        )},
+        synchronize_session=False,
     )
+    referenced_hashes = set(
+        content_hash
+        for content_hash, in session.query(models.AttachmentBlob.content_hash).filter(
+            models.AttachmentBlob.content_hash.in_(list(ref_deltas)),
+        )
+    )
+    new_blobs = [
+        models.AttachmentBlob(content_hash=content_hash, ref_count=ref_count)
+        for content_hash, ref_count in ref_deltas.items()
+        if content_hash not in referenced_hashes
+    ]
+    if new_blobs:
+        session.add_all(new_blobs)
+        session.flush()
 
-    _store_attachment_file(paste_id, file_data, new_attachment.hash_name)
 
-    session.add(new_attachment)
-    session.commit()
+def store_attachment_files(attachments_binary_data, mime_types=None):
+    """
+    Store the files of several attachments on disk concurrently, on the threads of attachment_file_executor. All files
+    are durable once this returns, so that they can be referenced by a transaction, which must then check that they are
+    still stored with ensure_attachment_file. If any of the files can't be stored, the files that were created by this
+    call are removed again, unless they are referenced in the meantime; files that were already stored are left alone.
 
-    return new_attachment
+    :param attachments_binary_data: List of the binary, base64-encoded data of each attachment
+    :param mime_types: List of the MIME types of each attachment, in the same order, deciding which attachments are
+                       stored compressed; or None to store all attachments raw
+    :return: A list of tuples of the hexadecimal SHA-256 digest of each attachment's data, identifying its blob, the
+             content encoding of the stored blob, and True if its file was created by this call, in the same order
+    :raises binascii.Error: If the data of any attachment is not validly base64-encoded
+    """
+    if not attachments_binary_data:
+        return []
+    futures = [
+        attachment_file_executor.submit(_write_attachment_blob, attachment_binary_data, mime_type)
+        for attachment_binary_data, mime_type in zip(
+            attachments_binary_data,
+            mime_types or [None] * len(attachments_binary_data),
+        )
+    ]
+    concurrent.futures.wait(futures)
+
+    if any(future.exception() is not None for future in futures):
+        remove_attachment_blob_files(
+            content_hash
+            for content_hash, _, is_created in (future.result() for future in futures if future.exception() is None)
+            if is_created
+        )
+        next(future for future in futures if future.exception() is not None).result()
+    return [future.result() for future in futures]
 
 
-def _store_attachment_file(paste_id, attachment_binary_data, attachment_hash_name):
+@contextlib.contextmanager
+def _spool_attachment_chunks(chunks, max_size, mime_type=None):
     """
-    Store the attachment on disk.
+    Spool the raw data of an attachment to a temporary file as it is streamed, computing its size and hash along the
+    way. Text-like data is compressed along the way into a second temporary file, which is stored instead if it is
+    smaller. The blob is only stored once the context's function to store it is called; the temporary files are removed
+    when the context exits.
+
+    :param chunks: Iterable of byte strings, making up the raw data of the attachment
+    :param max_size: Maximum allowed size of the attachment in bytes, or None for no limit
+    :param mime_type: MIME type of the attachment
+    :return: A context manager of a tuple of the size of the attachment in bytes, the hexadecimal SHA-256 digest of its
+             data, and a function storing its blob unless an identical blob is already stored, which returns a tuple as
+             _write_attachment_blob does
+    :raises AttachmentTooLargeException: If the attachment is larger than max_size bytes
+    """
+    storage = get_storage_backend()
+    file_size = 0
+    file_hash = hashlib.sha256()
+    compressor = util.compression.gzip_compressor() if _should_compress(mime_type) else None
+    temp_paths = []
+    # The blob's key is only known once all data has been hashed
+    try:
+        with tempfile.NamedTemporaryFile(dir=storage.temp_dir(), suffix='.tmp', delete=False) as temp_file, \
+                tempfile.NamedTemporaryFile(dir=storage.temp_dir(), suffix='.gz.tmp', delete=False) as gzip_file:
+            temp_paths = [temp_file.name, gzip_file.name]
+            for chunk in chunks:
+                file_size += len(chunk)
+                if max_size is not None and file_size > max_size:
+                    raise AttachmentTooLargeException(
+                        'Attachment is larger than the maximum size of {max_size} bytes'.format(max_size=max_size),
+                    )
+                file_hash.update(chunk)
+                temp_file.write(chunk)
+                if compressor:
+                    gzip_file.write(compressor.compress(chunk))
+            if compressor:
+                gzip_file.write(compressor.flush())
+            for stored_file in [temp_file, gzip_file]:
+                stored_file.flush()
+                os.fsync(stored_file.fileno())
+            gzip_size = gzip_file.tell()
+        content_hash = file_hash.hexdigest()
+
+        def store_blob():
+            is_stored, content_encoding = _find_attachment_blob(storage, content_hash)
+            if is_stored:
+                return content_hash, content_encoding, False
+            # The stored temporary file is consumed
+            if compressor and file_size >= config.ATTACHMENT_COMPRESSION_THRESHOLD and gzip_size < file_size:
+                storage.put_file(content_hash + GZIP_BLOB_SUFFIX, temp_paths.pop())
+                return content_hash, 'gzip', True
+            storage.put_file(content_hash, temp_paths.pop(0))
+            return content_hash, None, True
+
+        yield file_size, content_hash, store_blob
+    finally:
+        for temp_path in temp_paths:
+            os.remove(temp_path)
+
+
+def _store_attachment_file(paste_id, attachment_binary_data, mime_type=None):
+    """
+    Store the attachment, decoded, so that it can be served as is. Attachments are stored by the hash of their
+    contents, so that identical attachments share a single blob.
 
     :param paste_id: Paste ID to associate with this attachment
     :param attachment_binary_data: Binary, base64-encoded data for this attachment to write to a file
-    :param attachment_hash_name: The hashed name of the attachment corresponding to the name of the attachment file
-                                 on disk
-    """
-    # Create the file paths for storage
-    save_file_dir = '{attachments_dir}/{paste_id}'.format(
-        attachments_dir=config.ATTACHMENTS_DIR,
-        # This will throw PasteDoesNotExistException if the paste ID does not exist or is invalid
-        # This also protects against malicious users who specify an invalid paste ID
-        paste_id=database.paste.get_paste_by_id(paste_id, active_only=True).paste_id,
+    :param mime_type: MIME type of the attachment
+    :return: A tuple as returned by _write_attachment_blob
+    :raises PasteDoesNotExistException: If the paste does not exist or is not active
+    :raises binascii.Error: If the data is not validly base64-encoded
+    """
+    # This will throw PasteDoesNotExistException if the paste ID does not exist or is invalid
+    # This also protects against malicious users who specify an invalid paste ID
+    database.paste.get_paste_by_id(paste_id, active_only=True, include_contents=False)
+
+    return _write_attachment_blob(attachment_binary_data, mime_type)
+
+
+def _write_attachment_blob(attachment_binary_data, mime_type=None):
+    """
+    Store the decoded data of an attachment as its blob, unless an identical blob is already stored. Text-like data is
+    stored gzip-compressed if that makes it smaller. The blob is durable once this returns.
+
+    :param attachment_binary_data: Binary, base64-encoded data for this attachment to write to a file
+    :param mime_type: MIME type of the attachment
+    :return: A tuple of the hexadecimal SHA-256 digest of the attachment's data, identifying its blob, the content
+             encoding of the stored blob, and True if the blob's file was created by this call rather than already stored
+    :raises binascii.Error: If the data is not validly base64-encoded
+    """
+    attachment_data = base64.b64decode(attachment_binary_data)
+    content_hash = hashlib.sha256(attachment_data).hexdigest()
+    storage = get_storage_backend()
+    is_stored, content_encoding = _find_attachment_blob(storage, content_hash)
+    if is_stored:
+        return content_hash, content_encoding, False
+
+    if _should_compress(mime_type) and len(attachment_data) >= config.ATTACHMENT_COMPRESSION_THRESHOLD:
+        compressor = util.compression.gzip_compressor()
+        compressed_data = compressor.compress(attachment_data) + compressor.flush()
+        if len(compressed_data) < len(attachment_data):
+            storage.put(content_hash + GZIP_BLOB_SUFFIX, [compressed_data])
+            return content_hash, 'gzip', True
+    storage.put(content_hash, [attachment_data])
+    return content_hash, None, True
+
+
+def ensure_attachment_file(content_hash, attachment_binary_data, mime_type=None):
+    """
+    Make sure that the file of an attachment stored by store_attachment_files is still stored, once its blob is
+    referenced within the current transaction, and store it again otherwise.
+
+    Referencing a blob locks its entry until the transaction ends, and remove_attachment_blob_files only removes files
+    while holding the lock of their blob's entry, so a file that is still stored once its blob is referenced is never
+    removed until the reference is either committed, or rolled back. Before that, a file may have been removed, e.g. by
+    a concurrent scrub of the last attachment referencing an identical blob.
+
+    :param content_hash: Hexadecimal SHA-256 digest of the attachment's data, identifying its blob
+    :param attachment_binary_data: Binary, base64-encoded data of the attachment
+    :param mime_type: MIME type of the attachment
+    :return: A tuple of the content encoding of the stored blob, and True if the blob's file was stored again
+    """
+    return _ensure_attachment_blob(
+        content_hash,
+        functools.partial(_write_attachment_blob, attachment_binary_data, mime_type),
     )
-    save_file_path = '{save_file_dir}/{hash_name}'.format(
-        save_file_dir=save_file_dir,
-        hash_name=attachment_hash_name,
+
+
+def _ensure_attachment_blob(content_hash, store_blob):
+    """
+    Make sure that the blob of an attachment is stored, once it is referenced within the current transaction; see
+    ensure_attachment_file.
+
+    :param content_hash: Hexadecimal SHA-256 digest of the attachment's data, identifying its blob
+    :param store_blob: Function storing the attachment's blob, returning a tuple as _write_attachment_blob does
+    :return: A tuple of the content encoding of the stored blob, and True if the blob's file was created by this call
+    """
+    is_stored, content_encoding = _find_attachment_blob(get_storage_backend(), content_hash)
+    if is_stored:
+        return content_encoding, False
+    _, content_encoding, is_created = store_blob()
+    return content_encoding, is_created
+
+
+def _should_compress(mime_type):
+    return config.ENABLE_ATTACHMENT_COMPRESSION and util.compression.is_text_mime_type(mime_type)
+
+
+def _find_attachment_blob(storage, content_hash):
+    """
+    Find which variant of an attachment blob is already stored, if any.
+
+    :param storage: Storage backend of the attachment blobs
+    :param content_hash: Hexadecimal SHA-256 digest of the blob's data
+    :return: A tuple of True if the blob is stored, and the content encoding of the stored variant
+    """
+    if storage.exists(content_hash):
+        return True, None
+    if storage.exists(content_hash + GZIP_BLOB_SUFFIX):
+        return True, 'gzip'
+    return False, None
+
+
+def get_storage_backend():
+    """
+    Get the backend storing the attachment blobs, as configured by config.ATTACHMENTS_STORAGE_BACKEND. Attachments
+    uploaded before attachments were stored by content are always stored in config.ATTACHMENTS_DIR.
+
+    :return: A storage backend from util.storage
+    """
+    if config.ATTACHMENTS_STORAGE_BACKEND == 's3':
+        return _get_s3_storage_backend(
+            config.ATTACHMENTS_S3_BUCKET,
+            config.ATTACHMENTS_S3_PREFIX,
+            config.ATTACHMENTS_S3_ENDPOINT_URL,
+            config.ATTACHMENTS_S3_REGION,
+            config.ATTACHMENTS_S3_PRESIGNED_URL_TTL,
+        )
+    return util.storage.LocalStorageBackend(os.path.join(config.ATTACHMENTS_DIR, BLOB_DIR_NAME))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_s3_storage_backend(bucket, prefix, endpoint_url, region_name, presigned_url_ttl):
+    # The backend's client is thread-safe, and is expensive to create, so it is shared by all requests of the process
+    return util.storage.S3StorageBackend(
+        bucket=bucket,
+        prefix=prefix,
+        endpoint_url=endpoint_url,
+        region_name=region_name,
+        presigned_url_ttl=presigned_url_ttl,
     )
 
-    # Create the directory if it doesn't already exist
+
+def get_blob_key(content_hash, content_encoding=None):
+    """
+    Get the key under which an attachment blob is stored in the storage backend.
+
+    :param content_hash: Hexadecimal SHA-256 digest of the blob's data
+    :param content_encoding: Content coding of the stored blob, e.g. 'gzip', or None if it is stored raw
+    :return: Key of the blob
+    """
+    if content_encoding == 'gzip':
+        return content_hash + GZIP_BLOB_SUFFIX
+    return content_hash
+
+
+def get_blob_path(content_hash, content_encoding=None):
+    """
+    Get the path of the file storing the attachment blob with the specified content hash, when blobs are stored
+    locally.
+
+    :param content_hash: Hexadecimal SHA-256 digest of the blob's data
+    :param content_encoding: Content coding of the stored blob, e.g. 'gzip', or None if it is stored raw
+    :return: Path to the blob file
+    """
+    return util.storage.shard_path(
+        os.path.join(config.ATTACHMENTS_DIR, BLOB_DIR_NAME),
+        get_blob_key(content_hash, content_encoding),
+        content_hash,
+    )
+
+
+def get_paste_attachment_dir(paste_id):
+    """
+    Get the path of the directory storing the attachments of a paste that were uploaded before attachments were stored
+    by content.
+
+    :param paste_id: ID of the paste
+    :return: Path to the directory
+    """
+    return util.storage.shard_path(
+        os.path.join(config.ATTACHMENTS_DIR, PASTE_DIR_NAME),
+        str(paste_id),
+        hashlib.sha256(str(paste_id).encode('ascii')).hexdigest(),
+    )
+
+
+def _get_unsharded_paste_attachment_dir(paste_id):
+    return os.path.join(config.ATTACHMENTS_DIR, str(paste_id))
+
+
+def remove_paste_attachment_dirs(paste_id):
+    """
+    Remove the directory storing the attachments of a paste that were uploaded before attachments were stored by
+    content, in either layout, if it exists.
+
+    :param paste_id: ID of the paste
+    """
+    for dir_path in [get_paste_attachment_dir(paste_id), _get_unsharded_paste_attachment_dir(paste_id)]:
+        try:
+            shutil.rmtree(dir_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def dereference_attachment_blobs(content_hashes):
+    """
+    Remove references to attachment blobs, within the current transaction. The entries of the blobs that are no longer
+    referenced at all are kept, with no references, until their files are removed with remove_attachment_blob_files
+    once the transaction is committed.
+
+    :param content_hashes: Iterable of the content hashes of the removed references, with one entry per reference
+    :return: A list of the content hashes of the blobs that are no longer referenced
+    """
+    ref_deltas = collections.Counter(content_hashes)
+    if not ref_deltas:
+        return []
+    models.AttachmentBlob.query.filter(
+        models.AttachmentBlob.content_hash.in_(list(ref_deltas)),
+    ).update(
+        {models.AttachmentBlob.ref_count: models.AttachmentBlob.ref_count - case(
+            ref_deltas,
+            value=models.AttachmentBlob.content_hash,
+            else_=0,
+        )},
+        synchronize_session=False,
+    )
+    return [
+        content_hash
+        for content_hash, in session.query(models.AttachmentBlob.content_hash).filter(
+            models.AttachmentBlob.content_hash.in_(list(ref_deltas)),
+            models.AttachmentBlob.ref_count <= 0,
+        )
+    ]
+
+
+def remove_attachment_blob_files(content_hashes):
+    """
+    Remove the files of attachment blobs that are no longer referenced from the storage backend, along with the entries
+    of the blobs, in its own transaction. Blobs that were referenced again in the meantime are kept.
+
+    The files are removed while holding the locks of the blobs' entries, which are first recorded without references if
+    they don't exist, so that blobs that are being referenced concurrently are either kept, or only referenced once
+    their files are removed; see ensure_attachment_file.
+
+    :param content_hashes: Iterable of the content hashes of the blobs whose files to remove
+    """
+    content_hashes = set(content_hashes)
+    if not content_hashes:
+        return
+    while True:
+        recorded_hashes = set(
+            content_hash
+            for content_hash, in session.query(models.AttachmentBlob.content_hash).filter(
+                models.AttachmentBlob.content_hash.in_(list(content_hashes)),
+            )
+        )
+        try:
+            session.add_all([
+                models.AttachmentBlob(content_hash=content_hash, ref_count=0)
+                for content_hash in sorted(content_hashes - recorded_hashes)
+            ])
+            session.flush()
+            break
+        except IntegrityError:
+            # The same blobs were concurrently recorded by another transaction, which now holds their locks
+            session.rollback()
+
+    unreferenced_blobs = models.AttachmentBlob.query.filter(
+        models.AttachmentBlob.content_hash.in_(list(content_hashes)),
+        models.AttachmentBlob.ref_count <= 0,
+    )
+    unreferenced_hashes = [
+        content_hash
+        for content_hash, in unreferenced_blobs.with_entities(
+            models.AttachmentBlob.content_hash,
+        ).order_by(models.AttachmentBlob.content_hash).with_for_update()
+    ]
     try:
-        os.makedirs(save_file_dir)
-    except OSError as exception:
-        if exception.errno != errno.EEXIST:
-            raise
+        get_storage_backend().delete([
+            blob_key
+            for content_hash in unreferenced_hashes
+            for blob_key in [content_hash, content_hash + GZIP_BLOB_SUFFIX]
+        ])
+        unreferenced_blobs.delete(synchronize_session=False)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+
+def get_attachment_file(attachment):
+    """
+    Locate the file storing an attachment on disk.
+
+    :param attachment: An instance of models.Attachment
+    :return: A tuple of the path to the attachment file, and True if the file stores the raw contents of the attachment,
+             or False if it stores them base64-encoded. The path is None if the attachment's blob is not stored locally.
+             The contents of blobs stored compressed are encoded with the attachment's content_encoding.
+    """
+    if attachment.content_hash is not None:
+        blob_key = get_blob_key(attachment.content_hash, attachment.content_encoding)
+        return get_storage_backend().local_path(blob_key), True
 
-    # Write the attachment's base64-encoded data to a file
-    with open(save_file_path, 'w') as attachment_file:
-        attachment_file.write(attachment_binary_data)
+    # Files that have not been moved to the sharded layout yet are found in the earlier layout
+    paste_dir = get_paste_attachment_dir(attachment.paste_id)
+    if not os.path.isdir(paste_dir):
+        paste_dir = _get_unsharded_paste_attachment_dir(attachment.paste_id)
+    file_path = os.path.join(paste_dir, attachment.hash_name)
+    if os.path.exists(file_path + RAW_FILE_SUFFIX):
+        return file_path + RAW_FILE_SUFFIX, True
+    return file_path, False
 
 
 def get_attachment_by_id(attachment_id, active_only=False):
     """
-    Retrieve an attachment's details by ID.
+    Retrieve an attachment's details by ID, in a single query that never loads its paste's contents.
 
     :param attachment_id: ID of the attachment to retrieve
     :param active_only: True to only attempt to retrieve attachments associated with active pastes
@@ -81,8 +659,17 @@ def get_attachment_by_id(attachment_id, active_only=False):
     :raises AttachmentDoesNotExistException: If the attachment doesn't exist, or the associated paste doesn't exist,
                                              is deactivated, or has expired
     """
-    attachment = models.Attachment.query.filter_by(attachment_id=attachment_id).first()
-    if not attachment or (active_only and not database.paste.is_paste_active(attachment.paste_id)):
+    attachment_query = models.Attachment.query.filter_by(attachment_id=attachment_id)
+    if active_only:
+        attachment_query = attachment_query.join(
+            models.Paste,
+            models.Paste.paste_id == models.Attachment.paste_id,
+        ).filter(
+            models.Paste.is_active.is_(True),
+            or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+        )
+    attachment = attachment_query.first()
+    if not attachment:
         raise AttachmentDoesNotExistException(
             'No attachment with attachment_id {attachment_id} exists or its associated paste has been deactivated or is expired'.format(
                 attachment_id=attachment_id,
@@ -100,33 +687,201 @@ def get_attachment_by_name(paste_id, file_name, active_only=False):
     :param file_name: Name of the file to retrieve
     :param active_only: True to ensure that the paste is active
     :return: A models.Attachment instance representing the requested attachment
-    :raises PasteDoesNotExistException: If active_only is True and the paste is deactivated or nonexistent
+    :raises PasteDoesNotExistException: If the paste is nonexistent, or active_only is True and the paste is deactivated
     :raises AttachmentDoesNotExistException: If the attachment does not exist
     """
-    attachment = models.Attachment.query.filter_by(
-        paste_id=database.paste.get_paste_by_id(paste_id, active_only=active_only).paste_id,
-        file_name=file_name,
-    ).first()
-    if not attachment:
+    attachment, _ = get_attachment_and_post_time_by_name(paste_id, file_name, active_only=active_only)
+    return attachment
+
+
+def get_attachment_and_post_time_by_name(paste_id, file_name, active_only=False):
+    """
+    Get an attachment associated with a paste ID by name, along with the post time of the paste, in a single query on
+    the (paste_id, file_name) index that never loads the paste's contents.
+
+    :param paste_id: ID of the paste associated with this attachment
+    :param file_name: Name of the file to retrieve
+    :param active_only: True to ensure that the paste is active
+    :return: A tuple of the models.Attachment instance representing the requested attachment, and the UNIX timestamp
+             at which the paste was posted
+    :raises PasteDoesNotExistException: If the paste is nonexistent, or active_only is True and the paste is deactivated
+    :raises AttachmentDoesNotExistException: If the attachment does not exist
+    """
+    row = _get_paste_attachment_rows(paste_id, active_only, models.Attachment.file_name == file_name)[0]
+    if not row.Attachment:
         raise AttachmentDoesNotExistException(
             'No attachment with file_name {file_name} for paste_id {paste_id} exists'.format(
                 file_name=file_name,
                 paste_id=paste_id,
             )
         )
-    return attachment
+    return row.Attachment, row.post_time
 
 
 def get_attachments_for_paste(paste_id, active_only=False):
     """
-    Retrieve a list of attachments associated with a paste.
+    Retrieve a list of attachments associated with a paste, in a single query that never loads the paste's contents.
 
     :param paste_id: ID of the paste for which to retrieve a list of attachments entries.
     :param active_only: True to ensure that the paste is active
-    :return: A list of models.Attachment objects
-    :raises PasteDoesNotExistException: If active_only is True and the paste is deactivated or nonexistent
+    :return: A list of models.Attachment objects, in the order in which they were added
+    :raises PasteDoesNotExistException: If the paste is nonexistent, or active_only is True and the paste is deactivated
+    """
+    return [row.Attachment for row in _get_paste_attachment_rows(paste_id, active_only) if row.Attachment]
+
+
+def _get_paste_attachment_rows(paste_id, active_only, *criteria):
+    """
+    Query the attachments of a paste that match the given criteria, outer-joined to the paste, so that a paste without
+    any such attachments still yields a row.
+
+    :param paste_id: ID of the paste
+    :param active_only: True to ensure that the paste is active
+    :param criteria: SQLAlchemy criteria on models.Attachment
+    :return: A non-empty list of rows with the post_time of the paste and an Attachment, which is None if no
+             attachments match, ordered by attachment ID
+    :raises PasteDoesNotExistException: If the paste is nonexistent, or active_only is True and the paste is deactivated
+    """
+    paste_criteria = [models.Paste.paste_id == paste_id]
+    if active_only:
+        paste_criteria += [
+            models.Paste.is_active.is_(True),
+            or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+        ]
+    rows = session.query(models.Paste.post_time, models.Attachment).select_from(models.Paste).outerjoin(
+        models.Attachment,
+        and_(models.Attachment.paste_id == models.Paste.paste_id, *criteria),
+    ).filter(*paste_criteria).order_by(models.Attachment.attachment_id).all()
+    if not rows:
+        raise PasteDoesNotExistException(
+            'No paste with paste_id {paste_id} exists, or is no longer active due to deactivation or expiry'.format(
+                paste_id=paste_id,
+            )
+        )
+    return rows
+
+
+def find_encoded_attachment_files():
+    """
+    Find all attachment files in config.ATTACHMENTS_DIR that still store their attachment base64-encoded.
+
+    :return: A list of the paths of the base64-encoded attachment files
+    """
+    encoded_file_paths = []
+    for paste_dir_path in _find_paste_attachment_dirs():
+        try:
+            file_names = sorted(os.listdir(paste_dir_path))
+        except OSError as exception:
+            # The paste's attachments were scrubbed or moved, or this is not a directory of attachments
+            if exception.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            continue
+        encoded_file_paths += [
+            os.path.join(paste_dir_path, file_name)
+            for file_name in file_names
+            if '.' not in file_name
+        ]
+    return encoded_file_paths
+
+
+def _find_paste_attachment_dirs():
+    """
+    Find the directories storing the attachments of each paste that were uploaded before attachments were stored by
+    content, in both the earlier and the sharded layout.
+
+    :return: A list of the paths of the directories
+    """
+    unsharded_dirs = [
+        dir_path
+        for dir_path in glob.glob(os.path.join(glob.escape(config.ATTACHMENTS_DIR), '*'))
+        # Blobs, or anything else that is not a directory of a paste's attachments, are skipped
+        if os.path.basename(dir_path).isdigit()
+    ]
+    sharded_dirs = glob.glob(os.path.join(glob.escape(config.ATTACHMENTS_DIR), PASTE_DIR_NAME, *['*'] * (util.storage.SHARD_LEVELS + 1)))
+    return sorted(unsharded_dirs) + sorted(sharded_dirs)
+
+
+def convert_attachment_files():
+    """
+    Decode all base64-encoded attachment files in config.ATTACHMENTS_DIR, so that they can be served as is. Each file is
+    replaced by its raw counterpart atomically, so this method can run while the application is serving requests, and
+    can safely be run again if it is interrupted. This method is not intended to be called from within the application,
+    but rather externally either manually or via a script.
+
+    :return: A tuple of the list of paths of the converted files, and the list of paths of the files that could not be
+             decoded and were left as they are
+    """
+    converted_file_paths = []
+    invalid_file_paths = []
+    for file_path in find_encoded_attachment_files():
+        raw_file_path = file_path + RAW_FILE_SUFFIX
+        temp_file_path = raw_file_path + '.tmp'
+        try:
+            with open(file_path, 'rb') as encoded_file:
+                attachment_data = base64.b64decode(encoded_file.read())
+            with open(temp_file_path, 'wb') as temp_file:
+                temp_file.write(attachment_data)
+            os.replace(temp_file_path, raw_file_path)
+            # The raw file is served from now on; only then is the encoded file removed
+            os.remove(file_path)
+        except binascii.Error:
+            invalid_file_paths.append(file_path)
+            continue
+        except OSError as exception:
+            # The paste's attachments were scrubbed while they were being converted
+            if exception.errno != errno.ENOENT:
+                raise
+            continue
+        converted_file_paths.append(file_path)
+    return converted_file_paths, invalid_file_paths
+
+
+def find_unsharded_attachment_paths():
+    """
+    Find all blobs and per-paste attachment directories in config.ATTACHMENTS_DIR that are still stored in the earlier
+    layout, directly in their parent directory rather than in its levels of subdirectories.
+
+    :return: A list of the paths of the blob files and per-paste directories
+    """
+    blob_dir = os.path.join(glob.escape(config.ATTACHMENTS_DIR), BLOB_DIR_NAME)
+    unsharded_blob_paths = [
+        blob_path
+        for blob_path in glob.glob(os.path.join(blob_dir, '*'))
+        # Skip the subdirectories of the sharded layout, and the temporary files of blobs that are being stored
+        if os.path.isfile(blob_path) and not blob_path.endswith('.tmp')
+    ]
+    unsharded_paste_dirs = [
+        dir_path
+        for dir_path in glob.glob(os.path.join(glob.escape(config.ATTACHMENTS_DIR), '*'))
+        if os.path.basename(dir_path).isdigit() and os.path.isdir(dir_path)
+    ]
+    return sorted(unsharded_blob_paths) + sorted(unsharded_paste_dirs)
+
+
+def shard_attachment_paths():
+    """
+    Move all blobs and per-paste attachment directories in config.ATTACHMENTS_DIR that are stored in the earlier layout
+    to the sharded layout. Each is moved with an atomic rename, and attachments are found in either layout, so this
+    method can run while the application is serving requests, and can safely be run again if it is interrupted. This
+    method is not intended to be called from within the application, but rather externally either manually or via a
+    script.
+
+    :return: A list of the paths that were moved
     """
-    return models.Attachment.query.filter_by(
-        # This will throw an exception if the associated paste is inactive or nonexistent
-        paste_id=database.paste.get_paste_by_id(paste_id=paste_id, active_only=active_only).paste_id,
-    ).all()
+    moved_paths = []
+    for path in find_unsharded_attachment_paths():
+        name = os.path.basename(path)
+        if os.path.isdir(path):
+            sharded_path = get_paste_attachment_dir(name)
+        else:
+            sharded_path = get_blob_path(name)
+        util.storage.make_dir(os.path.dirname(sharded_path))
+        try:
+            os.rename(path, sharded_path)
+        except OSError as exception:
+            # The blob or the paste's attachments were scrubbed while they were being moved
+            if exception.errno != errno.ENOENT:
+                raise
+            continue
+        moved_paths.append(path)
+    return moved_paths
@@ -1,16 +1,58 @@
-import errno
-import shutil
+import base64
+import collections
+import concurrent.futures
+import json
 import time
 
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy import LargeBinary
 from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import defer
+from sqlalchemy.orm import lazyload
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.attributes import set_committed_value
 
 import config
+import database.attachment
 import models
+import util.aggregator
+import util.cache
 import util.cryptography
+from modern_paste import app
 from modern_paste import session
 from util.exception import *
 
 
+# Default maximum number of pastes deleted per transaction by scrub_inactive_pastes
+SCRUB_BATCH_SIZE = 500
+
+# Default number of threads removing the attachment files of scrubbed pastes
+SCRUB_FILE_THREADS = 8
+
+
+# Number of seconds for which each process caches the rank of the lowest paste on the top pastes leaderboard
+TOP_PASTES_FLOOR_TTL = 10
+TOP_PASTES_FLOOR_KEY = 'floor'
+# Rank below every viewed paste, as the floor of a top pastes leaderboard that is not full; see _get_top_pastes_floor
+NO_TOP_PASTES_FLOOR = (0, 0)
+
+
+# Read-through cache of paste rows, keyed by paste ID; only used if config.ENABLE_PASTE_CACHE is True
+paste_cache = util.cache.ReadThroughCache(
+    local=util.cache.LRUCache(config.PASTE_CACHE_SIZE),
+    shared=util.cache.RedisCacheBackend(config.PASTE_CACHE_REDIS_URL) if config.PASTE_CACHE_REDIS_URL else None,
+)
+
+# Rank of the lowest paste on the top pastes leaderboard, as last seen by this process; see _get_top_pastes_floor
+top_pastes_floor_cache = util.cache.LRUCache(1)
+
+
 def create_new_paste(contents, user_id=None, expiry_time=None, title=None, language=None, password=None, is_api_post=False):
     """
     Create a new paste.
@@ -23,39 +65,159 @@ def create_new_paste(contents, user_id=None, expiry_time=None, title=None, langu
     :param password: Password of the paste (optional)
     :param is_api_post: True to indicate that the post was posted externally via the API interface (optional)
     :return: An instance of models.Paste representing the newly added paste.
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
     """
-    new_paste = models.Paste(
-        user_id=user_id,
+    new_paste, _ = create_new_paste_with_attachments(
         contents=contents,
-        expiry_time=int(expiry_time) if expiry_time is not None else None,
-        title=title if title else 'Untitled',
-        language=language or 'text',
-        password_hash=util.cryptography.secure_hash(password) if password is not None else None,
+        attachments=[],
+        user_id=user_id,
+        expiry_time=expiry_time,
+        title=title,
+        language=language,
+        password=password,
         is_api_post=is_api_post,
     )
-    session.add(new_paste)
-    session.commit()
     return new_paste
 
 
-def get_paste_by_id(paste_id, active_only=False):
+def create_new_paste_with_attachments(contents, attachments, user_id=None, expiry_time=None, title=None, language=None, password=None, is_api_post=False):
+    """
+    Create a new paste along with its attachments, in a single transaction. The attachment files are written
+    concurrently and made durable before the transaction is committed; if the paste can't be created, the files that
+    were created for it are removed again.
+
+    :param contents: Contents of the paste
+    :param attachments: List of dictionaries describing the attachments, with the keys name, size, mime_type, and data
+                        (the binary, base64-encoded file data)
+    :param user_id: User ID of the paste poster
+    :param expiry_time: Unix time at which the paste should expire (optional, default to no expiry)
+    :param title: Title of the paste (optional)
+    :param language: Language of the paste (optional, defaults to plain text)
+    :param password: Password of the paste (optional)
+    :param is_api_post: True to indicate that the post was posted externally via the API interface (optional)
+    :return: A tuple of the instance of models.Paste representing the newly added paste, and a list of the instances
+             of models.Attachment describing its attachments
+    :raises binascii.Error: If the data of any attachment is not validly base64-encoded, in which case nothing is created
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
+    """
+    # The password is hashed first, so that nothing is stored if hashing is overloaded
+    password_hash = util.cryptography.hash_password(password)
+    stored_blobs = database.attachment.store_attachment_files(
+        [attachment.get('data') for attachment in attachments],
+        [attachment.get('mime_type') for attachment in attachments],
+    )
+
+    def add_paste():
+        _reference_paste_content(contents)
+        new_paste = models.Paste(
+            user_id=user_id,
+            contents=contents,
+            expiry_time=int(expiry_time) if expiry_time is not None else None,
+            title=title if title else 'Untitled',
+            language=language or 'text',
+            password_hash=password_hash,
+            is_api_post=is_api_post,
+        )
+        session.add(new_paste)
+        if not attachments:
+            return new_paste, []
+        # The paste ID is needed to add the attachments
+        session.flush()
+        return new_paste, database.attachment.add_attachments([
+            (
+                new_paste.paste_id,
+                attachment.get('name'),
+                attachment.get('size'),
+                attachment.get('mime_type'),
+                content_hash,
+                content_encoding,
+            )
+            for attachment, (content_hash, content_encoding, _) in zip(attachments, stored_blobs)
+        ])
+
+    created_blob_hashes = set(content_hash for content_hash, _, is_created in stored_blobs if is_created)
+    try:
+        try:
+            new_paste, new_attachments = add_paste()
+        except IntegrityError:
+            # The same contents or attachments were concurrently stored by another transaction, so they can now be
+            # referenced
+            session.rollback()
+            new_paste, new_attachments = add_paste()
+        # Files that were removed since they were stored, now that their blobs are referenced, are stored again
+        for new_attachment, attachment in zip(new_attachments, attachments):
+            new_attachment.content_encoding, is_restored = database.attachment.ensure_attachment_file(
+                new_attachment.content_hash,
+                attachment.get('data'),
+                attachment.get('mime_type'),
+            )
+            if is_restored:
+                created_blob_hashes.add(new_attachment.content_hash)
+        session.commit()
+    except:
+        session.rollback()
+        # Only the files written for this paste are removed; blobs that were already stored may be in use
+        database.attachment.remove_attachment_blob_files(created_blob_hashes)
+        raise
+    return new_paste, new_attachments
+
+
+def _reference_paste_content(contents):
+    """
+    Add a reference to the stored paste content with the specified contents, within the current transaction. Contents
+    that are not stored yet are stored with a single reference; otherwise, the existing content's reference count is
+    atomically incremented.
+
+    :param contents: Paste contents
+    :return: The hash of the contents, identifying the models.PasteContent
+    :raises IntegrityError: If the same contents are stored concurrently by another transaction
+    """
+    content_hash = models.PasteContent.hash_contents(contents)
+    is_referenced = models.PasteContent.query.filter_by(
+        content_hash=content_hash,
+    ).update(
+        {models.PasteContent.ref_count: models.PasteContent.ref_count + 1},
+        synchronize_session=False,
+    )
+    if not is_referenced:
+        # Contents loaded in this session may since have been deleted, e.g. by scrubbing, in which case their stale
+        # instance would conflict with the new one
+        stale_content = session.get(models.PasteContent, content_hash)
+        if stale_content is not None:
+            session.expunge(stale_content)
+        session.add(models.PasteContent(contents=contents))
+        session.flush()
+    return content_hash
+
+
+def get_paste_by_id(paste_id, active_only=False, include_contents=True):
     """
     Get the specified paste by ID.
 
     :param paste_id: Paste ID to look up
     :param active_only: Set this flag to True to only query for active and non-expired pastes
+    :param include_contents: False to not load the contents of the paste from the database until they are accessed;
+                             pastes served from the paste cache always include their contents
     :return: An instance of models.Paste representing the requested paste
     :raises PasteDoesNotExistException: If the paste does not exist
     """
-    if active_only:
-        paste = models.Paste.query.filter_by(
+    if config.ENABLE_PASTE_CACHE:
+        paste = _get_cached_paste(paste_id)
+        if paste and active_only and not (paste.is_active and (paste.expiry_time is None or paste.expiry_time > time.time())):
+            paste = None
+    elif active_only:
+        paste = models.Paste.query.options(
+            *_paste_load_options(include_contents)
+        ).filter_by(
             paste_id=paste_id,
             is_active=True,
         ).filter(
             or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
         ).first()
     else:
-        paste = models.Paste.query.filter_by(
+        paste = models.Paste.query.options(
+            *_paste_load_options(include_contents)
+        ).filter_by(
             paste_id=paste_id,
         ).first()
     if not paste:
@@ -67,6 +229,123 @@ def get_paste_by_id(paste_id, active_only=False):
     return paste
 
 
+def _get_cached_paste(paste_id):
+    """
+    Get the specified paste by ID through the paste cache. Only active, non-expired pastes without a password are
+    cached, and each cache entry expires no later than its paste does.
+
+    :param paste_id: Paste ID to look up
+    :return: An instance of models.Paste attached to the current session, or None if the paste does not exist
+    """
+    def load_paste_row():
+        paste = models.Paste.query.filter_by(paste_id=paste_id).first()
+        return _paste_row(paste) if paste else None
+
+    try:
+        paste_id = int(paste_id)
+    except (TypeError, ValueError):
+        return None
+
+    row = paste_cache.get(paste_id, load_paste_row, ttl=_paste_row_ttl)
+    if row is None:
+        return None
+
+    # Rebuild the paste from its cached row and attach it to the current session without querying the database, so that
+    # it behaves exactly like a paste that was just loaded by a query.
+    paste = session.merge(_instance_from_row(models.Paste, row), load=False)
+    content = session.merge(_instance_from_row(models.PasteContent, row['content']), load=False) if row['content'] else None
+    set_committed_value(paste, 'content', content)
+    return paste
+
+
+def _cache_paste(paste):
+    """
+    Write the current state of a paste to the paste cache.
+
+    :param paste: An instance of models.Paste
+    """
+    row = _paste_row(paste)
+    paste_cache.set(paste.paste_id, row, _paste_row_ttl(row))
+
+
+def _paste_row(paste):
+    """
+    Represent a paste, along with its content, as a JSON-serializable dictionary of column values, suitable for storage
+    in the paste cache.
+
+    :param paste: An instance of models.Paste
+    :return: Dictionary mapping column attribute names to values, and 'content' to the row of the paste's content
+    """
+    row = _instance_row(paste)
+    row['content'] = _instance_row(paste.content) if paste.content_hash is not None else None
+    return row
+
+
+def _instance_row(instance):
+    """
+    Represent a model instance as a JSON-serializable dictionary of its column values. Binary values are base64-encoded.
+
+    :param instance: A model instance
+    :return: Dictionary mapping column attribute names to values
+    """
+    row = {}
+    for key, is_binary in _column_attributes(type(instance)):
+        value = getattr(instance, key)
+        if value is not None and is_binary:
+            value = base64.b64encode(value).decode('ascii')
+        row[key] = value
+    return row
+
+
+def _instance_from_row(model, row):
+    """
+    Rebuild a model instance from its row, as returned by _instance_row, without querying the database. The instance is
+    detached, as if it had been loaded by a query in a session that has since been closed.
+
+    :param model: The model class
+    :param row: Dictionary mapping column attribute names to values
+    :return: A detached instance of the model
+    """
+    instance = model.__mapper__.class_manager.new_instance()
+    for key, is_binary in _column_attributes(model):
+        value = row[key]
+        if value is not None and is_binary:
+            value = base64.b64decode(value)
+        set_committed_value(instance, key, value)
+    make_transient_to_detached(instance)
+    return instance
+
+
+def _column_attributes(model):
+    """
+    Get the attributes of a model that are mapped to the columns of its table.
+
+    :param model: The model class
+    :return: A list of tuples of the attribute name, and whether the column holds binary values
+    """
+    return [
+        (model.__mapper__.get_property_by_column(column).key, isinstance(column.type, LargeBinary))
+        for column in model.__table__.columns
+    ]
+
+
+def _paste_row_ttl(row):
+    """
+    Number of seconds for which a paste row may be cached: inactive pastes are never cached, and active pastes are
+    cached no later than their expiry time. Password-protected pastes are never cached either, so that their passwords
+    and unlock tokens are always checked against their current password hash, even if it was changed by another
+    process whose evictions this process doesn't see.
+
+    :param row: Paste row, as returned by _paste_row
+    :return: Number of seconds for which the row may be cached
+    """
+    if not row['is_active'] or row['password_hash'] is not None:
+        return 0
+    if row['expiry_time'] is None:
+        return config.PASTE_CACHE_TTL
+    return min(config.PASTE_CACHE_TTL, row['expiry_time'] - time.time())
+
+
 def is_paste_active(paste_id):
     """
     Check if this paste is active. The paste is considered active if it exists, has not been deactivated, and has not
@@ -75,8 +354,12 @@ def is_paste_active(paste_id):
     :param paste_id: ID of the paste to check
     :return: True if the paste is active; False otherwise
     """
-    paste = models.Paste.query.filter_by(paste_id=paste_id).first()
-    return paste and paste.is_active and (paste.expiry_time is None or paste.expiry_time > time.time())
+    # Only the paste's ID is selected, so that its contents are never loaded
+    return session.query(models.Paste.paste_id).filter(
+        models.Paste.paste_id == paste_id,
+        models.Paste.is_active.is_(True),
+        or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+    ).first() is not None
 
 
 def set_paste_password(paste_id, password):
@@ -88,13 +371,77 @@ def set_paste_password(paste_id, password):
     :param password: New password to set for the paste, can be None to remove any existing password
     :return: An instance of models.Paste of the affected paste
     :raises PasteDoesNotExistException: If the paste does not exist
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
     """
     paste = get_paste_by_id(paste_id, active_only=True)
-    paste.password_hash = util.cryptography.secure_hash(password) if password is not None else None
+    paste.password_hash = util.cryptography.hash_password(password)
     session.commit()
+    paste_cache.invalidate(paste.paste_id)
     return paste
 
 
+def check_paste_password(paste, password):
+    """
+    Check the password of a password-protected paste. If it is correct, but the paste's password hash was generated by
+    another hasher or with other parameters than those currently configured, e.g. by an earlier version, the password
+    is hashed again.
+
+    :param paste: An instance of models.Paste of a paste with a password
+    :param password: Plain text password to check
+    :return: True if the password is correct; False otherwise
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
+    """
+    if not util.cryptography.verify_password(password, paste.password_hash):
+        return False
+    if util.cryptography.password_needs_rehash(paste.password_hash):
+        try:
+            new_password_hash = util.cryptography.hash_password(password)
+        except PasswordHashingOverloadedException:
+            # The hash is replaced when the password is next checked instead
+            return True
+        # The hash is only replaced if the password wasn't changed in the meantime
+        models.Paste.query.filter_by(
+            paste_id=paste.paste_id,
+            password_hash=paste.password_hash,
+        ).update({models.Paste.password_hash: new_password_hash}, synchronize_session=False)
+        session.commit()
+        paste_cache.invalidate(paste.paste_id)
+        set_committed_value(paste, 'password_hash', new_password_hash)
+    return True
+
+
+def _paste_unlock_message(paste):
+    # Tokens are scoped to the paste's current password hash, so that changing the password invalidates them
+    return 'paste-unlock:{paste_id}:{password_hash}'.format(paste_id=paste.paste_id, password_hash=paste.password_hash)
+
+
+def get_paste_unlock_token(paste):
+    """
+    Generate an unlock token for a password-protected paste, which grants access to it in place of its password for
+    config.PASTE_UNLOCK_TOKEN_TTL seconds, unless the paste's password is changed in the meantime. Tokens are only
+    checked with an HMAC, so this is much cheaper than checking the password every time.
+
+    :param paste: An instance of models.Paste of a paste with a password, which was just checked
+    :return: The unlock token, type str, or None if unlock tokens are disabled
+    """
+    if not config.PASTE_UNLOCK_TOKEN_TTL:
+        return None
+    return util.cryptography.generate_signed_token(_paste_unlock_message(paste), config.PASTE_UNLOCK_TOKEN_TTL)
+
+
+def check_paste_unlock_token(paste, token):
+    """
+    Check an unlock token generated by get_paste_unlock_token.
+
+    :param paste: An instance of models.Paste of a paste with a password
+    :param token: The unlock token, can be None
+    :return: True if the token unlocks the paste, with its current password; False otherwise
+    """
+    if not token or not config.PASTE_UNLOCK_TOKEN_TTL:
+        return False
+    return util.cryptography.verify_signed_token(token, _paste_unlock_message(paste))
+
+
 def deactivate_paste(paste_id):
     """
     Deactivate the specified paste by ID.
@@ -105,79 +452,571 @@ def deactivate_paste(paste_id):
     """
     paste = get_paste_by_id(paste_id)
     paste.is_active = False
+    is_top_paste = models.TopPaste.query.filter_by(paste_id=paste.paste_id).delete(synchronize_session=False)
     session.commit()
+    paste_cache.invalidate(paste.paste_id)
+    if is_top_paste:
+        _refill_top_pastes()
     return paste
 
 
 def increment_paste_views(paste_id):
     """
-    Increment (by 1) the number of times this paste has been viewed.
+    Increment (by 1) the number of times this paste has been viewed. The increment is performed atomically in the
+    database, so concurrent increments are never lost.
 
     :param paste_id: The paste whose view count should be incremented
     :return: The models.Paste object representing the paste whose view was incremented
     :raises PasteDoesNotExistException: If the paste does not exist
     """
     paste = get_paste_by_id(paste_id)
-    paste.views += 1
+    models.Paste.query.filter_by(
+        paste_id=paste.paste_id,
+    ).update(
+        {models.Paste.views: models.Paste.views + 1},
+        synchronize_session='evaluate',
+    )
     session.commit()
+    _update_top_pastes([paste.paste_id])
+    if config.ENABLE_PASTE_CACHE:
+        _cache_paste(paste)
     return paste
 
 
-def get_recent_pastes(page_num, num_per_page):
+def view_paste(paste_id, count_protected=True, include_contents=True):
+    """
+    Fetch an active, non-expired paste and count a view of it, in as few database round trips as possible.
+
+    If views are written through (config.PASTE_VIEW_FLUSH_INTERVAL is 0), a single conditional UPDATE both counts the
+    view and checks that the paste is active and not expired, and the paste is then loaded once in the same transaction.
+    The paste's row lock is held until the transaction commits, so the loaded view count includes exactly this view.
+    Otherwise, the paste is loaded once (or served from the paste cache), and the view is buffered in memory.
+
+    :param paste_id: Paste ID to look up
+    :param count_protected: False to not count the view if the paste is password-protected; in that case, the view
+                            should be recorded with record_paste_view once the password has been checked
+    :param include_contents: False to not load the contents of the paste from the database until they are accessed
+    :return: A tuple of the models.Paste object representing the viewed paste, and True if this was its first view
+    :raises PasteDoesNotExistException: If the paste does not exist, is deactivated, or has expired
+    """
+    if config.PASTE_VIEW_FLUSH_INTERVAL > 0:
+        paste = get_paste_by_id(paste_id, active_only=True, include_contents=include_contents)
+        if paste.password_hash and not count_protected:
+            return paste, False
+        return paste, record_paste_view(paste.paste_id, views=paste.views)
+
+    viewable_pastes = models.Paste.query.filter_by(
+        paste_id=paste_id,
+        is_active=True,
+    ).filter(
+        or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+    )
+    if not count_protected:
+        viewable_pastes = viewable_pastes.filter(models.Paste.password_hash.is_(None))
+    is_viewed = viewable_pastes.update(
+        {models.Paste.views: models.Paste.views + 1},
+        synchronize_session=False,
+    )
+    if not is_viewed:
+        session.commit()
+        # Either the paste doesn't exist, or it is password-protected and the view was deliberately not counted
+        return get_paste_by_id(paste_id, active_only=True, include_contents=include_contents), False
+
+    paste = models.Paste.query.options(
+        *_paste_load_options(include_contents)
+    ).filter_by(paste_id=paste_id).populate_existing().first()
+    session.commit()
+    _update_top_pastes([paste.paste_id], views={paste.paste_id: paste.views})
+    if config.ENABLE_PASTE_CACHE:
+        if include_contents:
+            _cache_paste(paste)
+        else:
+            # Caching the paste would load its contents after all; have the next lookup cache it instead
+            paste_cache.invalidate(paste.paste_id)
+    return paste, paste.views == 1
+
+
+def record_paste_view(paste_id, views=None):
+    """
+    Record a single view of a paste. Unless disabled by config.PASTE_VIEW_FLUSH_INTERVAL, the view is only counted in
+    memory by paste_view_counter, which writes views to the database in periodic batches rather than with one
+    transaction per view.
+
+    The first view of a paste is always written to the database immediately, with a conditional update, so that exactly
+    one viewer is ever considered to be the paste's first viewer.
+
+    :param paste_id: ID of the paste that was viewed
+    :param views: The paste's view count as it was last loaded, if known; used to detect the paste's first view
+    :return: True if this was the first view of the paste; False otherwise
+    """
+    if views == 0:
+        is_first_view = models.Paste.query.filter_by(
+            paste_id=paste_id,
+            views=0,
+        ).update(
+            {models.Paste.views: models.Paste.views + 1},
+            synchronize_session='evaluate',
+        )
+        session.commit()
+        if is_first_view:
+            paste_cache.invalidate(paste_id)
+            _update_top_pastes([paste_id], views={paste_id: 1})
+            return True
+
+    if config.PASTE_VIEW_FLUSH_INTERVAL > 0:
+        paste_view_counter.add(paste_id)
+    else:
+        _flush_paste_views({paste_id: 1})
+    return False
+
+
+def flush_paste_views():
+    """
+    Write all paste views buffered by this process to the database. This happens automatically in the background, but
+    may also be called explicitly, e.g. before shutting down a process.
+    """
+    paste_view_counter.flush()
+
+
+def _flush_paste_views(view_deltas):
+    """
+    Add buffered view counts to the database in a single UPDATE statement, as views = views + delta for each paste.
+    If the UPDATE fails, the session is rolled back and the exception is propagated, so that the views are retried on the
+    next flush. Once the UPDATE is committed, no exception is propagated, so that the views are never counted twice.
+
+    Views are flushed on a session of their own, in an app context of their own, whether from the background thread
+    outside of any request or inline from the request that triggered the flush; the pending changes of that request are
+    then neither committed nor rolled back by the flush.
+
+    :param view_deltas: Dictionary mapping paste IDs to the number of views to add
+    """
+    with app.app_context():
+        _flush_paste_views_in_session(view_deltas)
+
+
+def _flush_paste_views_in_session(view_deltas):
+    """
+    Add buffered view counts to the database with the session of the current app context; see _flush_paste_views.
+
+    :param view_deltas: Dictionary mapping paste IDs to the number of views to add
+    """
+    try:
+        session.execute(
+            models.Paste.__table__.update().where(
+                # Sorting the IDs keeps the order in which row locks are acquired consistent between processes
+                models.Paste.paste_id.in_(sorted(view_deltas)),
+            ).values(
+                views=models.Paste.views + case(view_deltas, value=models.Paste.paste_id, else_=0),
+            )
+        )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    try:
+        _update_top_pastes(view_deltas.keys())
+    except SQLAlchemyError:
+        # The leaderboard is best-effort, and catches up when it is next rebuilt
+        session.rollback()
+
+
+# Write-behind buffer of paste views, keyed by paste ID
+paste_view_counter = util.aggregator.DeltaAggregator(
+    flush=_flush_paste_views,
+    flush_interval=config.PASTE_VIEW_FLUSH_INTERVAL,
+    flush_threshold=config.PASTE_VIEW_FLUSH_THRESHOLD,
+)
+
+
+def get_recent_pastes(page_num, num_per_page, include_contents=False, cursor=None):
     """
     Get recently posted pastes that are active and not expired. This query is intended to be used in chunks,
-    indexed by page: e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc.
+    indexed by page: e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc. Alternatively, the chunk following
+    the paste a cursor was created from (see get_recent_pastes_cursor) can be queried, which avoids scanning all pastes
+    on the preceding pages.
 
-    :param page_num: The page number. Indexes from 0.
+    :param page_num: The page number. Indexes from 0. Ignored if a cursor is specified.
     :param num_per_page: The number of results to query for in this chunk (e.g., to display on this page).
+    :param include_contents: True to load the contents of each paste; by default, only their size and preview are loaded
+    :param cursor: Optional cursor after which to query for pastes
     :return: A list of models.Paste objects sorted by post time (descending) that are active and not expired.
+    :raises InvalidCursorException: If the cursor is invalid
     """
-    return models.Paste.query.filter_by(
+    query = models.Paste.query.options(
+        *_paste_list_options(include_contents)
+    ).filter_by(
         is_active=True,
     ).filter(
         or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
     ).order_by(
         models.Paste.post_time.desc(),
-    ).offset(
-        page_num * num_per_page,
-    ).limit(
-        num_per_page,
-    ).all()
+        models.Paste.paste_id.desc(),
+    )
+    return _paginate_pastes(query, models.Paste.post_time, models.Paste.paste_id, page_num, num_per_page, cursor)
 
 
-def get_top_pastes(page_num, num_per_page):
+def get_top_pastes(page_num, num_per_page, include_contents=False, cursor=None):
     """
     Get the top (most viewed) pastes that are active and not expired. This query is intended to be used in chunks,
-    indexed by page: e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc.
+    indexed by page: e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc. Alternatively, the chunk following
+    the paste a cursor was created from (see get_top_pastes_cursor) can be queried, which avoids scanning all pastes on
+    the preceding pages.
+
+    Chunks within the top pastes leaderboard are read from it, without sorting all pastes by their views.
 
-    :param page_num: The page number. Indexes from 0.
+    :param page_num: The page number. Indexes from 0. Ignored if a cursor is specified.
     :param num_per_page: The number of results to query for in this chunk (e.g., to display on this page).
+    :param include_contents: True to load the contents of each paste; by default, only their size and preview are loaded
+    :param cursor: Optional cursor after which to query for pastes
     :return: A list of models.Paste objects sorted by number of views (descending) that are active and not expired.
+    :raises InvalidCursorException: If the cursor is invalid
     """
-    return models.Paste.query.filter_by(
+    if config.TOP_PASTES_LEADERBOARD_SIZE > 0:
+        def get_leaderboard_chunk():
+            return _paginate_pastes(
+                leaderboard_query,
+                models.TopPaste.views,
+                models.TopPaste.paste_id,
+                page_num,
+                num_per_page,
+                cursor,
+            )
+
+        leaderboard_query = models.Paste.query.options(
+            *_paste_list_options(include_contents)
+        ).join(
+            models.TopPaste,
+            models.TopPaste.paste_id == models.Paste.paste_id,
+        ).filter(
+            models.Paste.is_active.is_(True),
+            or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+        ).order_by(
+            models.TopPaste.views.desc(),
+            models.TopPaste.paste_id.desc(),
+        )
+        pastes = get_leaderboard_chunk()
+        # The leaderboard always holds the top pastes, so a full chunk from it is exactly the requested chunk. Otherwise,
+        # the chunk extends beyond the leaderboard, or deactivated or expired pastes on it cut the chunk short; these are
+        # then replaced by the next pastes below it.
+        is_within_leaderboard = cursor is not None or (page_num + 1) * num_per_page <= config.TOP_PASTES_LEADERBOARD_SIZE
+        if len(pastes) < num_per_page and is_within_leaderboard and prune_top_pastes():
+            pastes = get_leaderboard_chunk()
+        if len(pastes) == num_per_page:
+            return pastes
+
+    query = models.Paste.query.options(
+        *_paste_list_options(include_contents)
+    ).filter_by(
         is_active=True,
     ).filter(
         or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
     ).order_by(
         models.Paste.views.desc(),
-    ).offset(
-        page_num * num_per_page,
+        models.Paste.paste_id.desc(),
+    )
+    return _paginate_pastes(query, models.Paste.views, models.Paste.paste_id, page_num, num_per_page, cursor)
+
+
+def get_recent_pastes_cursor(paste):
+    """
+    Create a cursor for querying the recent pastes following the specified paste.
+
+    :param paste: The last models.Paste object of a chunk returned by get_recent_pastes
+    :return: An opaque cursor string
+    """
+    return _encode_paste_cursor(models.Paste.post_time, paste)
+
+
+def get_top_pastes_cursor(paste):
+    """
+    Create a cursor for querying the top pastes following the specified paste.
+
+    :param paste: The last models.Paste object of a chunk returned by get_top_pastes
+    :return: An opaque cursor string
+    """
+    return _encode_paste_cursor(models.Paste.views, paste)
+
+
+def _paginate_pastes(query, sort_column, id_column, page_num, num_per_page, cursor):
+    """
+    Query for a chunk of pastes, sorted (descending) by a column and then by paste ID.
+
+    :param query: Query for pastes, sorted by sort_column and id_column
+    :param sort_column: The column by which the pastes are primarily sorted
+    :param id_column: The paste ID column by which the pastes are secondarily sorted
+    :param page_num: The page number, if no cursor is specified
+    :param num_per_page: The number of results to query for in this chunk
+    :param cursor: Optional cursor after which to query for pastes
+    :return: A list of models.Paste objects
+    :raises InvalidCursorException: If the cursor is invalid, or was created for a different sort column
+    """
+    if cursor is None:
+        query = query.offset(page_num * num_per_page)
+    else:
+        sort_value, paste_id = _decode_paste_cursor(sort_column, cursor)
+        query = query.filter(or_(
+            sort_column < sort_value,
+            and_(sort_column == sort_value, id_column < paste_id),
+        ))
+    return query.limit(num_per_page).all()
+
+
+def _encode_paste_cursor(sort_column, paste):
+    """
+    Encode the position of a paste in a list sorted by a column and then by paste ID as an opaque, URL-safe string.
+
+    :param sort_column: The column by which the list is primarily sorted
+    :param paste: The paste whose position to encode
+    :return: The cursor string
+    """
+    position = [sort_column.key, getattr(paste, sort_column.key), paste.paste_id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def _decode_paste_cursor(sort_column, cursor):
+    """
+    Decode a cursor created by _encode_paste_cursor.
+
+    :param sort_column: The column by which the list is expected to be sorted
+    :param cursor: The cursor string
+    :return: A tuple of the sort column value and the paste ID of the paste at the position
+    :raises InvalidCursorException: If the cursor is malformed, or was created for a different sort column
+    """
+    try:
+        column_key, sort_value, paste_id = json.loads(base64.urlsafe_b64decode(str(cursor).encode('ascii')))
+    except (TypeError, ValueError):
+        raise InvalidCursorException('Cursor {cursor} is malformed'.format(cursor=cursor))
+    if column_key != sort_column.key or not all(isinstance(value, int) for value in (sort_value, paste_id)):
+        raise InvalidCursorException('Cursor {cursor} is not valid for this list'.format(cursor=cursor))
+    return sort_value, paste_id
+
+
+def rebuild_top_pastes():
+    """
+    Rebuild the top pastes leaderboard from scratch, from the current views of all active, non-expired pastes. This
+    happens when the database is created by build/build_database.py or migrated by build/migrate_database.py, and
+    whenever inactive pastes are scrubbed. It may also be called explicitly, e.g. after changing
+    config.TOP_PASTES_LEADERBOARD_SIZE.
+    """
+    top_pastes = session.query(
+        models.Paste.paste_id,
+        models.Paste.views,
+    ).filter(
+        *_top_paste_candidate_criteria()
+    ).order_by(
+        models.Paste.views.desc(),
+        models.Paste.paste_id.desc(),
     ).limit(
-        num_per_page,
+        max(config.TOP_PASTES_LEADERBOARD_SIZE, 0),
     ).all()
 
+    try:
+        models.TopPaste.query.delete(synchronize_session=False)
+        session.add_all([models.TopPaste(paste_id=paste_id, views=views) for paste_id, views in top_pastes])
+        session.commit()
+    except (IntegrityError, OperationalError):
+        # Another process is updating the leaderboard concurrently
+        session.rollback()
+    top_pastes_floor_cache.clear()
+
+
+def _top_paste_candidate_criteria():
+    """
+    Criteria of the pastes that may be on the top pastes leaderboard. Pastes that were never viewed are left off, so that
+    a new paste, which ranks above older pastes with no views by its paste ID, never outranks a paste on the leaderboard.
+
+    :return: A list of filter criteria for models.Paste queries
+    """
+    return [
+        models.Paste.is_active.is_(True),
+        or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+        models.Paste.views > 0,
+    ]
+
+
+def _get_top_pastes_floor():
+    """
+    Get the rank of the lowest paste on the top pastes leaderboard, as cached by this process for at most
+    TOP_PASTES_FLOOR_TTL seconds. The lowest rank only rises as views are counted, so a cached rank is never above the
+    actual one, except within TOP_PASTES_FLOOR_TTL seconds of the leaderboard being refilled or rebuilt.
+
+    :return: A tuple of the views and paste ID of the lowest paste on the leaderboard if it is full, NO_TOP_PASTES_FLOOR
+             if it is not full, so that every viewed paste ranks above it, or None if it is empty
+    """
+    floor = top_pastes_floor_cache.get(TOP_PASTES_FLOOR_KEY)
+    if floor is None:
+        lowest_top_pastes = models.TopPaste.query.order_by(
+            models.TopPaste.views.desc(),
+            models.TopPaste.paste_id.desc(),
+        ).offset(
+            config.TOP_PASTES_LEADERBOARD_SIZE - 1,
+        ).first()
+        if lowest_top_pastes:
+            floor = (lowest_top_pastes.views, lowest_top_pastes.paste_id)
+        elif models.TopPaste.query.first():
+            floor = NO_TOP_PASTES_FLOOR
+        else:
+            floor = ()
+        top_pastes_floor_cache.set(TOP_PASTES_FLOOR_KEY, floor, ttl=TOP_PASTES_FLOOR_TTL)
+    return floor or None
+
+
+def _update_top_pastes(paste_ids, views=None):
+    """
+    Update the top pastes leaderboard with the current views of the specified pastes, in a separate transaction.
+
+    The leaderboard always holds the top viewed pastes by (views, paste_id): every viewed paste it does not hold ranks
+    below every paste it holds. Since views only ever increase, this is preserved by updating pastes that are already on
+    the leaderboard and by adding pastes that now rank above its lowest paste, or any paste while it is not full, and
+    then removing pastes beyond its size. Removing deactivated and expired pastes preserves it as well, as long as they
+    are replaced by the top pastes below the leaderboard (see _refill_top_pastes). Pastes that rank below the lowest
+    paste of a full leaderboard are neither, so most views don't touch the leaderboard at all. An empty leaderboard is
+    filled from scratch instead. The leaderboard is best-effort; if it can't be updated due to concurrent updates, it may
+    fall behind until it is next rebuilt, but view counts themselves are never affected.
+
+    :param paste_ids: IDs of the pastes whose views changed
+    :param views: Dictionary mapping the IDs of active pastes to their current views, if they were just loaded, so that
+                  they don't have to be queried
+    """
+    if config.TOP_PASTES_LEADERBOARD_SIZE <= 0:
+        return
+
+    try:
+        lowest_rank = _get_top_pastes_floor()
+        if lowest_rank is None:
+            # The leaderboard holds no pastes yet, so it is filled with the top pastes as they are now
+            _refill_top_pastes()
+            return
+
+        if views is None:
+            views = dict(session.query(
+                models.Paste.paste_id,
+                models.Paste.views,
+            ).filter(
+                models.Paste.paste_id.in_(list(paste_ids)),
+                models.Paste.is_active.is_(True),
+                models.Paste.views >= lowest_rank[0],
+            ).all())
+        top_views = {
+            paste_id: paste_views
+            for paste_id, paste_views in views.items()
+            if (paste_views, paste_id) >= lowest_rank
+        }
+        if not top_views:
+            return
+
+        for paste_id, paste_views in top_views.items():
+            session.merge(models.TopPaste(paste_id=paste_id, views=paste_views))
+        session.flush()
+
+        cutoff_top_paste = models.TopPaste.query.order_by(
+            models.TopPaste.views.desc(),
+            models.TopPaste.paste_id.desc(),
+        ).offset(
+            config.TOP_PASTES_LEADERBOARD_SIZE,
+        ).first()
+        if cutoff_top_paste:
+            models.TopPaste.query.filter(or_(
+                models.TopPaste.views < cutoff_top_paste.views,
+                and_(
+                    models.TopPaste.views == cutoff_top_paste.views,
+                    models.TopPaste.paste_id <= cutoff_top_paste.paste_id,
+                ),
+            )).delete(synchronize_session=False)
+        if cutoff_top_paste or lowest_rank == NO_TOP_PASTES_FLOOR:
+            # The lowest rank rose, or the leaderboard may have filled up
+            top_pastes_floor_cache.clear()
+        session.commit()
+    except (IntegrityError, OperationalError):
+        session.rollback()
+
 
-def get_all_pastes_for_user(user_id, active_only=False):
+def prune_top_pastes():
+    """
+    Remove deactivated and expired pastes from the top pastes leaderboard, and replace them with the top pastes below
+    it, in a separate transaction. Deactivated pastes are removed as they are deactivated, but pastes expire without
+    notice, so this happens whenever expired pastes cut a chunk of top pastes short.
+
+    :return: True if any pastes were removed; False otherwise
+    """
+    stale_paste_ids = [
+        paste_id
+        for paste_id, in session.query(
+            models.TopPaste.paste_id,
+        ).join(
+            models.Paste,
+            models.Paste.paste_id == models.TopPaste.paste_id,
+        ).filter(or_(
+            models.Paste.is_active.is_(False),
+            and_(models.Paste.expiry_time.isnot(None), models.Paste.expiry_time <= time.time()),
+        ))
+    ]
+    if not stale_paste_ids:
+        return False
+    try:
+        models.TopPaste.query.filter(
+            models.TopPaste.paste_id.in_(stale_paste_ids),
+        ).delete(synchronize_session=False)
+    except OperationalError:
+        session.rollback()
+        return False
+    _refill_top_pastes()
+    return True
+
+
+def _refill_top_pastes():
+    """
+    Fill the top pastes leaderboard up to its size with the top pastes below its lowest paste, as the last statements of
+    the current transaction, which is committed. This takes a single range scan of at most as many pastes as are added;
+    if the leaderboard is empty, this amounts to rebuilding it.
+    """
+    try:
+        top_paste_count = models.TopPaste.query.count()
+        if top_paste_count < config.TOP_PASTES_LEADERBOARD_SIZE:
+            lowest_top_paste = models.TopPaste.query.order_by(
+                models.TopPaste.views.asc(),
+                models.TopPaste.paste_id.asc(),
+            ).first()
+            query = session.query(
+                models.Paste.paste_id,
+                models.Paste.views,
+            ).filter(
+                *_top_paste_candidate_criteria()
+            )
+            if lowest_top_paste:
+                query = query.filter(or_(
+                    models.Paste.views < lowest_top_paste.views,
+                    and_(models.Paste.views == lowest_top_paste.views, models.Paste.paste_id < lowest_top_paste.paste_id),
+                ))
+            session.add_all([
+                models.TopPaste(paste_id=paste_id, views=views)
+                for paste_id, views in query.order_by(
+                    models.Paste.views.desc(),
+                    models.Paste.paste_id.desc(),
+                ).limit(config.TOP_PASTES_LEADERBOARD_SIZE - top_paste_count)
+            ])
+        session.commit()
+    except (IntegrityError, OperationalError):
+        # Another process is updating the leaderboard concurrently
+        session.rollback()
+    top_pastes_floor_cache.clear()
+
+
+def get_all_pastes_for_user(user_id, active_only=False, include_contents=False):
     """
     Gets all pastes for the specified user ID. Only return pastes that have not expired, and optionally filter by
     whether the paste is active.
 
     :param user_id: User ID for which to retrieve all the pastes
     :param active_only: Set this flag to True to only query for active and non-expired pastes
+    :param include_contents: True to load the contents of each paste; by default, only their size and preview are loaded
     :return: A list of models.Paste objects belonging to the user ID (can be an empty list)
     """
     if active_only:
-        return models.Paste.query.filter_by(
+        return models.Paste.query.options(
+            *_paste_list_options(include_contents)
+        ).filter_by(
             user_id=user_id,
             is_active=True,
         ).filter(
@@ -186,7 +1025,9 @@ def get_all_pastes_for_user(user_id, active_only=False):
             models.Paste.post_time.desc(),
         ).all()
     else:
-        return models.Paste.query.filter_by(
+        return models.Paste.query.options(
+            *_paste_list_options(include_contents)
+        ).filter_by(
             user_id=user_id,
         ).filter(
             or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
@@ -195,36 +1036,277 @@ def get_all_pastes_for_user(user_id, active_only=False):
         ).all()
 
 
-def scrub_inactive_pastes():
+def _paste_list_options(include_contents):
+    """
+    Get the query options for loading a list of pastes. Unless requested, the (potentially large) contents of the pastes
+    are not loaded, and only their size and a short preview are computed by the database instead.
+
+    :param include_contents: True to load the full contents of the pastes
+    :return: A list of query options
+    """
+    if include_contents:
+        return []
+    return _paste_load_options(include_contents) + [
+        undefer(models.Paste.contents_size),
+        undefer(models.Paste.contents_preview),
+    ]
+
+
+def _paste_load_options(include_contents):
+    """
+    Get the query options for loading a single paste. Unlike when listing pastes, the contents are deferred without
+    computing a summary of them instead.
+
+    :param include_contents: True to load the full contents of the paste
+    :return: A list of query options
+    """
+    if include_contents:
+        return []
+    return [
+        defer(models.Paste.plain_contents),
+        defer(models.Paste.compressed_contents),
+        lazyload(models.Paste.content),
+    ]
+
+
+def convert_paste_contents(batch_size=100):
+    """
+    Convert the stored contents of existing pastes to match the current storage configuration. First, the contents of
+    pastes created before contents were deduplicated are moved out of the pastes themselves, to be shared by all pastes
+    with identical contents. Then, if compression is enabled, uncompressed contents that are at least
+    config.PASTE_COMPRESSION_THRESHOLD bytes long are compressed, and otherwise, all compressed contents are
+    decompressed. Contents are converted in batches, each in its own short transaction, so this method can run in the
+    background while the application is serving requests. This method is not intended to be called from within the
+    application, but rather externally either manually or via a script/cron job.
+
+    For example, with the build/convert_paste_contents.py script, or in a Python shell:
+        > import database.paste
+        > database.paste.convert_paste_contents()
+
+    :param batch_size: Number of pastes or contents to convert per transaction
+    :return: The number of pastes and contents that were converted
+    """
+    return _deduplicate_paste_contents(batch_size) + _compress_paste_contents(batch_size)
+
+
+def _deduplicate_paste_contents(batch_size):
+    """
+    Move the contents of pastes that still store their own contents into shared models.PasteContent rows.
+
+    :param batch_size: Number of pastes to convert per transaction
+    :return: The number of pastes that were converted
+    """
+    num_converted = 0
+    while True:
+        batch = models.Paste.query.filter(
+            models.Paste.content_hash.is_(None),
+        ).order_by(models.Paste.paste_id).limit(batch_size).all()
+        if not batch:
+            return num_converted
+
+        try:
+            for paste in batch:
+                paste.content_hash = _reference_paste_content(paste.contents)
+                models.CompressibleContents.contents.fset(paste, None)
+            session.commit()
+        except IntegrityError:
+            # Some of the same contents were concurrently stored by another transaction; retry the batch, which can now
+            # reference them
+            session.rollback()
+            continue
+        num_converted += len(batch)
+
+        for paste in batch:
+            paste_cache.invalidate(paste.paste_id)
+            # Don't accumulate converted pastes, along with their contents, in the session
+            session.expunge(paste)
+
+
+def _compress_paste_contents(batch_size):
     """
-    Goes through the database and deletes all pastes that are either inactive or have expired. This method is not
-    intended to be called from within the application, but rather externally either manually or via a script/cron job.
+    (De)compress the stored contents of pastes, according to the current compression configuration.
+
+    :param batch_size: Number of contents to convert per transaction
+    :return: The number of contents that were converted
+    """
+    num_converted = 0
+    last_content_hash = ''
+    while True:
+        candidate_contents = models.PasteContent.query.filter(models.PasteContent.content_hash > last_content_hash)
+        if config.ENABLE_PASTE_COMPRESSION:
+            candidate_contents = candidate_contents.filter(
+                models.PasteContent.contents_codec.is_(None),
+                func.length(models.PasteContent.plain_contents) >= config.PASTE_COMPRESSION_THRESHOLD,
+            )
+        else:
+            candidate_contents = candidate_contents.filter(models.PasteContent.contents_codec.isnot(None))
+        batch = candidate_contents.order_by(models.PasteContent.content_hash).limit(batch_size).all()
+        if not batch:
+            return num_converted
+
+        for content in batch:
+            codec = content.contents_codec
+            content.contents = content.contents
+            if content.contents_codec != codec:
+                num_converted += 1
+        session.commit()
+
+        converted_hashes = [content.content_hash for content in batch]
+        for (paste_id,) in session.query(models.Paste.paste_id).filter(models.Paste.content_hash.in_(converted_hashes)):
+            paste_cache.invalidate(paste_id)
+        for content in batch:
+            # Don't accumulate converted contents in the session
+            session.expunge(content)
+        last_content_hash = batch[-1].content_hash
+
+
+def scrub_inactive_pastes(batch_size=SCRUB_BATCH_SIZE, after_paste_id=0, max_rate=None, dry_run=False, file_threads=SCRUB_FILE_THREADS, on_batch=None):
+    """
+    Goes through the database and deletes all pastes that are either inactive or have expired, along with their
+    attachments. This method is not intended to be called from within the application, but rather externally either
+    manually or via a script/cron job.
+
+    Pastes are scrubbed in batches, in order of their IDs, each in its own short transaction, so this method can run in
+    the background while the application is serving requests. After each batch, on_batch is called with the progress
+    so far; its last_paste_id can be passed as after_paste_id to resume scrubbing where an interrupted run stopped.
 
     For example, in a Python shell:
         > import database.paste
         > database.paste.scrub_inactive_pastes()
+
+    :param batch_size: Maximum number of pastes to scrub per transaction
+    :param after_paste_id: Only scrub pastes with a greater ID, e.g. the last_paste_id of an interrupted run
+    :param max_rate: Maximum number of pastes to scrub per second, on average, or None for no limit
+    :param dry_run: True to only count the pastes, attachments, and attachment blobs that would be scrubbed, without
+                    deleting anything. Blobs shared by pastes in different batches are not counted.
+    :param file_threads: Number of threads removing the attachment files stored per paste
+    :param on_batch: Function called with a dictionary of the progress so far after each batch (optional)
+    :return: Dictionary of the final progress, with the number of batches, pastes, attachments, and orphaned attachment
+             blobs scrubbed, the ID of the last scrubbed paste, the number of seconds elapsed, and the average number of
+             pastes scrubbed per second
     """
-    inactive_pastes = models.Paste.query.filter(or_(
-        models.Paste.is_active.is_(False),
-        models.Paste.expiry_time < time.time(),
-    ))
-    inactive_paste_ids = [paste.paste_id for paste in inactive_pastes]
-    if not inactive_paste_ids:
-        # No inactive pastes to scrub; quit without taking further action
-        return
-    inactive_attachments = models.Attachment.query.filter(
-        models.Attachment.paste_id.in_(inactive_paste_ids)
-    )
+    # Pastes that expire while scrubbing are left for the next run, so that the run ends
+    scrub_time = time.time()
+    start_time = time.time()
+    progress = {
+        'batches': 0,
+        'pastes': 0,
+        'attachments': 0,
+        'blobs': 0,
+        'last_paste_id': after_paste_id,
+        'elapsed': 0.0,
+        'pastes_per_second': 0.0,
+    }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=file_threads, thread_name_prefix='scrub-file') as executor:
+        while True:
+            inactive_pastes = session.query(models.Paste.paste_id, models.Paste.content_hash).filter(
+                models.Paste.paste_id > progress['last_paste_id'],
+                or_(
+                    models.Paste.is_active.is_(False),
+                    models.Paste.expiry_time < scrub_time,
+                ),
+            ).order_by(models.Paste.paste_id).limit(batch_size).all()
+            if not inactive_pastes:
+                break
 
-    # Attempt to remove the attachment files, if they exist
-    for paste_id in inactive_paste_ids:
-        try:
-            shutil.rmtree('{attachment_dir}/{paste_id}'.format(attachment_dir=config.ATTACHMENTS_DIR, paste_id=paste_id))
-        except OSError as err:
-            if err.errno != errno.ENOENT:
-                raise
-
-    # Then, delete the database entries
-    inactive_pastes.delete(synchronize_session='fetch')
-    inactive_attachments.delete(synchronize_session='fetch')
+            num_attachments, num_orphaned_blobs = _scrub_paste_batch(inactive_pastes, dry_run, executor)
+            progress['batches'] += 1
+            progress['pastes'] += len(inactive_pastes)
+            progress['attachments'] += num_attachments
+            progress['blobs'] += num_orphaned_blobs
+            progress['last_paste_id'] = inactive_pastes[-1].paste_id
+            progress['elapsed'] = time.time() - start_time
+            progress['pastes_per_second'] = progress['pastes'] / progress['elapsed'] if progress['elapsed'] else 0.0
+            if on_batch:
+                on_batch(dict(progress))
+
+            if max_rate:
+                delay = progress['pastes'] / float(max_rate) - (time.time() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+
+    if progress['pastes'] and not dry_run:
+        # Refill the leaderboard with the pastes that now rank in place of the scrubbed pastes
+        rebuild_top_pastes()
+    progress['elapsed'] = time.time() - start_time
+    progress['pastes_per_second'] = progress['pastes'] / progress['elapsed'] if progress['elapsed'] else 0.0
+    return progress
+
+
+def _scrub_paste_batch(inactive_pastes, dry_run, executor):
+    """
+    Scrub a batch of inactive or expired pastes in a single transaction.
+
+    :param inactive_pastes: List of the (paste_id, content_hash) rows of the pastes
+    :param dry_run: True to only count what would be scrubbed, without deleting anything
+    :param executor: concurrent.futures.Executor on which to remove the attachment files stored per paste
+    :return: A tuple of the number of attachments, and the number of attachment blobs no longer referenced at all
+    """
+    inactive_paste_ids = [paste_id for paste_id, _ in inactive_pastes]
+    inactive_attachments = models.Attachment.query.filter(models.Attachment.paste_id.in_(inactive_paste_ids))
+    inactive_blob_hashes = [
+        content_hash
+        for content_hash, in inactive_attachments.with_entities(models.Attachment.content_hash)
+    ]
+    num_attachments = len(inactive_blob_hashes)
+    inactive_blob_hashes = [content_hash for content_hash in inactive_blob_hashes if content_hash is not None]
+
+    if dry_run:
+        ref_deltas = collections.Counter(inactive_blob_hashes)
+        num_orphaned_blobs = len([
+            content_hash
+            for content_hash, ref_count in session.query(models.AttachmentBlob.content_hash, models.AttachmentBlob.ref_count).filter(
+                models.AttachmentBlob.content_hash.in_(list(ref_deltas)),
+            )
+            if ref_count <= ref_deltas[content_hash]
+        ]) if ref_deltas else 0
+        session.rollback()
+        return num_attachments, num_orphaned_blobs
+
+    # Attempt to remove the attachment files stored per paste, if they exist; should the batch then fail, it is scrubbed
+    # again by the next run
+    for _ in executor.map(database.attachment.remove_paste_attachment_dirs, inactive_paste_ids):
+        pass
+
+    # Then, delete the database entries, along with the contents no longer referenced at all
+    models.Paste.query.filter(
+        models.Paste.paste_id.in_(inactive_paste_ids),
+    ).delete(synchronize_session=False)
+    inactive_attachments.delete(synchronize_session=False)
+    _dereference_paste_contents(content_hash for _, content_hash in inactive_pastes if content_hash is not None)
+    orphaned_blob_hashes = database.attachment.dereference_attachment_blobs(inactive_blob_hashes)
     session.commit()
+
+    # Blob files are only removed once they are no longer referenced in the database, since they may be shared, along
+    # with the entries of their blobs
+    database.attachment.remove_attachment_blob_files(orphaned_blob_hashes)
+
+    for paste_id in inactive_paste_ids:
+        paste_cache.invalidate(paste_id)
+    return num_attachments, len(orphaned_blob_hashes)
+
+
+def _dereference_paste_contents(content_hashes):
+    """
+    Remove references to stored paste contents, within the current transaction, deleting the contents that are no
+    longer referenced at all.
+
+    :param content_hashes: Iterable of the content hashes of the removed references, with one entry per reference
+    """
+    ref_deltas = collections.Counter(content_hashes)
+    if not ref_deltas:
+        return
+    models.PasteContent.query.filter(
+        models.PasteContent.content_hash.in_(list(ref_deltas)),
+    ).update(
+        {models.PasteContent.ref_count: models.PasteContent.ref_count - case(
+            ref_deltas,
+            value=models.PasteContent.content_hash,
+            else_=0,
+        )},
+        synchronize_session=False,
+    )
+    models.PasteContent.query.filter(
+        models.PasteContent.content_hash.in_(list(ref_deltas)),
+        models.PasteContent.ref_count <= 0,
+    ).delete(synchronize_session=False)
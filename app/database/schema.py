@@ -0,0 +1,95 @@
+import sqlalchemy
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.schema import CreateTable
+
+from modern_paste import db
+
+
+def get_missing_schema():
+    """
+    Compare the schema of the database against the models, finding all tables, columns, and indexes that are defined by
+    the models but are missing from the database. An index is considered present if the database has an index with the
+    same name, or with the same columns in the same order.
+
+    :return: A dictionary with the keys 'tables', 'columns', and 'indexes', mapping to lists of the missing
+             sqlalchemy.Table, sqlalchemy.Column, and sqlalchemy.Index objects, respectively. Columns and indexes of
+             missing tables are not listed separately.
+    """
+    inspector = sqlalchemy.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = {
+        'tables': [],
+        'columns': [],
+        'indexes': [],
+    }
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            missing['tables'].append(table)
+            continue
+
+        existing_columns = set(column['name'] for column in inspector.get_columns(table.name))
+        missing['columns'] += [column for column in table.columns if column.name not in existing_columns]
+
+        existing_indexes = inspector.get_indexes(table.name)
+        existing_index_names = set(index['name'] for index in existing_indexes)
+        existing_index_columns = set(tuple(index['column_names']) for index in existing_indexes)
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            index_columns = tuple(column.name for column in index.columns)
+            if index.name not in existing_index_names and index_columns not in existing_index_columns:
+                missing['indexes'].append(index)
+
+    return missing
+
+
+def get_migration_statements(missing=None):
+    """
+    Generate the DDL statements that add all missing tables, columns, and indexes to the database. Nothing is ever
+    dropped or altered, so the statements are safe to run against a database with existing data. On MySQL, columns and
+    indexes are added with online DDL, so that the table remains readable and writable while they are being built.
+
+    :param missing: A dictionary of the missing schema, as returned by get_missing_schema; queried if not specified
+    :return: A list of DDL statement strings, in the order in which they should be executed
+    """
+    if missing is None:
+        missing = get_missing_schema()
+    dialect = db.engine.dialect
+    online_ddl = dialect.name == 'mysql'
+    statements = []
+
+    for table in missing['tables']:
+        statements.append(str(CreateTable(table).compile(dialect=dialect)).strip())
+        statements += [
+            str(CreateIndex(index).compile(dialect=dialect)).strip()
+            for index in sorted(table.indexes, key=lambda index: index.name)
+        ]
+
+    for column in missing['columns']:
+        statements.append('ALTER TABLE {table} ADD COLUMN {column_spec}{options}'.format(
+            table=dialect.identifier_preparer.format_table(column.table),
+            column_spec=dialect.ddl_compiler(dialect, None).get_column_specification(column),
+            options=', ALGORITHM=INPLACE, LOCK=NONE' if online_ddl else '',
+        ))
+
+    for index in missing['indexes']:
+        statements.append('{create_index}{options}'.format(
+            create_index=str(CreateIndex(index).compile(dialect=dialect)).strip(),
+            options=' ALGORITHM=INPLACE LOCK=NONE' if online_ddl else '',
+        ))
+
+    return statements
+
+
+def migrate_schema(statements=None):
+    """
+    Add all missing tables, columns, and indexes to the database.
+
+    :param statements: A list of DDL statements, as returned by get_migration_statements; generated if not specified
+    :return: The list of DDL statements that were executed
+    """
+    if statements is None:
+        statements = get_migration_statements()
+    for statement in statements:
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text(statement))
+    return statements
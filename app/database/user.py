@@ -19,6 +19,7 @@ def create_new_user(username, password, signup_ip, name=None, email=None):
     :return: Newly created User object
     :raises InvalidEmailException: If an invalid email is passed
     :raises UsernameNotAvailableException: If the username is not available
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
     """
     # Input validation
     if not is_username_available(username):
@@ -29,7 +30,7 @@ def create_new_user(username, password, signup_ip, name=None, email=None):
     new_user = models.User(
         signup_ip=signup_ip,
         username=username,
-        password_hash=util.cryptography.secure_hash(password),
+        password_hash=util.cryptography.hash_password(password),
         name=name,
         email=email,
     )
@@ -49,6 +50,7 @@ def update_user_details(user_id, name, email, new_password):
     :param new_password: New password, if updating the user's password
     :return: models.User object representing the updated user
     :raises InvalidEmailException: If an invalid email is passed
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
     """
     if email and not is_email_address_valid(email):
         raise InvalidEmailException('{email_addr} is not a valid email address'.format(email_addr=email))
@@ -57,7 +59,7 @@ def update_user_details(user_id, name, email, new_password):
     user.name = name
     user.email = email
     if new_password:
-        user.password_hash = util.cryptography.secure_hash(new_password)
+        user.password_hash = util.cryptography.hash_password(new_password)
     session.commit()
     return user
 
@@ -133,15 +135,26 @@ def generate_new_api_key(user_id):
 def authenticate_user(username, password):
     """
     Authenticate a user with a username and password. This function only checks if the
-    credentials are correct.
+    credentials are correct. If they are, but the user's password hash was generated by another hasher or with other
+    parameters than those currently configured, e.g. by an earlier version, the password is hashed again.
 
     :param username: Username to check
     :param password: Plain text password to authenticate against
     :return: True if the credential pair is valid; False otherwise
     :raises UserDoesNotExistException: If no user exists with the given username
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
     """
     user = get_user_by_username(username)
-    return user.is_active and util.cryptography.secure_hash(password) == user.password_hash
+    if not user.is_active or not util.cryptography.verify_password(password, user.password_hash):
+        return False
+    if util.cryptography.password_needs_rehash(user.password_hash):
+        try:
+            user.password_hash = util.cryptography.hash_password(password)
+            session.commit()
+        except PasswordHashingOverloadedException:
+            # The hash is replaced on a later login instead
+            pass
+    return True
 
 
 def deactivate_user(user_id):
@@ -1,3 +1,6 @@
 from models.attachment import *
+from models.attachment_blob import *
 from models.paste import *
+from models.paste_content import *
+from models.top_paste import *
 from models.user import *
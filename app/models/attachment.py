@@ -4,13 +4,21 @@ from modern_paste import db
 
 class Attachment(db.Model):
     __tablename__ = 'attachment'
+    __table_args__ = (
+        # Support looking up a paste's attachment by name; MySQL can only index a prefix of a TEXT column
+        db.Index('ix_attachment_paste_id_file_name', 'paste_id', 'file_name', mysql_length={'file_name': 255}),
+    )
 
     attachment_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     paste_id = db.Column(db.Integer, index=True)
     file_name = db.Column(db.Text)
-    hash_name = db.Column(db.Text)
+    # Attachments uploaded before attachments were stored by content are stored per paste, under their hashed name
+    hash_name = db.Column(db.Text, default=None)
+    content_hash = db.Column(db.String(64), default=None, index=True)
     file_size = db.Column(db.Integer)
     mime_type = db.Column(db.Text)
+    # Content coding of the stored blob, e.g. 'gzip' for text-like attachments stored compressed, or None if it is raw
+    content_encoding = db.Column(db.String(16), default=None)
 
     def __init__(
         self,
@@ -18,12 +26,15 @@ class Attachment(db.Model):
         file_name,
         file_size,
         mime_type,
+        content_hash,
+        content_encoding=None,
     ):
         self.paste_id = paste_id
         self.file_name = file_name
-        self.hash_name = util.cryptography.secure_hash(file_name)
         self.file_size = file_size
         self.mime_type = mime_type
+        self.content_hash = content_hash
+        self.content_encoding = content_encoding
 
     def as_dict(self):
         """
@@ -0,0 +1,16 @@
+from modern_paste import db
+
+
+class AttachmentBlob(db.Model):
+    __tablename__ = 'attachment_blob'
+
+    content_hash = db.Column(db.String(64), primary_key=True)
+    ref_count = db.Column(db.Integer)
+
+    def __init__(
+        self,
+        content_hash,
+        ref_count=1,
+    ):
+        self.content_hash = content_hash
+        self.ref_count = ref_count
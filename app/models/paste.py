@@ -2,27 +2,45 @@ import time
 
 import util.cryptography
 import util.testing
+from models.paste_content import *
 from modern_paste import db
 from uri.paste import *
 
 
-class Paste(db.Model):
+class Paste(CompressibleContents, db.Model):
     __tablename__ = 'paste'
-    __table_args__ = {'mysql_collate': 'utf8mb4_general_ci'}
+    __table_args__ = (
+        # Support paginating (with offsets or cursors) through active pastes, sorted by post time or views
+        db.Index('ix_paste_is_active_post_time_paste_id', 'is_active', 'post_time', 'paste_id'),
+        db.Index('ix_paste_is_active_views_paste_id', 'is_active', 'views', 'paste_id'),
+        # Support listing a user's pastes, sorted by post time
+        db.Index('ix_paste_user_id_post_time', 'user_id', 'post_time'),
+        # Support finding expired pastes to scrub
+        db.Index('ix_paste_expiry_time', 'expiry_time'),
+        {'mysql_collate': 'utf8mb4_general_ci'},
+    )
 
     paste_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     is_active = db.Column(db.Boolean)
-    user_id = db.Column(db.Integer, default=None, index=True)
+    user_id = db.Column(db.Integer, default=None)
     post_time = db.Column(db.Integer)
     expiry_time = db.Column(db.Integer, default=None)
     title = db.Column(db.Text, default=None)
     language = db.Column(db.Text)
     password_hash = db.Column(db.Text, default=None)
-    contents = db.Column(db.Text)
+    # The contents of a paste are stored once per distinct contents as a models.PasteContent, identified by its hash.
+    # Pastes created before contents were deduplicated store their contents in the columns of CompressibleContents instead.
+    content_hash = db.Column(db.String(64), default=None, index=True)
     deactivation_token = db.Column(db.Text)
     views = db.Column(db.Integer)
     is_api_post = db.Column(db.Boolean)
 
+    content = db.relationship(
+        PasteContent,
+        primaryjoin='foreign(Paste.content_hash) == PasteContent.content_hash',
+        lazy='joined',
+    )
+
     def __init__(
         self,
         user_id,
@@ -40,27 +58,78 @@ class Paste(db.Model):
         self.title = title
         self.language = language
         self.password_hash = password_hash
-        self.contents = contents
+        self.content_hash = PasteContent.hash_contents(contents)
         self.deactivation_token = util.testing.random_alphanumeric_string()
         self.views = 0
         self.is_api_post = is_api_post
 
-    def as_dict(self):
+    @property
+    def contents(self):
+        """
+        The contents of this paste.
+        """
+        if self.content_hash is None:
+            return CompressibleContents.contents.fget(self)
+        return self.content.contents
+
+    def as_dict(self, include_contents=True, id_repr=None):
         """
         Represent this paste as an easily JSON-serializable dictionary. This method is intended to present the paste
         for consumption at the highest level of the stack, so it should exclude all sensitive information.
 
+        :param include_contents: True to include the full contents of the paste; False to summarize the paste with only
+                                 the size of its contents and a short preview of them. Password-protected pastes are
+                                 summarized without a preview.
+        :param id_repr: Representation of the paste's ID, if it is already known, e.g. from
+                        util.cryptography.get_id_reprs for a list of pastes
         :return: Dictionary of paste properties
         """
-        return {
-            'paste_id_repr': util.cryptography.get_id_repr(self.paste_id),
+        if id_repr is None:
+            id_repr = util.cryptography.get_id_repr(self.paste_id)
+        paste_dict = {
+            'paste_id_repr': id_repr,
             'is_active': self.is_active,
             'post_time': self.post_time,
             'expiry_time': self.expiry_time,
-            'contents': self.contents,
             'title': self.title,
             'language': self.language,
             'views': self.views,
             'is_password_protected': self.password_hash is not None,
-            'url': PasteViewInterfaceURI.full_uri(paste_id=util.cryptography.get_id_repr(self.paste_id)),
+            'url': PasteViewInterfaceURI.full_uri(paste_id=id_repr),
         }
+        if include_contents:
+            paste_dict['contents'] = self.contents
+        else:
+            paste_dict['contents_size'] = self.contents_size
+            paste_dict['contents_preview'] = self.contents_preview if self.password_hash is None else None
+        return paste_dict
+
+
+# Computed by the database, and only loaded when explicitly requested, so that listing pastes need not load contents
+Paste.contents_size = db.column_property(
+    db.func.coalesce(
+        db.select(
+            db.func.coalesce(db.func.length(PasteContent.plain_contents), PasteContent.uncompressed_size),
+        ).where(
+            PasteContent.content_hash == Paste.content_hash,
+        ).scalar_subquery(),
+        db.func.length(Paste.plain_contents),
+        Paste.uncompressed_size,
+    ),
+    deferred=True,
+)
+Paste.contents_preview = db.column_property(
+    db.func.coalesce(
+        db.select(
+            db.func.coalesce(
+                db.func.substr(PasteContent.plain_contents, 1, CONTENTS_PREVIEW_LENGTH),
+                PasteContent.uncompressed_preview,
+            ),
+        ).where(
+            PasteContent.content_hash == Paste.content_hash,
+        ).scalar_subquery(),
+        db.func.substr(Paste.plain_contents, 1, CONTENTS_PREVIEW_LENGTH),
+        Paste.uncompressed_preview,
+    ),
+    deferred=True,
+)
@@ -0,0 +1,91 @@
+import hashlib
+
+import config
+import util.compression
+from modern_paste import db
+
+
+# Number of characters of the contents included in the summary of a paste
+CONTENTS_PREVIEW_LENGTH = 100
+
+
+class CompressibleContents:
+    """
+    Mixin for models that store paste contents either as is, or compressed with the named codec along with the size and
+    a preview of the uncompressed contents.
+    """
+
+    plain_contents = db.Column('contents', db.Text, default=None)
+    compressed_contents = db.Column(db.LargeBinary, default=None)
+    contents_codec = db.Column(db.String(16), default=None)
+    uncompressed_size = db.Column(db.Integer, default=None)
+    uncompressed_preview = db.Column(db.Text, default=None)
+
+    @property
+    def contents(self):
+        """
+        The stored contents. Compressed contents are only decompressed when they are first read.
+        """
+        if self.contents_codec is None:
+            return self.plain_contents
+        decompressed = getattr(self, '_decompressed_contents', None)
+        if decompressed is None or decompressed[0] is not self.compressed_contents:
+            decompressed = (
+                self.compressed_contents,
+                util.compression.decompress(self.compressed_contents, self.contents_codec),
+            )
+            self._decompressed_contents = decompressed
+        return decompressed[1]
+
+    @contents.setter
+    def contents(self, contents):
+        """
+        Store contents, compressing them if compression is enabled, they are at least
+        config.PASTE_COMPRESSION_THRESHOLD bytes long, and compressing them makes them smaller.
+        """
+        self.plain_contents = contents
+        self.compressed_contents = None
+        self.contents_codec = None
+        self.uncompressed_size = None
+        self.uncompressed_preview = None
+        if not config.ENABLE_PASTE_COMPRESSION or contents is None:
+            return
+
+        size = len(contents.encode('utf-8'))
+        if size < config.PASTE_COMPRESSION_THRESHOLD:
+            return
+        compressed_contents = util.compression.compress(contents, config.PASTE_COMPRESSION_CODEC)
+        if len(compressed_contents) >= size:
+            return
+
+        self.plain_contents = None
+        self.compressed_contents = compressed_contents
+        self.contents_codec = config.PASTE_COMPRESSION_CODEC
+        self.uncompressed_size = size
+        self.uncompressed_preview = contents[:CONTENTS_PREVIEW_LENGTH]
+
+
+class PasteContent(CompressibleContents, db.Model):
+    __tablename__ = 'paste_content'
+    __table_args__ = {'mysql_collate': 'utf8mb4_general_ci'}
+
+    content_hash = db.Column(db.String(64), primary_key=True)
+    ref_count = db.Column(db.Integer)
+
+    def __init__(
+        self,
+        contents,
+    ):
+        self.content_hash = self.hash_contents(contents)
+        self.ref_count = 1
+        self.contents = contents
+
+    @staticmethod
+    def hash_contents(contents):
+        """
+        Hash paste contents, to identify identical contents.
+
+        :param contents: Paste contents
+        :return: The hexadecimal BLAKE2b digest of the contents
+        """
+        return hashlib.blake2b(contents.encode('utf-8'), digest_size=32).hexdigest()
@@ -0,0 +1,19 @@
+from modern_paste import db
+
+
+class TopPaste(db.Model):
+    __tablename__ = 'top_paste'
+    __table_args__ = (
+        db.Index('ix_top_paste_views_paste_id', 'views', 'paste_id'),
+    )
+
+    paste_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    views = db.Column(db.Integer)
+
+    def __init__(
+        self,
+        paste_id,
+        views,
+    ):
+        self.paste_id = paste_id
+        self.views = views
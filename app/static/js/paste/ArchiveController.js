@@ -25,6 +25,8 @@ modernPaste.paste.ArchiveController = function() {
 
     this.currentPage = 0;
     this.numPerPage = 20;
+    // Cursors returned by the server for retrieving each page after the first, indexed by page number
+    this.pageCursors = [null];
 
     modernPaste.paste.ArchiveController.loadPastes.bind(this)();
 
@@ -41,6 +43,7 @@ modernPaste.paste.ArchiveController = function() {
  */
 modernPaste.paste.ArchiveController.changeMode = function(mode) {
     this.currentPage = 0;
+    this.pageCursors = [null];
     this.currentArchiveMode = mode;
     modernPaste.paste.ArchiveController.loadPastes.bind(this)();
 };
@@ -48,6 +51,7 @@ modernPaste.paste.ArchiveController.changeMode = function(mode) {
 /**
  * Load pastes for the current page number and the predefined number of results per page.
  * These constants are global variables that are modified outside this function.
+ * If the cursor for the current page is known, it is used in favor of the page number.
  */
 modernPaste.paste.ArchiveController.loadPastes = function() {
     var url = modernPaste.universal.URIController.uris.RecentPastesURI;
@@ -61,6 +65,7 @@ modernPaste.paste.ArchiveController.loadPastes = function() {
         'contentType': 'application/json',
         'data': JSON.stringify({
             'page_num': this.currentPage,
+            'cursor': this.pageCursors[this.currentPage] || null,
             'num_per_page': this.numPerPage
         })
     })
@@ -80,6 +85,7 @@ modernPaste.paste.ArchiveController.loadPastesIntoList = function(data) {
         modernPaste.universal.AlertController.displayErrorAlert('There are no more pastes to display.');
         return;
     }
+    this.pageCursors[this.currentPage + 1] = data.next_cursor;
 
     // Hide or show the previous button accordingly
     this.currentPage <= 0 ? this.previousButton.fadeOut('fast') : this.previousButton.fadeIn('fast');
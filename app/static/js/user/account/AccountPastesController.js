@@ -29,7 +29,12 @@ modernPaste.user.account.AccountPastesController = function() {
 modernPaste.user.account.AccountPastesController.loadUserPastes = function() {
     $.ajax({
         'method': 'POST',
-        'url': modernPaste.universal.URIController.uris.PastesForUserURI
+        'url': modernPaste.universal.URIController.uris.PastesForUserURI,
+        'contentType': 'application/json',
+        'data': JSON.stringify({
+            // Full contents are needed to download pastes directly from the list
+            'include_contents': true
+        })
     })
     .done(modernPaste.user.account.AccountPastesController.loadPastesIntoList.bind(this))
     .fail(modernPaste.user.account.AccountPastesController.showPasteLoadError.bind(this));
@@ -30,6 +30,11 @@ class PasteSubmitURI(URI):
     path = '/api/paste/submit'
 
 
+class PasteAttachmentUploadURI(URI):
+    api_endpoint = True
+    path = '/api/paste/attachment/upload'
+
+
 class PasteDeactivateURI(URI):
     api_endpoint = True
     path = '/api/paste/deactivate'
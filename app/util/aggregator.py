@@ -0,0 +1,131 @@
+import atexit
+import os
+import threading
+import time
+
+
+class DeltaAggregator:
+    """
+    Thread-safe, in-memory accumulator of integer deltas keyed by ID, for write-behind updates of counters.
+
+    Pending deltas are handed to a flush function in a single batch as soon as deltas for flush_threshold distinct keys
+    are pending, and at least every flush_interval seconds by a background thread. If the process dies, at most the
+    pending deltas are lost; they are also flushed when the interpreter exits normally.
+    """
+
+    def __init__(self, flush, flush_interval, flush_threshold):
+        """
+        :param flush: Function accepting a dictionary mapping keys to their accumulated deltas
+        :param flush_interval: Maximum number of seconds a delta may remain pending
+        :param flush_threshold: Maximum number of distinct keys that may have pending deltas
+        """
+        self.flush_function = flush
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.flush_count = 0
+        self.last_flush_time = time.time()
+        self._deltas = {}
+        self._lock = threading.Lock()
+        self._flush_thread_pid = None
+        atexit.register(self._flush_at_exit)
+
+    def add(self, key, delta=1):
+        """
+        Accumulate a delta for a key, flushing all pending deltas if either flush condition is met. Errors during the
+        flush are not raised here; the deltas remain pending and are retried on the next flush.
+
+        :param key: Key for which to accumulate the delta
+        :param delta: Amount to add to the key's pending delta
+        """
+        with self._lock:
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+            should_flush = len(self._deltas) >= self.flush_threshold or \
+                time.time() - self.last_flush_time >= self.flush_interval
+
+        self._ensure_flush_thread()
+        if should_flush:
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def pending(self, key):
+        """
+        Get the delta accumulated for a key that has not yet been flushed.
+
+        :param key: Key to look up
+        :return: The pending delta for the key, or 0 if there is none
+        """
+        with self._lock:
+            return self._deltas.get(key, 0)
+
+    def flush(self):
+        """
+        Hand all pending deltas to the flush function. If the flush function raises an exception, the deltas are
+        returned to the pending set before the exception is propagated.
+        """
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+            self.last_flush_time = time.time()
+        if not deltas:
+            return
+
+        try:
+            self.flush_function(deltas)
+            self.flush_count += 1
+        except Exception:
+            with self._lock:
+                for key, delta in deltas.items():
+                    self._deltas[key] = self._deltas.get(key, 0) + delta
+            raise
+
+    def clear(self):
+        """
+        Discard all pending deltas without flushing them.
+        """
+        with self._lock:
+            self._deltas = {}
+
+    def stats(self):
+        """
+        Report the aggregator's state for monitoring purposes.
+
+        :return: Dictionary of aggregator statistics
+        """
+        with self._lock:
+            return {
+                'pending_keys': len(self._deltas),
+                'pending_total': sum(self._deltas.values()),
+                'flush_count': self.flush_count,
+                'last_flush_time': self.last_flush_time,
+            }
+
+    def _ensure_flush_thread(self):
+        """
+        Start the background flush thread if it is not running in the current process. The thread is started lazily,
+        and per process, so that it also exists in workers forked from a parent process that already imported this
+        module.
+        """
+        if self._flush_thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flush_thread_pid == os.getpid():
+                return
+            self._flush_thread_pid = os.getpid()
+        flush_thread = threading.Thread(target=self._flush_periodically)
+        flush_thread.daemon = True
+        flush_thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(max(self.flush_interval, 1))
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            pass
@@ -0,0 +1,200 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded in-process cache. Entries are evicted in least-recently-used order once the cache is
+    full, and each entry may optionally carry its own time-to-live.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: Maximum number of entries to hold
+        """
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Retrieve a value from the cache.
+
+        :param key: Key to look up
+        :return: The cached value, or None if the key is not cached or its entry has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace an entry in the cache, evicting the least recently used entry if the cache is full.
+
+        :param key: Key under which to store the value
+        :param value: Value to store
+        :param ttl: Number of seconds after which the entry expires (optional, defaults to no expiry)
+        """
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Remove an entry from the cache, if it exists.
+
+        :param key: Key to remove
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    """
+    Cache backend shared between all application processes, backed by Redis. Values must be JSON-serializable.
+    This backend requires the redis Python package, which is only imported when the backend is first constructed.
+    """
+
+    def __init__(self, url, prefix='modern-paste'):
+        """
+        :param url: Redis connection URL, e.g. redis://localhost:6379/0
+        :param prefix: Namespace prepended to all keys stored by this backend
+        """
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, key):
+        return '{prefix}:{key}'.format(prefix=self.prefix, key=key)
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), json.dumps(value), ex=max(int(ttl), 1) if ttl is not None else None)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+class ReadThroughCache:
+    """
+    Two-tier read-through cache: a local LRUCache in front of an optional shared backend (such as RedisCacheBackend),
+    in front of the data source itself. Values found in the shared backend are copied into the local cache, and values
+    loaded from the data source are written to both tiers. Hit and miss counters are kept for monitoring purposes.
+    """
+
+    def __init__(self, local, shared=None):
+        """
+        :param local: An LRUCache instance for process-local caching
+        :param shared: A shared cache backend implementing get, set, and delete (optional)
+        """
+        self.local = local
+        self.shared = shared
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, key, loader, ttl=None):
+        """
+        Retrieve a value by key, falling back to the loader on a cache miss.
+
+        :param key: Key to look up
+        :param loader: Function of no arguments returning the value to cache, or None if the value should not be cached
+        :param ttl: Function mapping a loaded value to the number of seconds it may be cached for (optional, defaults to
+                    no expiry). A TTL that is not positive prevents the value from being cached at all.
+        :return: The cached or loaded value, or None if the loader returned None
+        """
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.shared_hits += 1
+                entry_ttl = ttl(value) if ttl else None
+                if entry_ttl is None or entry_ttl > 0:
+                    self.local.set(key, value, entry_ttl)
+                return value
+
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.set(key, value, ttl(value) if ttl else None)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Write a value to all cache tiers.
+
+        :param key: Key under which to store the value
+        :param value: Value to store
+        :param ttl: Number of seconds after which the entry expires (optional, defaults to no expiry)
+        """
+        if ttl is not None and ttl <= 0:
+            return
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def invalidate(self, key):
+        """
+        Remove a key from all cache tiers.
+
+        :param key: Key to remove
+        """
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        """
+        Remove all entries from the local cache, and reset the hit and miss counters. Entries in the shared backend
+        are left untouched, since they may be in use by other processes.
+        """
+        self.local.clear()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Report the cache's hit and miss counters.
+
+        :return: Dictionary of cache statistics
+        """
+        hits = self.local_hits + self.shared_hits
+        return {
+            'hits': hits,
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_ratio': float(hits) / (hits + self.misses) if hits + self.misses else 0.0,
+            'size': len(self.local),
+        }
@@ -0,0 +1,117 @@
+import bz2
+import lzma
+import zlib
+
+from util.exception import *
+
+
+# Supported compression codecs, by name, as pairs of compress and decompress functions operating on bytes
+# The name of the codec is stored alongside any compressed data, so a codec must never be removed or renamed.
+CODECS = {
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+    'zlib': (zlib.compress, zlib.decompress),
+}
+
+# MIME types of text-like data, which compresses well, besides text/* and types with a +json or +xml suffix
+TEXT_MIME_TYPES = {
+    'application/csv',
+    'application/ecmascript',
+    'application/javascript',
+    'application/json',
+    'application/ld+json',
+    'application/sql',
+    'application/toml',
+    'application/x-httpd-php',
+    'application/x-javascript',
+    'application/x-ndjson',
+    'application/x-sh',
+    'application/x-yaml',
+    'application/xml',
+    'application/yaml',
+    'image/svg+xml',
+}
+
+# Number of bytes of a gzip-compressed file read at a time
+GZIP_CHUNK_SIZE = 64 * 1024
+
+
+def compress(text, codec):
+    """
+    Compress a string.
+
+    :param text: String to compress
+    :param codec: Name of the codec with which to compress the string
+    :return: The compressed UTF-8 representation of the string, as bytes
+    :raises InvalidCodecException: If the codec is not supported
+    """
+    return _get_codec(codec)[0](text.encode('utf-8'))
+
+
+def decompress(data, codec):
+    """
+    Decompress a string compressed with compress.
+
+    :param data: Compressed bytes
+    :param codec: Name of the codec with which the string was compressed
+    :return: The original string
+    :raises InvalidCodecException: If the codec is not supported
+    """
+    return _get_codec(codec)[1](data).decode('utf-8')
+
+
+def _get_codec(codec):
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise InvalidCodecException('Unsupported compression codec {codec}'.format(codec=codec))
+
+
+def is_text_mime_type(mime_type):
+    """
+    Check whether a MIME type describes text-like data, which compresses well.
+
+    :param mime_type: MIME type, optionally with parameters, e.g. 'text/plain; charset=utf-8'
+    :return: True if the MIME type is text-like
+    """
+    if not mime_type:
+        return False
+    mime_type = mime_type.split(';', 1)[0].strip().lower()
+    return mime_type.startswith('text/') or mime_type.endswith(('+json', '+xml')) or mime_type in TEXT_MIME_TYPES
+
+
+def gzip_compressor():
+    """
+    Create a compressor producing gzip data incrementally. The output is deterministic: it does not depend on the time
+    at which it was produced.
+
+    :return: A zlib compression object, whose compress and flush methods return the gzip data
+    """
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def iter_gunzip_file(open_file, chunk_size=GZIP_CHUNK_SIZE):
+    """
+    Decompress a gzip-compressed file in chunks, so that it is never held in memory as a whole. The file is only opened
+    once the first chunk is requested, and is closed once it is read, or the generator is closed. Each chunk read is
+    decompressed at most chunk_size bytes at a time, so that highly compressible data doesn't expand in memory.
+
+    :param open_file: Function opening the file as a binary file object
+    :param chunk_size: Maximum number of compressed bytes to read, and of decompressed bytes to generate, at a time
+    :return: A generator of non-empty byte strings of the decompressed data
+    :raises zlib.error: If the file is not validly gzip-compressed
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open_file() as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            while chunk:
+                data = decompressor.decompress(chunk, chunk_size)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
@@ -1,8 +1,14 @@
 import base64
+import functools
+import hashlib
+import hmac
+import os
+import time
 from Crypto.Cipher import AES
-from Crypto.Hash import SHA256
 
 import config
+import util.cache
+import util.hashing
 from util.exception import InvalidIDException
 
 
@@ -13,6 +19,24 @@ BLOCK_SIZE = 16
 PADDING_CHAR = '*'
 ALTCHARS = b'~-'
 
+# Maximum number of pairs of encrypted and decrypted IDs memoized by each ID codec
+ID_CODEC_CACHE_SIZE = 4096
+
+# Encrypted IDs of the 'permutation' scheme are IDs of up to 64 bits, permuted by a Feistel network whose round function
+# is keyed BLAKE2s, and written in base62 with a fixed number of digits
+PERMUTATION_ID_BITS = 64
+PERMUTATION_ROUNDS = 4
+BASE62_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+BASE62_ID_LENGTH = 11
+
+# Password hashes include a random salt of PASSWORD_SALT_SIZE bytes, and a derived key of PASSWORD_KEY_SIZE bytes
+PASSWORD_SALT_SIZE = 16
+PASSWORD_KEY_SIZE = 32
+SCRYPT_MAXMEM_MARGIN = 1024 * 1024
+
+# Signed tokens are signed with a key derived from the Flask secret key for this purpose only
+SIGNED_TOKEN_KEY_LABEL = b'modern-paste signed token'
+
 
 def _pad(s):
     return s + (BLOCK_SIZE - len(s) % BLOCK_SIZE) * PADDING_CHAR
@@ -26,6 +50,301 @@ def _base64_decode(data):
     return base64.b64decode(data.encode(), ALTCHARS)
 
 
+def _xor(data, other_data):
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(other_data, 'big')).to_bytes(len(data), 'big')
+
+
+class IDCodec(object):
+    """
+    Base class of the codecs generating encrypted IDs from decrypted IDs, and back, as get_encid and get_decid do. The
+    most recently used pairs of encrypted and decrypted IDs are memoized. Subclasses implement _encrypt and _decrypt,
+    which are passed lists of IDs, so that lists of IDs can be handled together. Instances are thread-safe.
+    """
+
+    def __init__(self, cache_size=ID_CODEC_CACHE_SIZE):
+        """
+        :param cache_size: Maximum number of pairs of encrypted and decrypted IDs to memoize
+        """
+        # Keyed by ('encid', encid) and ('decid', decid), so that each pair is found from either side
+        self._cache = util.cache.LRUCache(2 * cache_size)
+
+    def encode(self, decid):
+        """
+        Generate an encrypted ID from a decrypted ID.
+
+        :param decid: Decrypted ID, type int
+        :return: Encrypted ID, type str
+        :raises InvalidIDException: If the decrypted ID is not int-castable
+        """
+        decid = str(decid)
+        encid = self._cache.get(('decid', decid))
+        if encid is None:
+            encid = self._encrypt([decid])[0]
+            self._remember(decid, encid)
+        return encid
+
+    def decode(self, encid):
+        """
+        Generate a decrypted ID from an encrypted ID.
+
+        :param encid: Encrypted ID, type str
+        :return: Decrypted ID, type int
+        :raises InvalidIDException: If the encrypted ID is not valid
+        """
+        encid = str(encid)
+        decid = self._cache.get(('encid', encid))
+        if decid is None:
+            decid = self._decrypt([encid])[0]
+            self._remember(str(decid), encid)
+        return decid
+
+    def encode_many(self, decids):
+        """
+        Generate the encrypted IDs of several decrypted IDs.
+
+        :param decids: Iterable of decrypted IDs, type int
+        :return: List of the encrypted IDs, type str, in the same order
+        :raises InvalidIDException: If any decrypted ID is not int-castable
+        """
+        decids = [str(decid) for decid in decids]
+        encids = [self._cache.get(('decid', decid)) for decid in decids]
+        missing_decids = list(dict.fromkeys(decid for decid, encid in zip(decids, encids) if encid is None))
+        if not missing_decids:
+            return encids
+        new_encids = dict(zip(missing_decids, self._encrypt(missing_decids)))
+        for decid, encid in new_encids.items():
+            self._remember(decid, encid)
+        return [encid if encid is not None else new_encids[decid] for decid, encid in zip(decids, encids)]
+
+    def decode_many(self, encids):
+        """
+        Generate the decrypted IDs of several encrypted IDs.
+
+        :param encids: Iterable of encrypted IDs, type str
+        :return: List of the decrypted IDs, type int, in the same order
+        :raises InvalidIDException: If any encrypted ID is not valid
+        """
+        encids = [str(encid) for encid in encids]
+        decids = [self._cache.get(('encid', encid)) for encid in encids]
+        missing_encids = list(dict.fromkeys(encid for encid, decid in zip(encids, decids) if decid is None))
+        if not missing_encids:
+            return decids
+        new_decids = dict(zip(missing_encids, self._decrypt(missing_encids)))
+        for encid, decid in new_decids.items():
+            self._remember(str(decid), encid)
+        return [decid if decid is not None else new_decids[encid] for encid, decid in zip(encids, decids)]
+
+    def _encrypt(self, decids):
+        """
+        Encrypt decrypted IDs, without memoization.
+
+        :param decids: Non-empty list of decrypted IDs, type str
+        :return: List of the encrypted IDs, type str, in the same order
+        :raises InvalidIDException: If any decrypted ID is not int-castable, or can't be encrypted by this codec
+        """
+        raise NotImplementedError
+
+    def _decrypt(self, encids):
+        """
+        Decrypt encrypted IDs, without memoization.
+
+        :param encids: Non-empty list of encrypted IDs, type str
+        :return: List of the decrypted IDs, type int, in the same order
+        :raises InvalidIDException: If any encrypted ID is not valid
+        """
+        raise NotImplementedError
+
+    def _remember(self, decid, encid):
+        self._cache.set(('decid', decid), encid)
+        self._cache.set(('encid', encid), int(decid))
+
+
+class AESIDCodec(IDCodec):
+    """
+    Encrypts IDs with AES-CBC under a fixed key and IV, padded with PADDING_CHAR, into URL-safe base64 without padding.
+    The cipher is set up only once, rather than for every ID. Lists of IDs are encrypted and decrypted together, with a
+    single cipher operation per block of the longest ID.
+    """
+
+    def __init__(self, key, iv, cache_size=ID_CODEC_CACHE_SIZE):
+        """
+        :param key: AES key, type bytes
+        :param iv: AES IV for CBC block cipher operation, type bytes
+        :param cache_size: Maximum number of pairs of encrypted and decrypted IDs to memoize
+        """
+        super(AESIDCodec, self).__init__(cache_size)
+        # A CBC cipher object is stateful, so it can't be reused; CBC is applied over the stateless ECB mode instead
+        self._cipher = AES.new(key, AES.MODE_ECB)
+        self._iv = iv
+
+    def _encrypt(self, decids):
+        for decid in decids:
+            try:
+                int(decid)
+            except ValueError:
+                raise InvalidIDException('Decrypted ID must be int-castable')
+
+        plaintexts = [_pad(decid).encode() for decid in decids]
+        if all(len(plaintext) == BLOCK_SIZE for plaintext in plaintexts):
+            # Most IDs fit in a single block, so all of them are encrypted at once
+            blocks = self._cipher.encrypt(_xor(b''.join(plaintexts), self._iv * len(plaintexts)))
+            ciphertexts = [blocks[offset:offset + BLOCK_SIZE] for offset in range(0, len(blocks), BLOCK_SIZE)]
+        else:
+            # Each block is chained to the previous block of the same ID, so the IDs are encrypted a block at a time
+            ciphertexts = [b''] * len(plaintexts)
+            offset = 0
+            while True:
+                indexes = [index for index, plaintext in enumerate(plaintexts) if len(plaintext) > offset]
+                if not indexes:
+                    break
+                blocks = self._cipher.encrypt(_xor(
+                    b''.join(plaintexts[index][offset:offset + BLOCK_SIZE] for index in indexes),
+                    b''.join(ciphertexts[index][-BLOCK_SIZE:] if offset else self._iv for index in indexes),
+                ))
+                for position, index in enumerate(indexes):
+                    ciphertexts[index] += blocks[position * BLOCK_SIZE:(position + 1) * BLOCK_SIZE]
+                offset += BLOCK_SIZE
+
+        # Slashes are not URL-friendly; replace them with dashes
+        # Also strip the base64 padding: it can be recovered.
+        return [base64.b64encode(ciphertext, ALTCHARS).rstrip(b'=').decode() for ciphertext in ciphertexts]
+
+    def _decrypt(self, encids):
+        try:
+            ciphertexts = [_base64_decode(encid) for encid in encids]
+        except:
+            raise InvalidIDException('The encrypted ID is not valid')
+        if any(not ciphertext or len(ciphertext) % BLOCK_SIZE for ciphertext in ciphertexts):
+            raise InvalidIDException('The encrypted ID is not valid')
+
+        # Unlike encryption, decryption is not chained, so all blocks of all IDs are decrypted at once
+        plaintexts = _xor(
+            self._cipher.decrypt(b''.join(ciphertexts)),
+            b''.join(self._iv + ciphertext[:-BLOCK_SIZE] for ciphertext in ciphertexts),
+        )
+        decids = []
+        offset = 0
+        for ciphertext in ciphertexts:
+            try:
+                decids.append(int(plaintexts[offset:offset + len(ciphertext)].rstrip(PADDING_CHAR.encode())))
+            except ValueError:
+                raise InvalidIDException('The encrypted ID is not valid')
+            offset += len(ciphertext)
+        return decids
+
+
+_HALF_BITS = PERMUTATION_ID_BITS // 2
+_HALF_MASK = (1 << _HALF_BITS) - 1
+
+
+def _round_function(round_hash, half):
+    # Copying a keyed hash is cheaper than keying a new one
+    round_hash = round_hash.copy()
+    round_hash.update(half.to_bytes(_HALF_BITS // 8, 'big'))
+    return int.from_bytes(round_hash.digest(), 'big')
+
+
+# Base62 digits of each number below 62 ** 2, and the number of each pair of digits, to convert two digits at a time
+_BASE62_PAIRS = [first + second for first in BASE62_ALPHABET for second in BASE62_ALPHABET]
+_BASE62_PAIR_VALUES = dict((pair, value) for value, pair in enumerate(_BASE62_PAIRS))
+_BASE62_DIGIT_VALUES = dict((digit, value) for value, digit in enumerate(BASE62_ALPHABET))
+
+
+class PermutationIDCodec(IDCodec):
+    """
+    Encrypts IDs below 2 ** 64 with a keyed permutation of the 64-bit numbers: a balanced Feistel network, whose round
+    function is BLAKE2s keyed by a distinct key per round. The permuted ID is written in base62 with BASE62_ID_LENGTH
+    digits, so that encrypted IDs are short, and each ID has exactly one encrypted ID.
+    """
+
+    def __init__(self, key, cache_size=ID_CODEC_CACHE_SIZE):
+        """
+        :param key: Secret key, type bytes, from which the key of each round is derived
+        :param cache_size: Maximum number of pairs of encrypted and decrypted IDs to memoize
+        """
+        super(PermutationIDCodec, self).__init__(cache_size)
+        self._round_hashes = [
+            hashlib.blake2s(
+                key=hashlib.sha256(b'id-permutation/' + bytes([round_index]) + key).digest(),
+                digest_size=_HALF_BITS // 8,
+            )
+            for round_index in range(PERMUTATION_ROUNDS)
+        ]
+
+    def _encrypt(self, decids):
+        encids = []
+        for decid in decids:
+            try:
+                value = int(decid)
+            except ValueError:
+                raise InvalidIDException('Decrypted ID must be int-castable')
+            if not 0 <= value < 2 ** PERMUTATION_ID_BITS:
+                raise InvalidIDException('Decrypted ID is out of range')
+            encids.append(self._to_base62(self._permute(value)))
+        return encids
+
+    def _decrypt(self, encids):
+        return [self._unpermute(self._from_base62(encid)) for encid in encids]
+
+    def _permute(self, value):
+        left, right = value >> _HALF_BITS, value & _HALF_MASK
+        for round_hash in self._round_hashes:
+            left, right = right, left ^ _round_function(round_hash, right)
+        return (left << _HALF_BITS) | right
+
+    def _unpermute(self, value):
+        left, right = value >> _HALF_BITS, value & _HALF_MASK
+        for round_hash in reversed(self._round_hashes):
+            left, right = right ^ _round_function(round_hash, left), left
+        return (left << _HALF_BITS) | right
+
+    @staticmethod
+    def _to_base62(value):
+        pairs = []
+        for _ in range(BASE62_ID_LENGTH // 2):
+            value, pair_value = divmod(value, len(_BASE62_PAIRS))
+            pairs.append(_BASE62_PAIRS[pair_value])
+        # The leading digit is only needed for an odd number of digits
+        pairs.append(BASE62_ALPHABET[value] if BASE62_ID_LENGTH % 2 else '')
+        return ''.join(reversed(pairs))
+
+    @staticmethod
+    def _from_base62(encid):
+        if len(encid) != BASE62_ID_LENGTH:
+            raise InvalidIDException('The encrypted ID is not valid')
+        try:
+            value = _BASE62_DIGIT_VALUES[encid[0]] if BASE62_ID_LENGTH % 2 else 0
+            for offset in range(BASE62_ID_LENGTH % 2, BASE62_ID_LENGTH, 2):
+                value = value * len(_BASE62_PAIRS) + _BASE62_PAIR_VALUES[encid[offset:offset + 2]]
+        except KeyError:
+            raise InvalidIDException('The encrypted ID is not valid')
+        # Numbers of BASE62_ID_LENGTH digits may exceed the permuted IDs
+        if value >= 2 ** PERMUTATION_ID_BITS:
+            raise InvalidIDException('The encrypted ID is not valid')
+        return value
+
+
+def get_id_codec():
+    """
+    Get the ID codec of the scheme config.ENCRYPTED_ID_SCHEME, keyed by config.ID_ENCRYPTION_KEY.
+
+    :return: An instance of IDCodec, shared by all requests of the process
+    """
+    if config.ENCRYPTED_ID_SCHEME == 'permutation':
+        return _get_permutation_id_codec(config.ID_ENCRYPTION_KEY)
+    return _get_aes_id_codec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_aes_id_codec(key, iv):
+    return AESIDCodec(key.encode(), iv.encode())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_permutation_id_codec(key):
+    return PermutationIDCodec(key.encode())
+
+
 def get_encid(decid):
     """
     Generate an encrypted ID from a decrypted ID
@@ -33,15 +352,7 @@ def get_encid(decid):
     :param decid: Decrypted ID, type int
     :return: Encrypted ID, type str
     """
-    try:
-        int(decid)
-    except:
-        raise InvalidIDException('Decrypted ID must be int-castable')
-
-    # Slashes are not URL-friendly; replace them with dashes
-    # Also strip the base64 padding: it can be recovered.
-    cipher = AES.new(config.ID_ENCRYPTION_KEY.encode(), AES.MODE_CBC, config.ID_ENCRYPTION_IV.encode())
-    return base64.b64encode(cipher.encrypt(_pad(str(decid)).encode()), ALTCHARS).rstrip(b'=').decode()
+    return get_id_codec().encode(decid)
 
 
 def get_decid(encid, force=False):
@@ -70,9 +381,14 @@ def get_decid(encid, force=False):
             raise InvalidIDException('The encrypted ID is not valid')
 
     try:
-        str(encid)
-        cipher = AES.new(config.ID_ENCRYPTION_KEY.encode(), AES.MODE_CBC, config.ID_ENCRYPTION_IV.encode())
-        return int(cipher.decrypt(_base64_decode(str(encid))).rstrip(PADDING_CHAR.encode()))
+        return get_id_codec().decode(encid)
+    except:
+        if config.ENCRYPTED_ID_SCHEME == 'aes' or not config.ACCEPT_LEGACY_ENCRYPTED_IDS:
+            raise InvalidIDException('The encrypted ID is not valid')
+
+    try:
+        # IDs of the AES scheme, e.g. in links shared before the scheme was changed, are accepted during the transition
+        return _get_aes_id_codec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV).decode(encid)
     except:
         raise InvalidIDException('The encrypted ID is not valid')
 
@@ -95,9 +411,29 @@ def get_id_repr(raw_id):
         return get_decid(raw_id, force=True)
 
 
+def get_id_reprs(raw_ids):
+    """
+    Get the representations of several IDs given the application configuration, as by get_id_repr. The IDs are
+    encrypted together when the application is configured to use encrypted IDs.
+
+    :param raw_ids: Iterable of IDs to adapt to the current configuration
+    :return: List of the representations of the IDs, in the same order
+    """
+    raw_ids = list(raw_ids)
+    if config.USE_ENCRYPTED_IDS:
+        try:
+            return get_id_codec().encode_many(raw_ids)
+        except InvalidIDException:
+            # Some of the IDs are already encids
+            pass
+    return [get_id_repr(raw_id) for raw_id in raw_ids]
+
+
 def secure_hash(s, iterations=10000):
     """
     Performs several iterations of a SHA256 hash of a plain-text string to generate a secure hash.
+    This is the unsalted password hash of earlier versions, which is only still used to verify legacy password hashes;
+    new password hashes are generated by hash_password.
 
     :param s: Input string to hash
     :param iterations: Number of hash iterations to use
@@ -105,7 +441,270 @@ def secure_hash(s, iterations=10000):
     """
     if s is None:
         return None
-    hash_result = SHA256.new(data=str(s).encode()).hexdigest()
+    hash_result = hashlib.sha256(str(s).encode()).hexdigest()
     for i in range(iterations):
-        hash_result = SHA256.new(data=hash_result.encode()).hexdigest()
+        hash_result = hashlib.sha256(hash_result.encode()).hexdigest()
     return hash_result
+
+
+def _b64encode(data):
+    return base64.b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data):
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+class PasswordHasher(object):
+    """
+    Base class of the password hashers. Hashes are strings of the name of the algorithm, its parameters, the random
+    salt, and the derived key, separated by '$', so that a hash can be verified whatever the hasher currently configured
+    is. Subclasses define the algorithm name and implement _derive_key and _from_parameters.
+    """
+
+    algorithm = None
+
+    def __init__(self, parameters):
+        """
+        :param parameters: Tuple of the integer parameters of the algorithm, in the order in which they are encoded
+        """
+        self.parameters = tuple(parameters)
+
+    def hash(self, password, salt=None):
+        """
+        Hash a password with a new random salt.
+
+        :param password: Plain-text password
+        :param salt: Salt to use instead of a random one, type bytes
+        :return: The encoded hash, including the algorithm, its parameters, and the salt, type str
+        """
+        if salt is None:
+            salt = os.urandom(PASSWORD_SALT_SIZE)
+        fields = [self.algorithm]
+        fields.extend(str(parameter) for parameter in self.parameters)
+        fields.extend([_b64encode(salt), _b64encode(self._derive_key(password, salt))])
+        return '$'.join(fields)
+
+    @classmethod
+    def verify(cls, password, password_hash):
+        """
+        Verify a password against a hash generated by this kind of hasher, with the parameters encoded in the hash.
+
+        :param password: Plain-text password
+        :param password_hash: Encoded hash, as generated by hash
+        :return: True if the password matches the hash; False otherwise, or if the hash is malformed
+        """
+        try:
+            hasher, salt, key = cls.decode(password_hash)
+        except (ValueError, TypeError):
+            return False
+        return hmac.compare_digest(hasher._derive_key(password, salt), key)
+
+    @classmethod
+    def decode(cls, password_hash):
+        """
+        Split a hash generated by this kind of hasher into its parts.
+
+        :param password_hash: Encoded hash, as generated by hash
+        :return: Tuple of the hasher with the parameters of the hash, the salt, and the derived key
+        :raises ValueError: If the hash is malformed
+        """
+        fields = password_hash.split('$')
+        if fields[0] != cls.algorithm:
+            raise ValueError('Not a {algorithm} password hash'.format(algorithm=cls.algorithm))
+        hasher = cls._from_parameters([int(field) for field in fields[1:-2]])
+        return hasher, _b64decode(fields[-2]), _b64decode(fields[-1])
+
+    @classmethod
+    def _from_parameters(cls, parameters):
+        raise NotImplementedError
+
+    def _derive_key(self, password, salt):
+        raise NotImplementedError
+
+
+class PBKDF2PasswordHasher(PasswordHasher):
+    """
+    Hashes passwords with PBKDF2-HMAC-SHA256, e.g. pbkdf2_sha256$100000$<salt>$<key>.
+    """
+
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations):
+        """
+        :param iterations: Number of iterations of HMAC-SHA256
+        """
+        super(PBKDF2PasswordHasher, self).__init__((iterations,))
+        self.iterations = iterations
+
+    @classmethod
+    def _from_parameters(cls, parameters):
+        iterations, = parameters
+        return cls(iterations)
+
+    def _derive_key(self, password, salt):
+        return hashlib.pbkdf2_hmac('sha256', str(password).encode(), salt, self.iterations)
+
+
+class ScryptPasswordHasher(PasswordHasher):
+    """
+    Hashes passwords with scrypt, e.g. scrypt$16384$8$1$<salt>$<key>.
+    """
+
+    algorithm = 'scrypt'
+
+    def __init__(self, n, r, p):
+        """
+        :param n: CPU and memory cost, a power of 2
+        :param r: Block size
+        :param p: Parallelization
+        """
+        super(ScryptPasswordHasher, self).__init__((n, r, p))
+        self.n = n
+        self.r = r
+        self.p = p
+
+    @classmethod
+    def _from_parameters(cls, parameters):
+        n, r, p = parameters
+        return cls(n, r, p)
+
+    def _derive_key(self, password, salt):
+        return hashlib.scrypt(
+            str(password).encode(),
+            salt=salt,
+            n=self.n,
+            r=self.r,
+            p=self.p,
+            # scrypt needs 128 * r * (n + p) bytes, more than the default limit of OpenSSL for larger costs
+            maxmem=128 * self.r * (self.n + self.p) + SCRYPT_MAXMEM_MARGIN,
+            dklen=PASSWORD_KEY_SIZE,
+        )
+
+
+PASSWORD_HASHERS = {
+    PBKDF2PasswordHasher.algorithm: PBKDF2PasswordHasher,
+    ScryptPasswordHasher.algorithm: ScryptPasswordHasher,
+}
+
+
+def get_password_hasher():
+    """
+    Get the password hasher of the current application configuration.
+
+    :return: PasswordHasher instance
+    :raises ValueError: If config.PASSWORD_HASHER is not a known algorithm
+    """
+    if config.PASSWORD_HASHER == PBKDF2PasswordHasher.algorithm:
+        return PBKDF2PasswordHasher(config.PASSWORD_PBKDF2_ITERATIONS)
+    if config.PASSWORD_HASHER == ScryptPasswordHasher.algorithm:
+        return ScryptPasswordHasher(config.PASSWORD_SCRYPT_N, config.PASSWORD_SCRYPT_R, config.PASSWORD_SCRYPT_P)
+    raise ValueError('Unknown password hasher: {hasher}'.format(hasher=config.PASSWORD_HASHER))
+
+
+def hash_password(password):
+    """
+    Hash a password, with a random salt, using the password hasher of the current application configuration. This is
+    done by the password hashing executor, if one is configured.
+
+    :param password: Plain-text password
+    :return: The encoded hash, type str, or None if the password is None
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
+    """
+    if password is None:
+        return None
+    return util.hashing.run(get_password_hasher().hash, password)
+
+
+def _is_legacy_password_hash(password_hash):
+    return '$' not in password_hash
+
+
+def verify_password(password, password_hash):
+    """
+    Verify a password against a hash generated by hash_password, with any hasher or parameters, or by secure_hash, as
+    earlier versions did. This is done by the password hashing executor, if one is configured.
+
+    :param password: Plain-text password
+    :param password_hash: Stored hash of the password
+    :return: True if the password matches the hash; False otherwise
+    :raises PasswordHashingOverloadedException: If the password hashing executor is overloaded
+    """
+    if password is None or not password_hash:
+        return False
+    return util.hashing.run(_verify_password, password, password_hash)
+
+
+def _verify_password(password, password_hash):
+    if _is_legacy_password_hash(password_hash):
+        return hmac.compare_digest(secure_hash(password), password_hash)
+    hasher_class = PASSWORD_HASHERS.get(password_hash.split('$', 1)[0])
+    if hasher_class is None:
+        return False
+    return hasher_class.verify(password, password_hash)
+
+
+def password_needs_rehash(password_hash):
+    """
+    Check whether a hash was generated by another hasher, or with other parameters, than those of the current
+    application configuration, e.g. by secure_hash, so that it should be replaced once its password is known.
+
+    :param password_hash: Stored hash of a password, which is verified
+    :return: True if the password should be hashed again with hash_password
+    """
+    if _is_legacy_password_hash(password_hash):
+        return True
+    hasher = get_password_hasher()
+    try:
+        stored_hasher, _, _ = hasher.decode(password_hash)
+    except (ValueError, TypeError):
+        return True
+    return stored_hasher.parameters != hasher.parameters
+
+
+@functools.lru_cache(maxsize=None)
+def _get_signed_token_key(secret_key):
+    return hmac.new(secret_key.encode(), SIGNED_TOKEN_KEY_LABEL, hashlib.sha256).digest()
+
+
+def _sign_token(message, expiry_time):
+    signature = hmac.new(
+        _get_signed_token_key(config.FLASK_SECRET_KEY),
+        '{expiry_time}:{message}'.format(expiry_time=expiry_time, message=message).encode(),
+        hashlib.sha256,
+    ).digest()
+    return base64.urlsafe_b64encode(signature).rstrip(b'=')
+
+
+def generate_signed_token(message, ttl):
+    """
+    Generate a token, signed with HMAC-SHA256, proving that the application issued it for a message, e.g. a statement
+    that a password has been checked. The message itself is not part of the token.
+
+    :param message: The message for which the token is issued, type str
+    :param ttl: Number of seconds for which the token is valid
+    :return: The token, of the expiry time and the signature, type str, which is safe to use in URLs and cookies
+    """
+    expiry_time = int(time.time()) + ttl
+    return '{expiry_time}.{signature}'.format(
+        expiry_time=expiry_time,
+        signature=_sign_token(message, expiry_time).decode(),
+    )
+
+
+def verify_signed_token(token, message):
+    """
+    Verify a token generated by generate_signed_token.
+
+    :param token: The token, type str
+    :param message: The message for which the token must have been issued
+    :return: True if the token was issued for the message and hasn't expired; False otherwise, or if it is malformed
+    """
+    try:
+        expiry_time, signature = token.split('.')
+        expiry_time = int(expiry_time)
+    except (AttributeError, ValueError):
+        return False
+    if expiry_time < time.time():
+        return False
+    return hmac.compare_digest(_sign_token(message, expiry_time), signature.encode())
@@ -20,6 +20,10 @@ class PasteDoesNotExistException(Exception):
     pass
 
 
+class InvalidCursorException(Exception):
+    pass
+
+
 # Attachment
 
 
@@ -27,8 +31,34 @@ class AttachmentDoesNotExistException(Exception):
     pass
 
 
+class AttachmentTooLargeException(Exception):
+    pass
+
+
+class AttachmentUploadTooLargeException(Exception):
+    pass
+
+
 # Cryptography
 
 
 class InvalidIDException(Exception):
     pass
+
+
+class PasswordHashingOverloadedException(Exception):
+    pass
+
+
+# Compression
+
+
+class InvalidCodecException(Exception):
+    pass
+
+
+# Byte ranges
+
+
+class RangeNotSatisfiableException(Exception):
+    pass
@@ -0,0 +1,188 @@
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+from util.exception import PasswordHashingOverloadedException
+
+
+# Number of most recent calls of which the latency is reported by HashingExecutor.stats
+LATENCY_WINDOW = 1000
+
+
+class HashingExecutor(object):
+    """
+    Runs CPU-bound functions, i.e. password hashing, in a pool of worker processes, so that they don't hold the GIL of
+    the application process while other requests are handled. At most max_pending calls may be queued or running at a
+    time: further calls, and calls that don't complete within the timeout, raise PasswordHashingOverloadedException
+    rather than piling up. The pool is started on first use in each process, so that it is never shared by forked
+    application processes. Instances are thread-safe.
+    """
+
+    def __init__(self, max_workers, max_pending, timeout, executable=None):
+        """
+        :param max_workers: Number of worker processes
+        :param max_pending: Maximum number of calls queued or running at a time
+        :param timeout: Maximum number of seconds a call may take, including the time it is queued
+        :param executable: Path of the Python interpreter running the worker processes, or None for sys.executable
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executable = executable
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def run(self, function, *args):
+        """
+        Call a function in a worker process, and wait for its result.
+
+        :param function: Module-level function to call, which must be picklable, as must its arguments and result
+        :param args: Arguments of the function
+        :return: The result of the function
+        :raises PasswordHashingOverloadedException: If too many calls are pending, or if the call times out
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise PasswordHashingOverloadedException('{pending} calls are already pending'.format(
+                    pending=self._pending,
+                ))
+            pool = self._get_pool()
+            self._pending += 1
+
+        start_time = time.time()
+        try:
+            future = pool.submit(function, *args)
+        except Exception as e:
+            self._call_done(None)
+            if isinstance(e, BrokenProcessPool):
+                self._discard_pool(pool)
+            raise
+        # The call is pending until it is actually done, even if its caller has given up on it
+        future.add_done_callback(self._call_done)
+        try:
+            result = future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            with self._lock:
+                self._timed_out += 1
+            raise PasswordHashingOverloadedException('The call timed out after {timeout} seconds'.format(
+                timeout=self.timeout,
+            ))
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            raise
+
+        with self._lock:
+            self._completed += 1
+            self._latencies.append(time.time() - start_time)
+        return result
+
+    def stats(self):
+        """
+        Report the executor's queue depth, counters, and the latency of recent calls, including the time they were
+        queued.
+
+        :return: Dictionary of executor statistics, with latencies in seconds
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'workers': self.max_workers,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'timed_out': self._timed_out,
+                'mean_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+                'median_latency': latencies[len(latencies) // 2] if latencies else 0.0,
+                'p95_latency': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+                'max_latency': latencies[-1] if latencies else 0.0,
+            }
+
+    def shutdown(self):
+        """
+        Stop the worker processes, once pending calls are done. A new pool is started if the executor is used again.
+        """
+        with self._lock:
+            pool = self._pool if self._pool_pid == os.getpid() else None
+            self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _get_pool(self):
+        if self._pool_pid != os.getpid():
+            # The pool and pending calls, if any, belong to the process from which this one was forked
+            self._pool = None
+            self._pool_pid = os.getpid()
+            self._pending = 0
+        if self._pool is None:
+            # Workers are spawned rather than forked, as forking a multi-threaded application process isn't safe
+            mp_context = multiprocessing.get_context('spawn')
+            if self.executable:
+                # When embedded, e.g. by mod_wsgi, sys.executable is the server's binary rather than a Python interpreter
+                mp_context.set_executable(self.executable)
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=mp_context,
+            )
+        return self._pool
+
+    def _discard_pool(self, pool):
+        # A worker process died, which breaks the whole pool; a new one is started for the next call
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+
+    def _call_done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+
+@functools.lru_cache(maxsize=None)
+def _get_hashing_executor(processes, max_pending, timeout, executable):
+    return HashingExecutor(processes, max_pending, timeout, executable)
+
+
+def get_hashing_executor():
+    """
+    Get the password hashing executor of the current application configuration.
+
+    :return: HashingExecutor instance, or None if password hashing is configured to run in the request's own thread
+    """
+    if not config.PASSWORD_HASHING_PROCESSES:
+        return None
+    return _get_hashing_executor(
+        config.PASSWORD_HASHING_PROCESSES,
+        config.PASSWORD_HASHING_MAX_PENDING,
+        config.PASSWORD_HASHING_TIMEOUT,
+        config.PASSWORD_HASHING_PYTHON_EXECUTABLE,
+    )
+
+
+def run(function, *args):
+    """
+    Call a CPU-bound password hashing function, by the password hashing executor if one is configured, or directly
+    otherwise.
+
+    :param function: Module-level function to call, which must be picklable, as must its arguments and result
+    :param args: Arguments of the function
+    :return: The result of the function
+    :raises PasswordHashingOverloadedException: If the executor is overloaded
+    """
+    executor = get_hashing_executor()
+    if executor is None:
+        return function(*args)
+    return executor.run(function, *args)
@@ -0,0 +1,55 @@
+import flask
+
+import config
+import util.cryptography
+
+
+# Unlock tokens of password-protected pastes are sent to clients as a cookie per paste, and in a response header. Clients
+# pass them back as the cookie, or as a request parameter.
+COOKIE_PREFIX = 'paste_unlock_'
+TOKEN_PARAMETER = 'unlock_token'
+TOKEN_HEADER = 'X-Paste-Unlock-Token'
+
+
+def get_cookie_name(paste_id):
+    """
+    Get the name of the cookie holding the unlock token of a paste.
+
+    :param paste_id: Decid of the paste
+    :return: The cookie name, which includes the ID of the paste as shown to users
+    """
+    return '{prefix}{paste_id}'.format(prefix=COOKIE_PREFIX, paste_id=util.cryptography.get_id_repr(paste_id))
+
+
+def get_request_token(paste_id, token=None):
+    """
+    Get the unlock token of a paste supplied with the current request.
+
+    :param paste_id: Decid of the paste
+    :param token: Token passed as a request parameter, if any, which takes precedence over the cookie
+    :return: The unlock token, or None if there is none
+    """
+    return token or flask.request.cookies.get(get_cookie_name(paste_id))
+
+
+def set_response_token(resp, paste_id, token):
+    """
+    Send a newly issued unlock token of a paste to the client, as a cookie and in a response header.
+
+    :param resp: The response to the current request
+    :param paste_id: Decid of the paste
+    :param token: Unlock token generated by database.paste.get_paste_unlock_token, can be None if tokens are disabled
+    :return: The response
+    """
+    if token is None:
+        return resp
+    resp.set_cookie(
+        get_cookie_name(paste_id),
+        token,
+        max_age=config.PASTE_UNLOCK_TOKEN_TTL,
+        secure=flask.request.is_secure,
+        httponly=True,
+        samesite='Lax',
+    )
+    resp.headers[TOKEN_HEADER] = token
+    return resp
@@ -0,0 +1,150 @@
+import secrets
+
+from werkzeug.http import parse_if_range_header
+from werkzeug.http import parse_range_header
+
+from util.exception import *
+
+
+# Number of bytes of a file read at a time
+CHUNK_SIZE = 64 * 1024
+
+# Maximum number of ranges served for a single request; requests for more ranges are answered with the full resource
+MAX_RANGES = 16
+
+
+def parse_byte_ranges(range_header, complete_length):
+    """
+    Parse the byte ranges requested by a Range header, resolved against the length of the resource. Overlapping and
+    adjacent ranges are coalesced, so that no byte is sent more than once.
+
+    :param range_header: Value of the Range header
+    :param complete_length: Size of the resource in bytes
+    :return: A sorted list of (start, stop) tuples of byte offsets, where stop is exclusive, or None if the header is
+             missing, malformed, or requests too many ranges, in which case the full resource should be sent
+    :raises RangeNotSatisfiableException: If none of the requested ranges overlap the resource
+    """
+    byte_range = parse_range_header(range_header)
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            # Suffix range, covering the last -start bytes of the resource
+            start, stop = max(complete_length + start, 0), complete_length
+        elif stop is None or stop > complete_length:
+            stop = complete_length
+        if start < stop:
+            ranges.append((start, stop))
+    if not ranges:
+        raise RangeNotSatisfiableException(
+            'None of the ranges {range_header} overlap the resource of {complete_length} bytes'.format(
+                range_header=range_header,
+                complete_length=complete_length,
+            )
+        )
+
+    coalesced_ranges = []
+    for start, stop in sorted(ranges):
+        if coalesced_ranges and start <= coalesced_ranges[-1][1]:
+            coalesced_ranges[-1] = (coalesced_ranges[-1][0], max(coalesced_ranges[-1][1], stop))
+        else:
+            coalesced_ranges.append((start, stop))
+    return coalesced_ranges
+
+
+def if_range_matches(if_range_header, etag, last_modified):
+    """
+    Check whether the Range header of a request applies to the current version of the resource, per its If-Range
+    header. Ranges must only be served if the client's partial copy is of the same version of the resource.
+
+    :param if_range_header: Value of the If-Range header, or None if the request has none
+    :param etag: Strong entity tag of the resource
+    :param last_modified: Timezone-aware datetime at which the resource was last modified
+    :return: True if the requested ranges should be served; False if the full resource should be sent instead
+    """
+    if not if_range_header:
+        return True
+    if if_range_header.startswith('W/'):
+        # Weak entity tags never match for ranges
+        return False
+    if_range = parse_if_range_header(if_range_header)
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == int(last_modified.timestamp())
+    return if_range.etag == etag
+
+
+def content_range(start, stop, complete_length):
+    """
+    Format the Content-Range header of a byte range.
+
+    :param start: Offset of the first byte of the range
+    :param stop: Offset following the last byte of the range
+    :param complete_length: Size of the resource in bytes
+    :return: The value of the Content-Range header
+    """
+    return 'bytes {first}-{last}/{complete_length}'.format(first=start, last=stop - 1, complete_length=complete_length)
+
+
+def iter_file_range(open_file, start, stop, chunk_size=CHUNK_SIZE):
+    """
+    Read a byte range of a file in chunks. The file is only opened once the first chunk is requested, and is closed
+    once the range is read, or the generator is closed.
+
+    :param open_file: Function opening the file as a binary file object supporting seek
+    :param start: Offset of the first byte of the range
+    :param stop: Offset following the last byte of the range
+    :param chunk_size: Maximum number of bytes to read at a time
+    :return: A generator of non-empty byte strings
+    """
+    with open_file() as file:
+        yield from _iter_file_range(file, start, stop, chunk_size)
+
+
+def iter_multipart_byteranges(open_file, ranges, complete_length, content_type, chunk_size=CHUNK_SIZE):
+    """
+    Generate a multipart/byteranges body of several byte ranges of a file, reading only the requested ranges. The file
+    is only opened once the first chunk is requested, and is closed once the body is generated, or the generator is
+    closed.
+
+    :param open_file: Function opening the file as a binary file object supporting seek
+    :param ranges: List of (start, stop) tuples, as returned by parse_byte_ranges
+    :param complete_length: Size of the resource in bytes
+    :param content_type: Content type of the resource
+    :param chunk_size: Maximum number of bytes to read at a time
+    :return: A tuple of the boundary separating the parts of the body, the length of the body in bytes, and a generator
+             of the body's non-empty byte strings
+    """
+    boundary = secrets.token_hex(16)
+    part_headers = [
+        '\r\n--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: {content_range}\r\n\r\n'.format(
+            boundary=boundary,
+            content_type=content_type,
+            content_range=content_range(start, stop, complete_length),
+        ).encode('latin-1')
+        for start, stop in ranges
+    ]
+    closing_boundary = '\r\n--{boundary}--\r\n'.format(boundary=boundary).encode('latin-1')
+    length = sum(len(headers) for headers in part_headers) + sum(stop - start for start, stop in ranges) + len(closing_boundary)
+
+    def body():
+        with open_file() as file:
+            for headers, (start, stop) in zip(part_headers, ranges):
+                yield headers
+                yield from _iter_file_range(file, start, stop, chunk_size)
+        yield closing_boundary
+
+    return boundary, length, body()
+
+
+def _iter_file_range(file, start, stop, chunk_size):
+    file.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = file.read(min(chunk_size, remaining))
+        if not chunk:
+            # The file was truncated since its size was determined
+            return
+        remaining -= len(chunk)
+        yield chunk
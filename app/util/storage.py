@@ -0,0 +1,380 @@
+import errno
+import io
+import os
+import tempfile
+
+
+# Number of bytes of an object read or written at a time
+CHUNK_SIZE = 64 * 1024
+
+# Objects stored in a local directory are fanned out into SHARD_LEVELS levels of subdirectories, each named by the next
+# SHARD_PREFIX_LENGTH characters of the hash of their name, so that no directory holds too many entries.
+SHARD_LEVELS = 2
+SHARD_PREFIX_LENGTH = 2
+
+# Maximum number of keys deleted by a single request to an S3-compatible object store
+S3_DELETE_BATCH_SIZE = 1000
+
+
+def shard_path(parent_dir, name, name_hash):
+    """
+    Get the path of an entry of a directory that is fanned out into levels of subdirectories.
+
+    :param parent_dir: Path to the directory
+    :param name: Name of the entry
+    :param name_hash: Hexadecimal hash of the entry's name, naming the subdirectories storing it
+    :return: Path to the entry
+    """
+    prefixes = [
+        name_hash[level * SHARD_PREFIX_LENGTH:(level + 1) * SHARD_PREFIX_LENGTH]
+        for level in range(SHARD_LEVELS)
+    ]
+    return os.path.join(parent_dir, *prefixes, name)
+
+
+def make_dir(dir_path):
+    """
+    Create a directory, along with its parent directories, if it doesn't already exist.
+
+    :param dir_path: Path to the directory
+    :return: Path to the directory
+    """
+    try:
+        os.makedirs(dir_path)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+    return dir_path
+
+
+def sync_dirs(dir_paths):
+    """
+    Sync directories, so that the entries that were placed in them are durable. Directories are synced after the
+    directories they contain.
+
+    :param dir_paths: Iterable of paths to the directories
+    """
+    for dir_path in sorted(set(dir_paths), reverse=True):
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class LocalStorageBackend:
+    """
+    Storage backend keeping immutable objects as files in a local directory, named by their key and fanned out into
+    levels of subdirectories named by prefixes of the key. Keys must therefore be hexadecimal hashes. Objects stored
+    directly in the directory, as by earlier versions, are found as well.
+
+    Every storage backend implements put, put_file, open, size, exists, delete, redirect_url, local_path, and temp_dir,
+    as documented below.
+    """
+
+    def __init__(self, root_dir):
+        """
+        :param root_dir: Path to the directory storing the objects
+        """
+        self.root_dir = root_dir
+
+    def put(self, key, chunks):
+        """
+        Store an object, replacing any object with the same key. The object is durable once this returns, and is never
+        visible partially written.
+
+        :param key: Key of the object
+        :param chunks: Iterable of byte strings, making up the data of the object
+        """
+        object_path = self._get_path(key)
+        with tempfile.NamedTemporaryFile(dir=make_dir(os.path.dirname(object_path)), suffix='.tmp', delete=False) as temp_file:
+            try:
+                for chunk in chunks:
+                    temp_file.write(chunk)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            except:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+        os.replace(temp_file.name, object_path)
+        self._sync_object_dirs(object_path)
+
+    def put_file(self, key, file_path):
+        """
+        Store the data of a local file as an object, replacing any object with the same key. The file is consumed: it
+        is moved into place or removed once it has been stored. The object is durable once this returns.
+
+        :param key: Key of the object
+        :param file_path: Path to the file, which must have been written and synced to a directory returned by
+                          temp_dir, or anywhere if temp_dir returns None
+        """
+        object_path = self._get_path(key)
+        make_dir(os.path.dirname(object_path))
+        os.replace(file_path, object_path)
+        self._sync_object_dirs(object_path)
+
+    def open(self, key):
+        """
+        Open an object for reading. Reads are streamed from the backend, so the object is never held in memory as a
+        whole.
+
+        :param key: Key of the object
+        :return: A readable and seekable binary file object
+        :raises OSError: If the object does not exist
+        """
+        return open(self.local_path(key), 'rb')
+
+    def size(self, key):
+        """
+        Get the size of an object.
+
+        :param key: Key of the object
+        :return: The size of the object in bytes, or None if it does not exist
+        """
+        try:
+            return os.path.getsize(self.local_path(key))
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+            return None
+
+    def exists(self, key):
+        """
+        Check whether an object exists.
+
+        :param key: Key of the object
+        :return: True if the object exists
+        """
+        return os.path.exists(self._get_path(key)) or os.path.exists(self._get_unsharded_path(key))
+
+    def delete(self, keys):
+        """
+        Delete several objects, with as few requests to the backend as possible. Objects that do not exist are ignored.
+
+        :param keys: Iterable of the keys of the objects
+        """
+        for key in keys:
+            for object_path in [self._get_path(key), self._get_unsharded_path(key)]:
+                try:
+                    os.remove(object_path)
+                except OSError as exception:
+                    if exception.errno != errno.ENOENT:
+                        raise
+
+    def redirect_url(self, key, content_type, content_encoding=None):
+        """
+        Get a URL from which clients can download an object directly from the backend, without involving the app.
+
+        :param key: Key of the object
+        :param content_type: Content type with which the object should be served
+        :param content_encoding: Content encoding with which the object should be served, or None for no encoding
+        :return: The URL, or None if the backend does not support direct downloads
+        """
+        return None
+
+    def local_path(self, key):
+        """
+        Get the path of the local file storing an object, which may not exist.
+
+        :param key: Key of the object
+        :return: Path to the file, or None if the backend does not store objects in local files
+        """
+        object_path = self._get_path(key)
+        unsharded_path = self._get_unsharded_path(key)
+        # Objects that have not been moved to the sharded layout yet are found in the earlier layout
+        if not os.path.exists(object_path) and os.path.exists(unsharded_path):
+            return unsharded_path
+        return object_path
+
+    def temp_dir(self):
+        """
+        Get the directory in which to write temporary files that are to be stored with put_file.
+
+        :return: Path to the directory, or None for the system's default temporary directory
+        """
+        return make_dir(self.root_dir)
+
+    def _get_path(self, key):
+        return shard_path(self.root_dir, key, key)
+
+    def _get_unsharded_path(self, key):
+        return os.path.join(self.root_dir, key)
+
+    def _sync_object_dirs(self, object_path):
+        """
+        Sync the directories storing an object, up to the root directory, so that the object and any of the directories
+        that were created for it are durable.
+        """
+        dir_paths = []
+        dir_path = os.path.dirname(object_path)
+        while dir_path != self.root_dir:
+            dir_paths.append(dir_path)
+            dir_path = os.path.dirname(dir_path)
+        sync_dirs(dir_paths + [self.root_dir])
+
+
+class S3StorageBackend:
+    """
+    Storage backend keeping objects in a bucket of an S3-compatible object store, such as Amazon S3 or MinIO. Downloads
+    can be redirected to presigned URLs, so that the data of objects never passes through the app. This backend
+    requires the boto3 Python package, which is only imported when the backend is first constructed without a client.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region_name=None, presigned_url_ttl=None, client=None):
+        """
+        :param bucket: Name of the bucket
+        :param prefix: Prefix prepended to the keys of all objects stored by this backend
+        :param endpoint_url: URL of the object store, or None for Amazon S3
+        :param region_name: Region of the bucket, or None for the default region of the environment
+        :param presigned_url_ttl: Number of seconds for which presigned URLs returned by redirect_url are valid, or
+                                  None to never redirect downloads
+        :param client: S3 client of the object store; created from the environment's credentials if not specified
+        """
+        if client is None:
+            import boto3
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region_name)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.presigned_url_ttl = presigned_url_ttl
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def put(self, key, chunks):
+        # Large objects are uploaded in parts, as they are read
+        self.client.upload_fileobj(_ChunkReader(chunks), self.bucket, self._key(key))
+
+    def put_file(self, key, file_path):
+        try:
+            self.client.upload_file(file_path, self.bucket, self._key(key))
+        finally:
+            os.remove(file_path)
+
+    def open(self, key):
+        return _S3ObjectReader(self.client, self.bucket, self._key(key))
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))['ContentLength']
+        except self.client.exceptions.ClientError as exception:
+            if exception.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+            return None
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def delete(self, keys):
+        keys = [self._key(key) for key in keys]
+        for batch_start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys[batch_start:batch_start + S3_DELETE_BATCH_SIZE]],
+                    'Quiet': True,
+                },
+            )
+
+    def redirect_url(self, key, content_type, content_encoding=None):
+        if not self.presigned_url_ttl:
+            return None
+        params = {
+            'Bucket': self.bucket,
+            'Key': self._key(key),
+            'ResponseContentType': content_type,
+        }
+        if content_encoding is not None:
+            params['ResponseContentEncoding'] = content_encoding
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.presigned_url_ttl)
+
+    def local_path(self, key):
+        return None
+
+    def temp_dir(self):
+        return None
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Readable binary file object reading the byte strings of an iterable in order.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b''
+                return 0
+        length = min(len(buffer), len(self._buffer))
+        buffer[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return length
+
+
+class _S3ObjectReader(io.RawIOBase):
+    """
+    Readable and seekable binary file object streaming an object of an S3-compatible object store. Each read continues
+    the response to a request for the object from the current position onwards; seeking elsewhere starts a new request
+    on the next read.
+    """
+
+    def __init__(self, client, bucket, key):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._position = 0
+        self._body = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Objects can only be seeked to absolute positions')
+        if offset != self._position:
+            self._close_body()
+            self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        if self._body is None:
+            try:
+                response = self._client.get_object(
+                    Bucket=self._bucket,
+                    Key=self._key,
+                    Range='bytes={start}-'.format(start=self._position),
+                )
+            except self._client.exceptions.ClientError as exception:
+                # Reading past the end of the object
+                if exception.response['Error']['Code'] != 'InvalidRange':
+                    raise
+                return 0
+            self._body = response['Body']
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
@@ -1,4 +1,6 @@
+import hashlib
 import json
+import os
 import random
 import time
 import types
@@ -33,6 +35,19 @@ def random_alphanumeric_string(length=64):
     return ''.join([random.choice(list(alphabet) + list(alphabet.upper()) + list(numbers)) for i in range(length)])
 
 
+def list_blob_files():
+    """
+    List the names of all files in the directory storing attachment blobs, including its subdirectories.
+
+    :return: A sorted list of file names, which are the content hashes of the blobs unless temporary files are left
+    """
+    return sorted(
+        file_name
+        for _, _, file_names in os.walk(os.path.join(config.ATTACHMENTS_DIR, database.attachment.BLOB_DIR_NAME))
+        for file_name in file_names
+    )
+
+
 class Factory:
     def __init__(self):
         pass
@@ -110,7 +125,10 @@ class AttachmentFactory(Factory):
         mime_type=lambda: 'image/png',
         file_data=lambda: random_alphanumeric_string(8192)
     ):
-        with mock.patch.object(database.attachment, '_store_attachment_file'):
+        def store_attachment_file(paste_id, file_data, mime_type):
+            return hashlib.sha256(file_data.encode('utf-8')).hexdigest(), None, False
+
+        with mock.patch.object(database.attachment, '_store_attachment_file', side_effect=store_attachment_file):
             return database.attachment.create_new_attachment(
                 paste_id=cls.random_or_specified_value(paste_id),
                 file_name=cls.random_or_specified_value(file_name),
@@ -134,7 +152,14 @@ class DatabaseTestCase(TestCase):
         config.ENABLE_USER_REGISTRATION = True
         config.ENABLE_PASTE_ATTACHMENTS = True
         config.MAX_ATTACHMENT_SIZE = 0
+        config.MAX_ATTACHMENT_UPLOAD_SIZE = 0
+        config.ATTACHMENTS_SENDFILE_HEADER = None
         config.AUTH_METHOD = 'local'
+        config.ENABLE_PASTE_CACHE = False
+        config.PASTE_VIEW_FLUSH_INTERVAL = 0
+        config.ENABLE_PASTE_COMPRESSION = False
+        config.PASTE_COMPRESSION_THRESHOLD = 1024
+        config.PASTE_COMPRESSION_CODEC = 'zlib'
 
         modern_paste.app.config['TESTING'] = True
         modern_paste.app.config['SQLALCHEMY_DATABASE_URI'] = modern_paste.app.config['SQLALCHEMY_TEST_DATABASE_URI']
@@ -154,6 +179,9 @@ class DatabaseTestCase(TestCase):
         """
         db.session.remove()
         db.drop_all()
+        database.paste.paste_cache.clear()
+        database.paste.paste_view_counter.clear()
+        database.paste.top_pastes_floor_cache.clear()
 
     def api_login_user(self, username, password):
         """
@@ -220,6 +248,9 @@ class OIDCTestCase(DatabaseTestCase):
         """
         db.session.remove()
         db.drop_all()
+        database.paste.paste_cache.clear()
+        database.paste.paste_view_counter.clear()
+        database.paste.top_pastes_floor_cache.clear()
         modern_paste.app.before_request_funcs[None] = []
 
     @classmethod
@@ -0,0 +1,118 @@
+from werkzeug.sansio.multipart import Epilogue
+from werkzeug.sansio.multipart import File
+from werkzeug.sansio.multipart import MultipartDecoder
+from werkzeug.sansio.multipart import NeedData
+
+from util.exception import AttachmentUploadTooLargeException
+
+
+# Number of bytes of a request body read at a time
+CHUNK_SIZE = 64 * 1024
+
+# Maximum number of bytes of the headers of a multipart part, and of any non-file field, held in memory
+MAX_FORM_MEMORY_SIZE = 1024 * 1024
+
+
+def iter_chunks(stream, chunk_size=CHUNK_SIZE, max_size=None):
+    """
+    Read a stream in chunks, as it arrives.
+
+    :param stream: File-like object, e.g. flask.request.stream
+    :param chunk_size: Maximum number of bytes to read at a time
+    :param max_size: Maximum number of bytes to read from the stream, or None for no limit
+    :return: A generator of non-empty byte strings
+    :raises AttachmentUploadTooLargeException: If the stream is longer than max_size bytes
+    """
+    stream = _SizeLimitedStream(stream, max_size)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_multipart_files(stream, boundary, chunk_size=CHUNK_SIZE, max_size=None):
+    """
+    Parse a multipart/form-data body as it arrives, without buffering the files it contains. Fields that are not files
+    are skipped.
+
+    The data of each file is generated by an iterator that must be consumed before advancing to the next file; any data
+    of the file that is not consumed is skipped.
+
+    :param stream: File-like object, e.g. flask.request.stream
+    :param boundary: The boundary separating the parts of the body, from the request's Content-Type
+    :param chunk_size: Maximum number of bytes to read at a time
+    :param max_size: Maximum number of bytes of the whole body to read, or None for no limit
+    :return: A generator of tuples of the file name, the MIME type (or None), and an iterator of the file's data chunks
+    :raises ValueError: If the body is not valid multipart/form-data
+    :raises AttachmentUploadTooLargeException: If the body is longer than max_size bytes
+    """
+    boundary = boundary.encode('latin-1')
+    decoder = MultipartDecoder(boundary, max_form_memory_size=MAX_FORM_MEMORY_SIZE)
+    events = _iter_multipart_events(_SizeLimitedStream(stream, max_size), decoder, boundary, chunk_size)
+    for event in events:
+        if isinstance(event, File):
+            yield event.filename, event.headers.get('Content-Type'), _iter_multipart_file_data(events)
+
+
+def _iter_multipart_events(stream, decoder, boundary, chunk_size):
+    """
+    Feed a stream to a multipart decoder as needed, generating its events up to (excluding) the epilogue.
+    """
+    # The decoder mistakes the line break before the closing boundary for data if the data it received so far ends right
+    # after the first trailing hyphen of the boundary, so the last byte of such data is held back until more data arrives
+    partial_closing_boundary = b'--' + boundary + b'-'
+    received_tail = b''
+    held_back = b''
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                if held_back:
+                    decoder.receive_data(held_back)
+                decoder.receive_data(None)
+                continue
+            data = held_back + chunk
+            held_back = b''
+            if (received_tail + data).endswith(partial_closing_boundary):
+                data, held_back = data[:-1], data[-1:]
+            if data:
+                received_tail = (received_tail + data)[-len(partial_closing_boundary):]
+                decoder.receive_data(data)
+        elif isinstance(event, Epilogue):
+            return
+        else:
+            yield event
+
+
+def _iter_multipart_file_data(events):
+    """
+    Generate the data chunks of the file whose File event was the last one consumed from events.
+    """
+    for event in events:
+        if event.data:
+            yield event.data
+        if not event.more_data:
+            return
+
+
+class _SizeLimitedStream(object):
+    """
+    Wraps a stream, counting the bytes read from it, so that a body whose length is not known up front, e.g. one sent
+    with chunked transfer encoding, is still rejected as soon as it is too long.
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def read(self, size):
+        data = self.stream.read(size)
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise AttachmentUploadTooLargeException(
+                'Upload is larger than the maximum size of {max_size} bytes'.format(max_size=self.max_size),
+            )
+        return data
@@ -1,11 +1,18 @@
 import base64
+import datetime
+import io
+import os
 
 import flask
+from werkzeug.http import is_resource_modified
 
 import config
 import database.attachment
 import database.paste
+import util.compression
 import util.cryptography
+import util.paste_unlock
+import util.ranges
 from api.decorators import render_view
 from api.decorators import require_login_frontend
 from modern_paste import app
@@ -36,15 +43,14 @@ def paste_view(paste_id, deactivation_token=None):
     :param deactivation_token: Deactivation token string for paste if the user is attempting to deactivate.
     """
     try:
-        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(paste_id), active_only=True)
-        database.paste.increment_paste_views(util.cryptography.get_decid(paste_id))
+        paste, is_first_view = database.paste.view_paste(util.cryptography.get_decid(paste_id))
     except (PasteDoesNotExistException, InvalidIDException):
         return 'paste/nonexistent.html', {}
 
     return 'paste/view.html', {
         'paste': paste,
         # Display the deactivation token if this is the paste's first view and if it was posted via the web interface
-        'show_deactivation_token': paste.views == 1 and not paste.is_api_post,
+        'show_deactivation_token': is_first_view and not paste.is_api_post,
         # User-supplied deactivation token for manual deactivation
         'deactivation_token': deactivation_token,
     }
@@ -57,22 +63,57 @@ def paste_view_raw(paste_id):
 
     :param paste_id: Encid or decid of the paste to look up; supplied in the URL
     """
+    def raw_response(range_header):
+        contents = paste.contents.encode('utf-8')
+        return _byte_range_response(
+            range_header=range_header,
+            open_file=lambda: io.BytesIO(contents),
+            complete_length=len(contents),
+            content_type='text/plain; charset=utf-8',
+        ) or flask.Response(contents, mimetype='text/plain')
+
     try:
-        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(paste_id), active_only=True)
+        # Views of password-protected pastes are only counted once the password has been checked below
+        # The contents are only loaded if the client doesn't already have them
+        paste, _ = database.paste.view_paste(
+            util.cryptography.get_decid(paste_id),
+            count_protected=False,
+            include_contents=False,
+        )
 
         password_protection_error = 'In order to view the raw contents of a password-protected paste, ' \
                                     'you must supply the password (in plain text) as a GET parameter in the URL, e.g. ' \
                                     '{example}'.format(example=PasteViewRawInterfaceURI.full_uri(paste_id=paste_id, password='PASTE_PASSWORD_HERE'))
         invalid_password_error = 'The password you supplied for this paste is not correct.'
-        if paste.password_hash and not flask.request.args.get('password'):
-            return flask.Response(password_protection_error, mimetype='text/plain')
-        if paste.password_hash and util.cryptography.secure_hash(flask.request.args.get('password')) != paste.password_hash:
-            return flask.Response(invalid_password_error, mimetype='text/plain')
+        unlock_token = None
+        # An unlock token issued when the password was last supplied is checked first, as it is much cheaper to check
+        if paste.password_hash and not database.paste.check_paste_unlock_token(
+            paste,
+            util.paste_unlock.get_request_token(paste.paste_id, flask.request.args.get(util.paste_unlock.TOKEN_PARAMETER)),
+        ):
+            if not flask.request.args.get('password'):
+                return flask.Response(password_protection_error, mimetype='text/plain')
+            if not database.paste.check_paste_password(paste, flask.request.args.get('password')):
+                return flask.Response(invalid_password_error, mimetype='text/plain')
+            unlock_token = database.paste.get_paste_unlock_token(paste)
 
-        database.paste.increment_paste_views(util.cryptography.get_decid(paste_id))
-        return flask.Response(paste.contents, mimetype='text/plain')
+        if paste.password_hash:
+            database.paste.record_paste_view(paste.paste_id, views=paste.views)
+        return util.paste_unlock.set_response_token(_conditional_response(
+            # Identical contents are identical representations, whichever paste they belong to
+            etag=paste.content_hash or '{paste_id}-{post_time}'.format(paste_id=paste.paste_id, post_time=paste.post_time),
+            last_modified=paste.post_time,
+            make_response=raw_response,
+            is_private=paste.password_hash is not None,
+        ), paste.paste_id, unlock_token)
     except (PasteDoesNotExistException, InvalidIDException):
         return flask.Response('This paste either does not exist or has been deleted.', mimetype='text/plain')
+    except PasswordHashingOverloadedException:
+        return flask.Response(
+            'The server is handling too many passwords at the moment. Please try again later.',
+            status=503,
+            mimetype='text/plain',
+        )
 
 
 @app.route(PasteAttachmentURI.path, methods=['GET'])
@@ -83,20 +124,101 @@ def paste_attachment(paste_id, file_name):
     :param paste_id: ID of the paste associated with this attachment
     :param file_name: File name of the attachment
     """
+    def attachment_response(range_header):
+        file_path, is_raw = database.attachment.get_attachment_file(attachment)
+        storage = database.attachment.get_storage_backend()
+        blob_key = database.attachment.get_blob_key(attachment.content_hash, attachment.content_encoding)
+        if attachment.content_encoding is not None and not is_encoding_accepted:
+            # The attachment is decompressed on the fly, so its size is unknown and byte ranges can't be served
+            resp = flask.Response(
+                util.compression.iter_gunzip_file(
+                    (lambda: open(file_path, 'rb')) if file_path is not None else (lambda: storage.open(blob_key)),
+                ),
+                content_type=attachment.mime_type,
+                direct_passthrough=True,
+            )
+            resp.accept_ranges = 'none'
+            return resp
+        if file_path is None:
+            # The blob is stored by a remote storage backend
+            redirect_url = storage.redirect_url(blob_key, attachment.mime_type, attachment.content_encoding)
+            if redirect_url is not None:
+                return flask.redirect(redirect_url)
+            # The recorded size of attachments submitted as JSON is reported by the client
+            complete_length = storage.size(blob_key)
+            resp = _byte_range_response(
+                range_header=range_header,
+                open_file=lambda: storage.open(blob_key),
+                complete_length=complete_length,
+                content_type=attachment.mime_type,
+            )
+            if resp is None:
+                resp = flask.Response(
+                    util.ranges.iter_file_range(lambda: storage.open(blob_key), 0, complete_length),
+                    direct_passthrough=True,
+                )
+                resp.content_length = complete_length
+        elif not is_raw:
+            # Attachments that have not been decoded yet can only be served from memory
+            with open(file_path) as attachment_file:
+                attachment_data = base64.b64decode(attachment_file.read())
+            resp = _byte_range_response(
+                range_header=range_header,
+                open_file=lambda: io.BytesIO(attachment_data),
+                complete_length=len(attachment_data),
+                content_type=attachment.mime_type,
+            ) or flask.make_response(attachment_data)
+        elif config.ATTACHMENTS_SENDFILE_HEADER == 'X-Sendfile':
+            # The web server answers range requests itself
+            resp = flask.make_response('')
+            resp.headers['X-Sendfile'] = os.path.abspath(file_path)
+        elif config.ATTACHMENTS_SENDFILE_HEADER == 'X-Accel-Redirect':
+            resp = flask.make_response('')
+            resp.headers['X-Accel-Redirect'] = '{prefix}/{file_path}'.format(
+                prefix=config.ATTACHMENTS_ACCEL_REDIRECT_PREFIX.rstrip('/'),
+                file_path=os.path.relpath(file_path, config.ATTACHMENTS_DIR),
+            )
+        else:
+            resp = None
+            if range_header is not None:
+                resp = _byte_range_response(
+                    range_header=range_header,
+                    open_file=lambda: open(file_path, 'rb'),
+                    complete_length=os.path.getsize(file_path),
+                    content_type=attachment.mime_type,
+                )
+            if resp is None:
+                resp = flask.send_file(file_path, mimetype=attachment.mime_type, conditional=False, etag=False, max_age=None)
+        if resp.status_code == 200:
+            resp.headers['Content-Type'] = attachment.mime_type
+        if attachment.content_encoding is not None and resp.status_code in (200, 206):
+            # Byte ranges of compressed attachments are ranges of their compressed data
+            resp.content_encoding = attachment.content_encoding
+        return resp
+
     try:
-        attachment = database.attachment.get_attachment_by_name(
+        attachment, post_time = database.attachment.get_attachment_and_post_time_by_name(
             paste_id=util.cryptography.get_decid(paste_id),
             file_name=file_name,
             active_only=True,
         )
-        file_path = '{attachments_dir}/{paste_id}/{hash_name}'.format(
-            attachments_dir=config.ATTACHMENTS_DIR,
-            paste_id=util.cryptography.get_decid(paste_id),
-            hash_name=attachment.hash_name,
+        etag = attachment.content_hash or '{paste_id}-{attachment_id}'.format(
+            paste_id=attachment.paste_id,
+            attachment_id=attachment.attachment_id,
+        )
+        is_encoding_accepted = False
+        if attachment.content_encoding is not None:
+            # The compressed and decompressed representations of the attachment are distinct resources
+            is_encoding_accepted = flask.request.accept_encodings[attachment.content_encoding] > 0
+            if is_encoding_accepted:
+                etag += '-' + attachment.content_encoding
+        # Attachments are never modified once they have been uploaded along with their paste
+        return _conditional_response(
+            etag=etag,
+            last_modified=post_time,
+            make_response=attachment_response,
+            vary_encoding=attachment.content_encoding is not None,
         )
-        resp = flask.make_response(base64.b64decode(open(file_path).read()))
-        resp.headers['Content-Type'] = attachment.mime_type
-        return resp
     except (PasteDoesNotExistException, InvalidIDException):
         return 'No paste with the given ID could be found. ' \
                'It\'s also possible that the paste has been deactivated or has expired.', 404
@@ -106,6 +228,89 @@ def paste_attachment(paste_id, file_name):
         return 'Undefined error. Please open an issue at https://github.com/LINKIWI/modern-paste/issues', 500
 
 
+def _conditional_response(etag, last_modified, make_response, is_private=False, vary_encoding=False):
+    """
+    Respond to a GET request for an immutable resource, answering conditional requests with 304 Not Modified if the
+    client's copy of the resource is still current. Caches must always revalidate their copy, so that deactivated
+    pastes are no longer served. Byte ranges of the resource are only requested from make_response if the client's
+    partial copy is of the current resource, per the request's If-Range header.
+
+    :param etag: Strong entity tag of the resource
+    :param last_modified: UNIX timestamp at which the resource was created
+    :param make_response: Function returning the response, only called if the client's copy is not current; it is
+                          passed the request's Range header, or None if the full resource must be sent
+    :param is_private: True if the resource must not be stored by shared caches
+    :param vary_encoding: True if the resource is represented differently depending on the request's Accept-Encoding
+                          header
+    :return: A flask.Response, with validators for the resource
+    """
+    last_modified = datetime.datetime.fromtimestamp(last_modified, tz=datetime.timezone.utc)
+    if is_resource_modified(flask.request.environ, etag=etag, last_modified=last_modified):
+        range_header = flask.request.headers.get('Range')
+        if not util.ranges.if_range_matches(flask.request.headers.get('If-Range'), etag, last_modified):
+            range_header = None
+        resp = make_response(range_header)
+    else:
+        resp = flask.Response(status=304)
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    if resp.accept_ranges is None:
+        resp.accept_ranges = 'bytes'
+    if vary_encoding:
+        resp.vary.add('Accept-Encoding')
+    resp.cache_control.no_cache = True
+    if is_private:
+        resp.cache_control.private = True
+    else:
+        resp.cache_control.public = True
+    return resp
+
+
+def _byte_range_response(range_header, open_file, complete_length, content_type):
+    """
+    Respond with the byte ranges of a resource requested by a Range header, reading only the requested ranges from the
+    resource's file. Several ranges are sent as a multipart/byteranges body.
+
+    :param range_header: Value of the request's Range header, or None if the full resource must be sent
+    :param open_file: Function opening the resource as a binary file object, only called as the response is sent
+    :param complete_length: Size of the resource in bytes
+    :param content_type: Content type of the resource
+    :return: A 206 Partial Content or 416 Range Not Satisfiable flask.Response, or None if the full resource should be
+             sent instead
+    """
+    if range_header is None:
+        return None
+    try:
+        ranges = util.ranges.parse_byte_ranges(range_header, complete_length)
+    except RangeNotSatisfiableException:
+        resp = flask.Response(status=416)
+        resp.headers['Content-Range'] = 'bytes */{complete_length}'.format(complete_length=complete_length)
+        return resp
+    if ranges is None:
+        return None
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        resp = flask.Response(
+            util.ranges.iter_file_range(open_file, start, stop),
+            status=206,
+            content_type=content_type,
+            direct_passthrough=True,
+        )
+        resp.headers['Content-Range'] = util.ranges.content_range(start, stop, complete_length)
+        resp.content_length = stop - start
+    else:
+        boundary, length, body = util.ranges.iter_multipart_byteranges(open_file, ranges, complete_length, content_type)
+        resp = flask.Response(
+            body,
+            status=206,
+            content_type='multipart/byteranges; boundary={boundary}'.format(boundary=boundary),
+            direct_passthrough=True,
+        )
+        resp.content_length = length
+    return resp
+
+
 @app.route(PasteArchiveInterfaceURI.path, methods=['GET'])
 @render_view
 def paste_archive():
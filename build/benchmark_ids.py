@@ -0,0 +1,119 @@
+"""
+This script measures the cost per ID of encrypting and decrypting paste IDs: as earlier versions did, setting up a
+cipher for every ID, and with the ID codecs of util.cryptography for each scheme of encrypted IDs, for IDs that are not
+memoized yet, for memoized IDs, and for lists of IDs encrypted together.
+"""
+
+import argparse
+import base64
+import timeit
+
+from Crypto.Cipher import AES
+
+import config
+import util.cryptography
+
+
+def legacy_get_encid(decid):
+    cipher = AES.new(config.ID_ENCRYPTION_KEY.encode(), AES.MODE_CBC, config.ID_ENCRYPTION_IV.encode())
+    return base64.b64encode(
+        cipher.encrypt(util.cryptography._pad(str(decid)).encode()),
+        util.cryptography.ALTCHARS,
+    ).rstrip(b'=').decode()
+
+
+def legacy_get_decid(encid):
+    cipher = AES.new(config.ID_ENCRYPTION_KEY.encode(), AES.MODE_CBC, config.ID_ENCRYPTION_IV.encode())
+    return int(cipher.decrypt(util.cryptography._base64_decode(encid)).rstrip(util.cryptography.PADDING_CHAR.encode()))
+
+
+CODECS = [
+    ('aes', lambda: util.cryptography.AESIDCodec(config.ID_ENCRYPTION_KEY.encode(), config.ID_ENCRYPTION_IV.encode())),
+    ('permutation', lambda: util.cryptography.PermutationIDCodec(config.ID_ENCRYPTION_KEY.encode())),
+]
+
+
+def per_id_cost(function, num_ids, repeat):
+    """
+    :return: The best time, in microseconds per ID, of calling the function, which processes num_ids IDs per call
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat)) / num_ids * 1e6
+
+
+def fresh_codec_cost(new_codec, method_name, run, num_ids, repeat):
+    """
+    :return: The best time, in microseconds per ID, of a run with a new codec, so that no ID is memoized yet
+    """
+    timings = []
+    for _ in range(repeat):
+        method = getattr(new_codec(), method_name)
+        timings.append(timeit.timeit(lambda: run(method), number=1))
+    return min(timings) / num_ids * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ids', help='Number of IDs per run', type=int, default=1000)
+    parser.add_argument('--batch-size', help='Number of IDs per list, like a page of pastes', type=int, default=100)
+    parser.add_argument('--repeat', help='Number of runs, of which the fastest is reported', type=int, default=20)
+    args = parser.parse_args()
+
+    decids = list(range(1, args.ids + 1))
+    legacy_encids = [legacy_get_encid(decid) for decid in decids]
+    assert CODECS[0][1]().encode_many(decids) == legacy_encids
+
+    results = [
+        ('encrypt', 'per-call AES cipher (before)', per_id_cost(
+            lambda: [legacy_get_encid(decid) for decid in decids],
+            len(decids),
+            args.repeat,
+        )),
+        ('decrypt', 'per-call AES cipher (before)', per_id_cost(
+            lambda: [legacy_get_decid(encid) for encid in legacy_encids],
+            len(decids),
+            args.repeat,
+        )),
+    ]
+    for scheme, new_codec in CODECS:
+        encids = new_codec().encode_many(decids)
+        for operation, ids, method_name, many_method_name in [
+            ('encrypt', decids, 'encode', 'encode_many'),
+            ('decrypt', encids, 'decode', 'decode_many'),
+        ]:
+            results.append((operation, '{scheme}, not memoized'.format(scheme=scheme), fresh_codec_cost(
+                new_codec,
+                method_name,
+                lambda method: [method(raw_id) for raw_id in ids],
+                len(ids),
+                args.repeat,
+            )))
+
+            method = getattr(new_codec(), method_name)
+            results.append((operation, '{scheme}, memoized'.format(scheme=scheme), per_id_cost(
+                lambda: [method(raw_id) for raw_id in ids],
+                len(ids),
+                args.repeat,
+            )))
+
+            results.append((
+                operation,
+                '{scheme}, lists of {batch_size}, not memoized'.format(scheme=scheme, batch_size=args.batch_size),
+                fresh_codec_cost(
+                    new_codec,
+                    many_method_name,
+                    lambda many_method: [
+                        many_method(ids[start:start + args.batch_size])
+                        for start in range(0, len(ids), args.batch_size)
+                    ],
+                    len(ids),
+                    args.repeat,
+                ),
+            ))
+        print('{scheme} encrypted IDs are {length} characters long, e.g. {encid}'.format(
+            scheme=scheme,
+            length=len(encids[-1]),
+            encid=encids[-1],
+        ))
+
+    for operation, variant, cost in sorted(results, key=lambda result: result[0]):
+        print('{operation:<8} {variant:<48} {cost:8.2f} us/ID'.format(operation=operation, variant=variant, cost=cost))
@@ -0,0 +1,86 @@
+"""
+This script measures the cost per hash of hashing passwords: as earlier versions did, with the unsalted, iterated
+SHA-256 hash of util.cryptography.secure_hash, and with the password hashers of util.cryptography for several
+parameters. The strength of the iterated SHA-256 hashes is reported as the number of invocations of the SHA-256
+compression function per password guess, which is what an attacker pays for each guess; scrypt is memory-hard, so its
+strength isn't comparable by that measure, and its memory cost is reported instead.
+"""
+
+import argparse
+import timeit
+
+from Crypto.Hash import SHA256
+
+import config
+import util.cryptography
+
+
+def legacy_secure_hash(s, iterations=10000):
+    hash_result = SHA256.new(data=str(s).encode()).hexdigest()
+    for i in range(iterations):
+        hash_result = SHA256.new(data=hash_result.encode()).hexdigest()
+    return hash_result
+
+
+def legacy_compressions(iterations=10000):
+    # Each iteration hashes a 64-character hex digest, which takes two 64-byte blocks with padding
+    return 2 * (iterations + 1)
+
+
+def pbkdf2_compressions(iterations):
+    # Each iteration computes one HMAC of a 32-byte message, with the inner and outer keys' blocks precomputed
+    return 2 * iterations
+
+
+HASHERS = [
+    ('pbkdf2_sha256, {iterations} iterations'.format(iterations=iterations),
+     util.cryptography.PBKDF2PasswordHasher(iterations),
+     '{compressions} SHA-256 compressions'.format(compressions=pbkdf2_compressions(iterations)))
+    for iterations in sorted({10000, 100000, 200000, 600000, config.PASSWORD_PBKDF2_ITERATIONS})
+] + [
+    ('scrypt, n={n}, r={r}, p={p}'.format(n=n, r=r, p=p),
+     util.cryptography.ScryptPasswordHasher(n, r, p),
+     '{memory} MiB of memory'.format(memory=128 * r * n // 2 ** 20))
+    for n, r, p in sorted({
+        (2 ** 14, 8, 1),
+        (2 ** 15, 8, 1),
+        (config.PASSWORD_SCRYPT_N, config.PASSWORD_SCRYPT_R, config.PASSWORD_SCRYPT_P),
+    })
+]
+
+
+def per_hash_cost(function, repeat):
+    """
+    :return: The best time, in milliseconds, of calling the function, which hashes one password
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', help='Number of hashes, of which the fastest is reported', type=int, default=10)
+    args = parser.parse_args()
+
+    password = 'correct horse battery staple'
+    assert legacy_secure_hash(password) == util.cryptography.secure_hash(password)
+
+    results = [
+        ('iterated SHA-256, pycryptodome (before)', per_hash_cost(lambda: legacy_secure_hash(password), args.repeat),
+         '{compressions} SHA-256 compressions'.format(compressions=legacy_compressions())),
+        ('iterated SHA-256, hashlib (legacy hashes)', per_hash_cost(
+            lambda: util.cryptography.secure_hash(password),
+            args.repeat,
+        ), '{compressions} SHA-256 compressions'.format(compressions=legacy_compressions())),
+    ]
+    for variant, hasher, strength in HASHERS:
+        password_hash = hasher.hash(password)
+        assert util.cryptography.verify_password(password, password_hash)
+        results.append((variant, per_hash_cost(lambda: hasher.hash(password), args.repeat), strength))
+
+    hasher = util.cryptography.get_password_hasher()
+    print('Passwords are hashed with {algorithm}, parameters {parameters}'.format(
+        algorithm=hasher.algorithm,
+        parameters=hasher.parameters,
+    ))
+    for variant, cost, strength in results:
+        print('{variant:<48} {cost:8.2f} ms/hash   {strength}'.format(variant=variant, cost=cost, strength=strength))
@@ -12,13 +12,20 @@ if __name__ == '__main__':
     parser.add_argument('--drop', help='Drop the database and all tables', action='store_true')
     args = parser.parse_args()
 
+    import config
+    import database.paste
+    from modern_paste import app
     from modern_paste import db
     if args.create and args.drop:
         print('Requested action ambiguous; exiting')
         sys.exit(1)
     elif args.create:
         print('Creating database and all tables')
-        db.create_all()
+        with app.app_context():
+            db.create_all()
+            if config.TOP_PASTES_LEADERBOARD_SIZE > 0:
+                database.paste.rebuild_top_pastes()
+                print('Top pastes leaderboard built')
     elif args.drop:
         print('Dropping database and all tables')
         db.drop_all()
@@ -0,0 +1,23 @@
+"""
+This script converts the stored contents of existing pastes in the database specified by config.BUILD_ENVIRONMENT to
+match the current storage configuration: the contents of pastes created before contents were deduplicated are moved
+into the shared, deduplicated storage, and contents are (de)compressed according to the current compression settings.
+Contents are converted in batches, each in its own short transaction, while the app keeps serving requests. Running it
+again after it completes, or after it is interrupted, only converts what is left.
+"""
+
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', help='Number of pastes or contents to convert per transaction', type=int, default=100)
+    args = parser.parse_args()
+
+    # The app is loaded first, so that its modules are imported in order
+    from modern_paste import app
+    import database.paste
+
+    with app.app_context():
+        num_converted = database.paste.convert_paste_contents(batch_size=args.batch_size)
+    print('Converted {num_converted} pastes and paste contents'.format(num_converted=num_converted))
@@ -0,0 +1,49 @@
+"""
+This script migrates the attachment files in config.ATTACHMENTS_DIR that were stored by earlier versions: it moves blobs
+and per-paste attachment directories stored directly in their parent directory to the sharded layout, and decodes the
+attachment files that were stored base64-encoded, so that they can be served as is. Files are migrated in place, one at
+a time, while the app keeps serving them.
+"""
+
+import sys
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', help='Report attachment files that need to be migrated without migrating them', action='store_true')
+    parser.add_argument('--migrate', help='Move all attachment files to the sharded layout and decode all base64-encoded attachment files', action='store_true')
+    args = parser.parse_args()
+
+    # The app is loaded first, so that its modules are imported in order
+    from modern_paste import app  # noqa: F401
+    import database.attachment
+    if args.check and args.migrate:
+        print('Requested action ambiguous; exiting')
+        sys.exit(1)
+    elif args.check:
+        unsharded_paths = database.attachment.find_unsharded_attachment_paths()
+        for path in unsharded_paths:
+            print('Unsharded attachment path {path}'.format(path=path))
+        encoded_file_paths = database.attachment.find_encoded_attachment_files()
+        for file_path in encoded_file_paths:
+            print('Encoded attachment file {file_path}'.format(file_path=file_path))
+        if unsharded_paths or encoded_file_paths:
+            print('Run this script with the --migrate flag to move {num_paths} attachment paths and decode {num_files} attachment files'.format(
+                num_paths=len(unsharded_paths),
+                num_files=len(encoded_file_paths),
+            ))
+            sys.exit(2)
+        print('All attachment files are migrated')
+    elif args.migrate:
+        moved_paths = database.attachment.shard_attachment_paths()
+        print('Moved {num_paths} attachment paths to the sharded layout'.format(num_paths=len(moved_paths)))
+        converted_file_paths, invalid_file_paths = database.attachment.convert_attachment_files()
+        for file_path in invalid_file_paths:
+            print('Could not decode attachment file {file_path}; leaving it as is'.format(file_path=file_path))
+        print('Decoded {num_files} attachment files'.format(num_files=len(converted_file_paths)))
+        if invalid_file_paths:
+            sys.exit(2)
+    else:
+        print('Call this script with either the --check or --migrate flag to report or migrate attachment files, respectively')
+        sys.exit(1)
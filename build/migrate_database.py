@@ -0,0 +1,55 @@
+"""
+This script migrates the tables in the existing database, as specified by config.BUILD_ENVIRONMENT, to the current
+schema by adding all missing tables, columns, and indexes. No tables, columns, indexes, or data are ever dropped. Once
+migrated, the top pastes leaderboard is rebuilt from the current views of all pastes.
+"""
+
+import sys
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', help='Report missing tables, columns, and indexes without migrating', action='store_true')
+    parser.add_argument('--migrate', help='Add all missing tables, columns, and indexes', action='store_true')
+    args = parser.parse_args()
+
+    import config
+    import database.paste
+    import database.schema
+    from modern_paste import app
+    if args.check and args.migrate:
+        print('Requested action ambiguous; exiting')
+        sys.exit(1)
+    elif args.check or args.migrate:
+        with app.app_context():
+            missing = database.schema.get_missing_schema()
+            for table in missing['tables']:
+                print('Missing table {table}'.format(table=table.name))
+            for column in missing['columns']:
+                print('Missing column {column} in table {table}'.format(column=column.name, table=column.table.name))
+            for index in missing['indexes']:
+                print('Missing index {index} on table {table} ({columns})'.format(
+                    index=index.name,
+                    table=index.table.name,
+                    columns=', '.join(column.name for column in index.columns),
+                ))
+            statements = database.schema.get_migration_statements(missing)
+            if not statements:
+                print('Database schema is up to date')
+            elif args.check:
+                print('Run this script with the --migrate flag to execute the following statements:')
+                for statement in statements:
+                    print('{statement};'.format(statement=statement))
+                sys.exit(2)
+            else:
+                for statement in statements:
+                    print('Executing: {statement}'.format(statement=statement))
+                    database.schema.migrate_schema([statement])
+                print('Database schema migrated')
+            if args.migrate and config.TOP_PASTES_LEADERBOARD_SIZE > 0:
+                database.paste.rebuild_top_pastes()
+                print('Top pastes leaderboard rebuilt')
+    else:
+        print('Call this script with either the --check or --migrate flag to report or add missing schema, respectively')
+        sys.exit(1)
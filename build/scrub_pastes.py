@@ -0,0 +1,67 @@
+"""
+This script deletes all inactive and expired pastes, along with their attachments, from the database specified by
+config.BUILD_ENVIRONMENT. Pastes are deleted in batches, each in its own short transaction, while the app keeps serving
+requests. With --checkpoint, the progress is recorded in a file after each batch, so that an interrupted run resumes
+where it stopped; the file is removed once a run completes.
+"""
+
+import argparse
+import json
+import os
+
+
+def read_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)['last_paste_id']
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(checkpoint_path, last_paste_id):
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'w') as checkpoint_file:
+        json.dump({'last_paste_id': last_paste_id}, checkpoint_file)
+    os.replace(temp_path, checkpoint_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', help='Report the number of pastes that would be deleted without deleting them', action='store_true')
+    parser.add_argument('--batch-size', help='Maximum number of pastes to delete per transaction', type=int)
+    parser.add_argument('--max-rate', help='Maximum number of pastes to delete per second', type=float)
+    parser.add_argument('--threads', help='Number of threads removing attachment files', type=int)
+    parser.add_argument('--checkpoint', help='File recording the progress, from which to resume an interrupted run')
+    args = parser.parse_args()
+
+    # The app is loaded first, so that its modules are imported in order
+    from modern_paste import app
+    import database.paste
+
+    after_paste_id = read_checkpoint(args.checkpoint) if args.checkpoint and not args.dry_run else 0
+    if after_paste_id:
+        print('Resuming after paste ID {paste_id}'.format(paste_id=after_paste_id))
+
+    def on_batch(progress):
+        print('{action} {pastes} pastes, {attachments} attachments, and {blobs} attachment blobs up to paste ID {last_paste_id} ({pastes_per_second:.1f} pastes/s)'.format(
+            action='Would delete' if args.dry_run else 'Deleted',
+            **progress
+        ))
+        if args.checkpoint and not args.dry_run:
+            write_checkpoint(args.checkpoint, progress['last_paste_id'])
+
+    with app.app_context():
+        progress = database.paste.scrub_inactive_pastes(
+            batch_size=args.batch_size or database.paste.SCRUB_BATCH_SIZE,
+            after_paste_id=after_paste_id,
+            max_rate=args.max_rate,
+            dry_run=args.dry_run,
+            file_threads=args.threads or database.paste.SCRUB_FILE_THREADS,
+            on_batch=on_batch,
+        )
+    if args.checkpoint and not args.dry_run and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    print('{action} {pastes} pastes in {batches} batches and {elapsed:.1f} seconds'.format(
+        action='Would delete' if args.dry_run else 'Deleted',
+        **progress
+    ))
@@ -1,8 +1,12 @@
 import json
 
+import mock
+
 import constants.api
+import util.hashing
 import util.testing
 from uri.authentication import *
+from util.exception import *
 
 
 class TestAuthentication(util.testing.DatabaseTestCase):
@@ -108,3 +112,17 @@ class TestAuthentication(util.testing.DatabaseTestCase):
                 }
             },
         )
+
+    def test_login_user_hashing_overloaded(self):
+        util.testing.UserFactory.generate(username='username', password='password')
+        with mock.patch.object(util.hashing, 'run', side_effect=PasswordHashingOverloadedException):
+            resp = self.client.post(
+                LoginUserURI.uri(),
+                data=json.dumps({
+                    'username': 'username',
+                    'password': 'password',
+                }),
+                content_type='application/json',
+            )
+        self.assertEqual(resp.status_code, constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE)
+        self.assertEqual(json.loads(resp.data), constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE)
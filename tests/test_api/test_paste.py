@@ -1,7 +1,12 @@
 # coding=utf-8
 
+import hashlib
+import io
 import json
+import os
 import random
+import shutil
+import tempfile
 import time
 
 import mock
@@ -17,6 +22,7 @@ import util.testing
 from uri.authentication import *
 from uri.main import *
 from uri.paste import *
+from util.exception import *
 
 
 class TestPaste(util.testing.DatabaseTestCase):
@@ -30,6 +36,20 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual(resp.status_code, constants.api.INCOMPLETE_PARAMS_FAILURE_CODE)
         self.assertEqual(json.loads(resp.data), constants.api.INCOMPLETE_PARAMS_FAILURE)
 
+    def test_submit_paste_hashing_overloaded(self):
+        with mock.patch.object(util.cryptography, 'hash_password', side_effect=PasswordHashingOverloadedException):
+            resp = self.client.post(
+                PasteSubmitURI.uri(),
+                data=json.dumps({
+                    'contents': 'paste',
+                    'password': 'password',
+                }),
+                content_type='application/json',
+            )
+        self.assertEqual(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.PASSWORD_HASHING_OVERLOADED_FAILURE, json.loads(resp.data))
+        self.assertEqual([], database.paste.get_recent_pastes(0, 5))
+
     def test_submit_paste_login_required(self):
         # Config requires authentication to post paste
         config.REQUIRE_LOGIN_TO_PASTE = True
@@ -185,7 +205,7 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE, json.loads(resp.data))
 
     def test_submit_paste_with_attachments(self):
-        with mock.patch.object(database.attachment, '_store_attachment_file') as mock_store_attachment_file:
+        with mock.patch.object(database.attachment, '_write_attachment_blob', return_value=('content hash', None, True)) as mock_write_attachment_blob:
             resp = self.client.post(
                 PasteSubmitURI.uri(),
                 data=json.dumps({
@@ -208,7 +228,8 @@ class TestPaste(util.testing.DatabaseTestCase):
                 content_type='application/json',
             )
             self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
-            self.assertEqual(2, mock_store_attachment_file.call_count)
+            # Each blob is written again once it is referenced, since the mocked blobs are not actually stored
+            self.assertEqual(4, mock_write_attachment_blob.call_count)
 
             resp_data = json.loads(resp.data)
             self.assertEqual('file_name', resp_data['attachments'][0]['name'])
@@ -227,7 +248,7 @@ class TestPaste(util.testing.DatabaseTestCase):
             )
 
     def test_submit_paste_invalid_attachments(self):
-        with mock.patch.object(database.attachment, '_store_attachment_file') as mock_store_attachment_file:
+        with mock.patch.object(database.attachment, '_write_attachment_blob', return_value=('content hash', None, True)) as mock_write_attachment_blob:
             resp = self.client.post(
                 PasteSubmitURI.uri(),
                 data=json.dumps({
@@ -241,11 +262,11 @@ class TestPaste(util.testing.DatabaseTestCase):
                 content_type='application/json',
             )
             self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
-            self.assertEqual(1, mock_store_attachment_file.call_count)
+            self.assertEqual(2, mock_write_attachment_blob.call_count)
 
     def test_submit_paste_too_large(self):
         config.MAX_ATTACHMENT_SIZE = 10.0 / (1000 * 1000)  # 10 B
-        with mock.patch.object(database.attachment, '_store_attachment_file'):
+        with mock.patch.object(database.attachment, '_write_attachment_blob', return_value=('content hash', None, True)):
             resp = self.client.post(
                 PasteSubmitURI.uri(),
                 data=json.dumps({
@@ -283,7 +304,7 @@ class TestPaste(util.testing.DatabaseTestCase):
 
     def test_submit_paste_base64_size_threshold(self):
         config.MAX_ATTACHMENT_SIZE = 3.0 / (1000 * 1000)  # 3 B
-        with mock.patch.object(database.attachment, '_store_attachment_file'):
+        with mock.patch.object(database.attachment, '_write_attachment_blob', return_value=('content hash', None, True)):
             resp = self.client.post(
                 PasteSubmitURI.uri(),
                 data=json.dumps({
@@ -320,7 +341,7 @@ class TestPaste(util.testing.DatabaseTestCase):
             self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
 
     def test_submit_paste_server_error(self):
-        with mock.patch.object(database.paste, 'create_new_paste', side_effect=SQLAlchemyError):
+        with mock.patch.object(database.paste, 'create_new_paste_with_attachments', side_effect=SQLAlchemyError):
             resp = self.client.post(
                 PasteSubmitURI.uri(),
                 data=json.dumps({
@@ -331,6 +352,198 @@ class TestPaste(util.testing.DatabaseTestCase):
             self.assertEqual(resp.status_code, constants.api.UNDEFINED_FAILURE_CODE)
             self.assertEqual(json.loads(resp.data), constants.api.UNDEFINED_FAILURE)
 
+    def test_upload_paste_attachment_raw(self):
+        paste = util.testing.PasteFactory.generate()
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(
+                    paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                    deactivation_token=paste.deactivation_token,
+                    file_name='file name',
+                ),
+                data=b'\x00attachment data\xff',
+                content_type='image/png',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            resp_data = json.loads(resp.data)
+            self.assertEqual([{
+                'paste_id_repr': util.cryptography.get_id_repr(paste.paste_id),
+                'file_name': 'file_name',
+                'file_size': 17,
+                'mime_type': 'image/png',
+                'sha256': hashlib.sha256(b'\x00attachment data\xff').hexdigest(),
+            }], resp_data['attachments'])
+
+            attachment = database.attachment.get_attachment_by_name(paste.paste_id, 'file_name')
+            self.assertEqual(17, attachment.file_size)
+            file_path, is_raw = database.attachment.get_attachment_file(attachment)
+            self.assertTrue(is_raw)
+            with open(file_path, 'rb') as attachment_file:
+                self.assertEqual(b'\x00attachment data\xff', attachment_file.read())
+            # No temporary files are left behind
+            self.assertEqual([os.path.basename(file_path)], os.listdir(os.path.dirname(file_path)))
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_upload_paste_attachment_multipart(self):
+        user = util.testing.UserFactory.generate()
+        paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(
+                    paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                    api_key=user.api_key,
+                ),
+                data={
+                    'field': 'ignored',
+                    'file': [
+                        (io.BytesIO(b'first file'), 'first.txt', 'text/plain'),
+                        (io.BytesIO(b'second file'), 'second.png', 'image/png'),
+                    ],
+                },
+                content_type='multipart/form-data',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            resp_data = json.loads(resp.data)
+            self.assertEqual(
+                [('first.txt', 10, 'text/plain'), ('second.png', 11, 'image/png')],
+                [(attachment['file_name'], attachment['file_size'], attachment['mime_type']) for attachment in resp_data['attachments']],
+            )
+            file_path, _ = database.attachment.get_attachment_file(
+                database.attachment.get_attachment_by_name(paste.paste_id, 'second.png'),
+            )
+            with open(file_path, 'rb') as attachment_file:
+                self.assertEqual(b'second file', attachment_file.read())
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_upload_paste_attachment_too_large(self):
+        config.MAX_ATTACHMENT_SIZE = 10.0 / (1000 * 1000)  # 10 B
+        paste = util.testing.PasteFactory.generate()
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            # Rejected by its Content-Length, before it is read
+            with mock.patch.object(database.attachment, 'create_new_attachments_from_stream') as mock_create:
+                resp = self.client.post(
+                    PasteAttachmentUploadURI.uri(
+                        paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                        deactivation_token=paste.deactivation_token,
+                        file_name='file',
+                    ),
+                    data=b'x' * 11,
+                    content_type='image/png',
+                )
+                self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE, resp.status_code)
+                self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE, json.loads(resp.data))
+                self.assertEqual(0, mock_create.call_count)
+
+            # Rejected as soon as too much of it has been read, along with the attachments preceding it
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(
+                    paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                    deactivation_token=paste.deactivation_token,
+                ),
+                data={'file': [
+                    (io.BytesIO(b'x' * 10), 'preceding', 'image/png'),
+                    (io.BytesIO(b'x' * 11), 'file', 'image/png'),
+                ]},
+                content_type='multipart/form-data',
+            )
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE, resp.status_code)
+            self.assertEqual([], database.attachment.get_attachments_for_paste(paste.paste_id))
+            self.assertEqual([], os.listdir(os.path.join(config.ATTACHMENTS_DIR, 'blobs')))
+
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(
+                    paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                    deactivation_token=paste.deactivation_token,
+                    file_name='file',
+                ),
+                data=b'x' * 10,
+                content_type='image/png',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_upload_paste_attachment_upload_too_large(self):
+        config.MAX_ATTACHMENT_UPLOAD_SIZE = 300.0 / (1000 * 1000)  # 300 B
+        paste = util.testing.PasteFactory.generate()
+        uri = PasteAttachmentUploadURI.uri(
+            paste_id=util.cryptography.get_id_repr(paste.paste_id),
+            deactivation_token=paste.deactivation_token,
+        )
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            # Rejected by its Content-Length, before it is read
+            with mock.patch.object(database.attachment, 'create_new_attachments_from_stream') as mock_create:
+                resp = self.client.post(
+                    uri,
+                    data={'file': (io.BytesIO(b'x' * 301), 'file', 'image/png')},
+                    content_type='multipart/form-data',
+                )
+                self.assertEqual(constants.api.PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE_CODE, resp.status_code)
+                self.assertEqual(constants.api.PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE, json.loads(resp.data))
+                self.assertEqual(0, mock_create.call_count)
+
+            # Rejected as soon as too much of it has been read, if its length is not known up front, along with the
+            # attachments preceding it
+            body = (
+                b'--boundary\r\n'
+                b'Content-Disposition: form-data; name="file"; filename="first"\r\n'
+                b'\r\n'
+                b'first data\r\n'
+                b'--boundary\r\n'
+                b'Content-Disposition: form-data; name="file"; filename="second"\r\n'
+                b'\r\n' + b'x' * 300 + b'\r\n'
+                b'--boundary--\r\n'
+            )
+            resp = self.client.post(
+                uri,
+                input_stream=io.BytesIO(body),
+                content_type='multipart/form-data; boundary=boundary',
+                headers={'Transfer-Encoding': 'chunked'},
+                environ_overrides={'wsgi.input_terminated': True},
+            )
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_UPLOAD_TOO_LARGE_FAILURE_CODE, resp.status_code)
+            self.assertEqual([], database.attachment.get_attachments_for_paste(paste.paste_id))
+            self.assertEqual([], util.testing.list_blob_files())
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_upload_paste_attachment_invalid(self):
+        paste = util.testing.PasteFactory.generate()
+        paste_id = util.cryptography.get_id_repr(paste.paste_id)
+        with mock.patch.object(database.attachment, 'create_new_attachments_from_stream') as mock_create:
+            # Missing parameters
+            for uri in [
+                PasteAttachmentUploadURI.uri(file_name='file'),
+                PasteAttachmentUploadURI.uri(paste_id=paste_id, deactivation_token=paste.deactivation_token),
+            ]:
+                resp = self.client.post(uri, data=b'data', content_type='image/png')
+                self.assertEqual(constants.api.INCOMPLETE_PARAMS_FAILURE_CODE, resp.status_code)
+
+            # Nonexistent paste
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(paste_id=-1, file_name='file'),
+                data=b'data',
+                content_type='image/png',
+            )
+            self.assertEqual(constants.api.NONEXISTENT_PASTE_FAILURE_CODE, resp.status_code)
+
+            # Invalid deactivation token or API key
+            for uri in [
+                PasteAttachmentUploadURI.uri(paste_id=paste_id, file_name='file'),
+                PasteAttachmentUploadURI.uri(paste_id=paste_id, file_name='file', deactivation_token='invalid'),
+                PasteAttachmentUploadURI.uri(paste_id=paste_id, file_name='file', api_key='invalid'),
+            ]:
+                resp = self.client.post(uri, data=b'data', content_type='image/png')
+                self.assertEqual(constants.api.AUTH_FAILURE_CODE, resp.status_code)
+
+            # Attachments disabled
+            config.ENABLE_PASTE_ATTACHMENTS = False
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(paste_id=paste_id, file_name='file', deactivation_token=paste.deactivation_token),
+                data=b'data',
+                content_type='image/png',
+            )
+            self.assertEqual(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE_CODE, resp.status_code)
+            self.assertEqual(0, mock_create.call_count)
+
     def test_deactivate_paste_invalid(self):
         resp = self.client.post(
             PasteDeactivateURI.uri(),
@@ -642,6 +855,54 @@ class TestPaste(util.testing.DatabaseTestCase):
         paste_details['attachments'] = []
         self.assertEqual(paste_details, json.loads(resp.data)['details'])
 
+    def test_paste_details_unlock_token(self):
+        paste = util.testing.PasteFactory.generate(password='password', user_id=None)
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                'password': 'password',
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(resp.status_code, constants.api.SUCCESS_CODE)
+        token = json.loads(resp.data)['unlock_token']
+        self.assertEqual(token, resp.headers['X-Paste-Unlock-Token'])
+
+        # The token is accepted in place of the password, as the cookie set by the response or a parameter
+        with mock.patch.object(util.cryptography, 'verify_password') as mock_verify_password:
+            resp = self.client.post(
+                PasteDetailsURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(resp.status_code, constants.api.SUCCESS_CODE)
+            # A client without the cookie
+            resp = self.client.application.test_client().post(
+                PasteDetailsURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                    'unlock_token': token,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(resp.status_code, constants.api.SUCCESS_CODE)
+            self.assertFalse(mock_verify_password.called)
+
+        # Changing the password invalidates the token
+        database.paste.set_paste_password(paste.paste_id, 'password')
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                'unlock_token': token,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(resp.status_code, constants.api.AUTH_FAILURE_CODE)
+
     def test_paste_details_anonymous(self):
         paste = util.testing.PasteFactory.generate(password=None, user_id=None)
         resp = self.client.post(
@@ -757,7 +1018,7 @@ class TestPaste(util.testing.DatabaseTestCase):
     def test_pastes_for_user_no_inactive(self):
         user = util.testing.UserFactory.generate(username='username', password='password')
         self.api_login_user('username', 'password')
-        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id).as_dict() for i in range(10)]
+        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id).as_dict(include_contents=False) for i in range(10)]
         [database.paste.deactivate_paste(util.cryptography.get_decid(paste['paste_id_repr'], force=True)) for paste in pastes]
         resp = self.client.post(
             PastesForUserURI.uri(),
@@ -770,7 +1031,7 @@ class TestPaste(util.testing.DatabaseTestCase):
     def test_pastes_for_user_valid(self):
         user = util.testing.UserFactory.generate(username='username', password='password')
         self.api_login_user('username', 'password')
-        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id).as_dict() for i in range(10)]
+        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id).as_dict(include_contents=False) for i in range(10)]
         resp = self.client.post(
             PastesForUserURI.uri(),
             data=json.dumps({}),
@@ -781,6 +1042,22 @@ class TestPaste(util.testing.DatabaseTestCase):
         for paste in json.loads(resp.data)['pastes']:
             self.assertIn(paste, pastes)
 
+    def test_pastes_for_user_include_contents(self):
+        user = util.testing.UserFactory.generate(username='username', password='password')
+        self.api_login_user('username', 'password')
+        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id).as_dict() for i in range(10)]
+        resp = self.client.post(
+            PastesForUserURI.uri(),
+            data=json.dumps({
+                'include_contents': True,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual(len(pastes), len(json.loads(resp.data)['pastes']))
+        for paste in json.loads(resp.data)['pastes']:
+            self.assertIn(paste, pastes)
+
     def test_pastes_for_user_server_error(self):
         user = util.testing.UserFactory.generate(username='username', password='password')
         self.api_login_user('username', 'password')
@@ -843,7 +1120,7 @@ class TestPaste(util.testing.DatabaseTestCase):
             with mock.patch.object(time, 'time', return_value=time.time() + random.randint(-10000, 10000)):
                 pastes.append(util.testing.PasteFactory.generate(expiry_time=None))
         recent_pastes_sorted = map(
-            lambda paste: paste.as_dict(),
+            lambda paste: paste.as_dict(include_contents=False),
             sorted(pastes, key=lambda paste: paste.post_time, reverse=True),
         )
 
@@ -858,6 +1135,93 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
         self.assertEqual(list(recent_pastes_sorted)[0:5], json.loads(resp.data)['pastes'])
 
+    def test_recent_pastes_summary(self):
+        util.testing.PasteFactory.generate(contents='contents' * 100, password=None)
+        util.testing.PasteFactory.generate(contents='contents' * 100, password='password')
+
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'page_num': 0,
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        pastes = sorted(json.loads(resp.data)['pastes'], key=lambda paste: paste['is_password_protected'])
+        for paste in pastes:
+            self.assertNotIn('contents', paste)
+            self.assertEqual(800, paste['contents_size'])
+        self.assertEqual('contents' * 12 + 'cont', pastes[0]['contents_preview'])
+        self.assertIsNone(pastes[1]['contents_preview'])
+
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'page_num': 0,
+                'num_per_page': 5,
+                'include_contents': True,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        for paste in json.loads(resp.data)['pastes']:
+            self.assertEqual('contents' * 100, paste['contents'])
+            self.assertNotIn('contents_size', paste)
+
+    def test_recent_pastes_cursor(self):
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for i in range(7)]
+        recent_pastes_sorted = [
+            paste.as_dict(include_contents=False)
+            for paste in sorted(pastes, key=lambda paste: (paste.post_time, paste.paste_id), reverse=True)
+        ]
+
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'page_num': 0,
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual(recent_pastes_sorted[0:5], json.loads(resp.data)['pastes'])
+
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'cursor': json.loads(resp.data)['next_cursor'],
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual(recent_pastes_sorted[5:7], json.loads(resp.data)['pastes'])
+
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'cursor': json.loads(resp.data)['next_cursor'],
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual([], json.loads(resp.data)['pastes'])
+        self.assertIsNone(json.loads(resp.data)['next_cursor'])
+
+    def test_recent_pastes_invalid_cursor(self):
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'cursor': 'invalid',
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.INVALID_CURSOR_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.INVALID_CURSOR_FAILURE, json.loads(resp.data))
+
     def test_top_pastes_invalid(self):
         resp = self.client.post(
             TopPastesURI.uri(),
@@ -945,6 +1309,36 @@ class TestPaste(util.testing.DatabaseTestCase):
         )
         self.assertEqual([], json.loads(resp.data)['pastes'])
 
+    def test_top_pastes_cursor(self):
+        pastes = [util.testing.PasteFactory.generate() for i in range(7)]
+        for paste in pastes:
+            for i in range(random.randint(0, 5)):
+                database.paste.increment_paste_views(paste.paste_id)
+        top_paste_ids = [
+            paste.as_dict()['paste_id_repr']
+            for paste in sorted(pastes, key=lambda paste: (paste.views, paste.paste_id), reverse=True)
+        ]
+
+        resp = self.client.post(
+            TopPastesURI.uri(),
+            data=json.dumps({
+                'page_num': 0,
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(top_paste_ids[0:5], [paste['paste_id_repr'] for paste in json.loads(resp.data)['pastes']])
+
+        resp = self.client.post(
+            TopPastesURI.uri(),
+            data=json.dumps({
+                'cursor': json.loads(resp.data)['next_cursor'],
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(top_paste_ids[5:7], [paste['paste_id_repr'] for paste in json.loads(resp.data)['pastes']])
+
     def test_top_pastes_server_error(self):
         with mock.patch.object(database.paste, 'get_top_pastes', side_effect=SQLAlchemyError):
             resp = self.client.post(
@@ -1,19 +1,31 @@
+import base64
+import binascii
 import errno
+import gzip
+import hashlib
 import os
+import shutil
+import tempfile
+import time
 
 import mock
+from sqlalchemy import event
 
 import config
 import database.attachment
 import database.paste
+import models
 import util.cryptography
+import util.storage
 import util.testing
+from modern_paste import db
 from util.exception import *
 
 
 class TestAttachment(util.testing.DatabaseTestCase):
     def test_create_new_attachment(self):
         with mock.patch.object(database.attachment, '_store_attachment_file') as mock_store_attachment_file:
+            mock_store_attachment_file.return_value = ('content hash', None, False)
             paste = util.testing.PasteFactory.generate()
             attachment = database.attachment.create_new_attachment(
                 paste_id=paste.paste_id,
@@ -27,16 +39,20 @@ class TestAttachment(util.testing.DatabaseTestCase):
             self.assertEqual('file_name', attachment.file_name)
             self.assertEqual(12345, attachment.file_size)
             self.assertEqual('image/png', attachment.mime_type)
-            self.assertEqual(util.cryptography.secure_hash('file_name'), attachment.hash_name)
-            self.assertEqual(1, mock_store_attachment_file.call_count)
+            self.assertEqual('content hash', attachment.content_hash)
+            self.assertIsNone(attachment.hash_name)
+            # The blob is stored again once it is referenced, since the mocked blob is not actually stored
+            self.assertEqual(2, mock_store_attachment_file.call_count)
             mock_store_attachment_file.assert_called_with(
                 paste.paste_id,
                 'binary data',
-                attachment.hash_name,
+                'image/png',
             )
+            self.assertEqual(1, models.AttachmentBlob.query.filter_by(content_hash='content hash').first().ref_count)
 
     def test_create_new_attachment_unsafe_file_name(self):
         with mock.patch.object(database.attachment, '_store_attachment_file') as mock_store_attachment_file:
+            mock_store_attachment_file.return_value = ('content hash', None, False)
             paste = util.testing.PasteFactory.generate()
             attachment = database.attachment.create_new_attachment(
                 paste_id=paste.paste_id,
@@ -46,11 +62,95 @@ class TestAttachment(util.testing.DatabaseTestCase):
                 file_data='binary data',
             )
             self.assertEqual('test_.bashrc', attachment.file_name)
-            self.assertEqual(util.cryptography.secure_hash('test_.bashrc'), attachment.hash_name)
-            self.assertEqual(1, mock_store_attachment_file.call_count)
+            self.assertEqual(2, mock_store_attachment_file.call_count)
+
+    def test_create_new_attachment_deduplicated(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            pastes = [util.testing.PasteFactory.generate() for _ in range(2)]
+            attachments = [
+                database.attachment.create_new_attachment(
+                    paste_id=paste.paste_id,
+                    file_name=file_name,
+                    file_size=11,
+                    mime_type='image/png',
+                    file_data=base64.b64encode(b'binary data'),
+                )
+                for paste in pastes
+                for file_name in ['first', 'second']
+            ]
+            attachment, digest = database.attachment.create_new_attachment_from_stream(
+                paste_id=pastes[0].paste_id,
+                file_name='streamed',
+                mime_type='image/png',
+                chunks=[b'binary', b' data'],
+            )
+            attachments.append(attachment)
+
+            # Identical attachments share a single blob, regardless of their paste and name
+            content_hash = hashlib.sha256(b'binary data').hexdigest()
+            self.assertEqual(content_hash, digest)
+            self.assertEqual([content_hash] * 5, [attachment.content_hash for attachment in attachments])
+            self.assertEqual(5, models.AttachmentBlob.query.filter_by(content_hash=content_hash).first().ref_count)
+            self.assertEqual([content_hash], util.testing.list_blob_files())
+            self.assertEqual(['blobs'], os.listdir(config.ATTACHMENTS_DIR))
+            with open(database.attachment.get_attachment_file(attachments[0])[0], 'rb') as attachment_file:
+                self.assertEqual(b'binary data', attachment_file.read())
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_create_new_attachments_from_stream(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            paste = util.testing.PasteFactory.generate()
+            with mock.patch.object(db.session, 'commit', wraps=db.session.commit) as mock_commit:
+                new_attachments = database.attachment.create_new_attachments_from_stream(paste.paste_id, [
+                    ('first', 'text/plain', [b'first ', b'data']),
+                    ('second', 'image/png', iter([b'second data'])),
+                    ('third', 'image/png', [b'first data']),
+                ])
+                # All attachments are added in a single transaction
+                self.assertEqual(1, mock_commit.call_count)
+            self.assertEqual(
+                [('first', 10), ('second', 11), ('third', 10)],
+                [(attachment.file_name, attachment.file_size) for attachment, _ in new_attachments],
+            )
+            self.assertEqual(
+                [hashlib.sha256(data).hexdigest() for data in [b'first data', b'second data', b'first data']],
+                [digest for _, digest in new_attachments],
+            )
+            self.assertEqual(
+                sorted(hashlib.sha256(data).hexdigest() for data in [b'first data', b'second data']),
+                util.testing.list_blob_files(),
+            )
+
+            # If any attachment fails, none of them are added, and none of their blobs are left behind
+            def failing_chunks():
+                yield b'fifth data'
+                raise ValueError
+
+            for files, exception in [
+                ([('fourth', 'text/plain', [b'fourth data']), ('fifth', 'text/plain', [b'x' * 100])], AttachmentTooLargeException),
+                ([('fourth', 'text/plain', [b'fourth data']), ('fifth', 'text/plain', failing_chunks())], ValueError),
+            ]:
+                self.assertRaises(
+                    exception,
+                    database.attachment.create_new_attachments_from_stream,
+                    paste.paste_id,
+                    files,
+                    max_size=50,
+                )
+                self.assertEqual(3, len(database.attachment.get_attachments_for_paste(paste.paste_id)))
+                self.assertEqual(2, len(util.testing.list_blob_files()))
+            with mock.patch.object(database.attachment, '_ensure_attachment_blob', side_effect=[(None, True), IOError]):
+                self.assertRaises(
+                    IOError,
+                    database.attachment.create_new_attachments_from_stream,
+                    paste.paste_id,
+                    [('fourth', 'text/plain', [b'fourth data']), ('fifth', 'text/plain', [b'fifth data'])],
+                )
+            self.assertEqual(3, len(database.attachment.get_attachments_for_paste(paste.paste_id)))
+            shutil.rmtree(config.ATTACHMENTS_DIR)
 
     def test_attachment_dict_repr(self):
-        with mock.patch.object(database.attachment, '_store_attachment_file'):
+        with mock.patch.object(database.attachment, '_store_attachment_file', return_value=('content hash', None, False)):
             paste = util.testing.PasteFactory.generate()
             attachment = database.attachment.create_new_attachment(
                 paste_id=paste.paste_id,
@@ -66,17 +166,49 @@ class TestAttachment(util.testing.DatabaseTestCase):
             self.assertEqual('image/png', attachment_dict['mime_type'])
 
     def test_store_attachment_file(self):
-        with mock.patch.object(os, 'makedirs') as mock_makedirs, mock.patch('builtins.open') as mock_open:
-            exception = OSError()
-            exception.errno = errno.EEXIST
-            mock_makedirs.side_effect = exception
-
+        content_hash = hashlib.sha256(b'binary data').hexdigest()
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()), \
+                mock.patch.object(os, 'fsync', wraps=os.fsync) as mock_fsync:
             paste = util.testing.PasteFactory.generate()
-            self.assertIsNone(database.attachment._store_attachment_file(paste.paste_id, 'binary data', 'hash name'))
-            self.assertEqual(1, mock_makedirs.call_count)
-            self.assertEqual(1, mock_open.call_count)
+            self.assertEqual(
+                (content_hash, None, True),
+                database.attachment._store_attachment_file(paste.paste_id, 'YmluYXJ5IGRhdGE='),
+            )
+            # The attachment is stored decoded, and stored as its blob atomically and durably
+            self.assertEqual([content_hash], util.testing.list_blob_files())
+            blob_path = os.path.join(config.ATTACHMENTS_DIR, 'blobs', content_hash[:2], content_hash[2:4], content_hash)
+            with open(blob_path, 'rb') as attachment_file:
+                self.assertEqual(b'binary data', attachment_file.read())
+            # The file is synced, along with each directory up to the directory storing blobs
+            self.assertEqual(4, mock_fsync.call_count)
 
-        with mock.patch.object(os, 'makedirs') as mock_makedirs, mock.patch('builtins.open') as mock_open:
+            # Storing the same data again is harmless
+            self.assertEqual(
+                (content_hash, None, False),
+                database.attachment._store_attachment_file(paste.paste_id, 'YmluYXJ5IGRhdGE='),
+            )
+            self.assertEqual([content_hash], util.testing.list_blob_files())
+
+            # Data that can't be decoded is not stored
+            self.assertRaises(
+                binascii.Error,
+                database.attachment._store_attachment_file,
+                paste.paste_id,
+                'invalid',
+            )
+            self.assertEqual([content_hash], util.testing.list_blob_files())
+
+            # Attachments can only be stored for active pastes
+            database.paste.deactivate_paste(paste.paste_id)
+            self.assertRaises(
+                PasteDoesNotExistException,
+                database.attachment._store_attachment_file,
+                paste.paste_id,
+                'YmluYXJ5IGRhdGE=',
+            )
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+        with mock.patch.object(os, 'makedirs') as mock_makedirs:
             exception = OSError()
             exception.errno = errno.EACCES
             mock_makedirs.side_effect = exception
@@ -86,24 +218,364 @@ class TestAttachment(util.testing.DatabaseTestCase):
                 OSError,
                 database.attachment._store_attachment_file,
                 paste.paste_id,
-                'binary data',
-                'hash name',
+                'YmluYXJ5IGRhdGE=',
+            )
+            mock_makedirs.assert_called_with(os.path.dirname(database.attachment.get_blob_path(hashlib.sha256(b'binary data').hexdigest())))
+
+    def test_store_attachment_files(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            data = [b'first', b'second', b'first']
+            stored_blobs = database.attachment.store_attachment_files([base64.b64encode(datum) for datum in data])
+            content_hashes = [content_hash for content_hash, _, _ in stored_blobs]
+            self.assertEqual([hashlib.sha256(datum).hexdigest() for datum in data], content_hashes)
+            self.assertEqual([None] * 3, [content_encoding for _, content_encoding, _ in stored_blobs])
+            self.assertEqual(sorted(set(content_hashes)), util.testing.list_blob_files())
+            self.assertEqual([], database.attachment.store_attachment_files([]))
+            self.assertEqual(
+                [False, False],
+                [is_created for _, _, is_created in database.attachment.store_attachment_files([base64.b64encode(b'first'), base64.b64encode(b'second')])],
             )
 
-        with mock.patch.object(os, 'makedirs') as mock_makedirs, mock.patch('builtins.open') as mock_open:
+            # If any file can't be stored, only the other files that were created by the call are removed; files that
+            # were already stored are kept, whether they are referenced or not
             paste = util.testing.PasteFactory.generate()
-            self.assertIsNone(database.attachment._store_attachment_file(paste.paste_id, 'binary data', 'hash name'))
-            self.assertEqual(1, mock_makedirs.call_count)
-            mock_makedirs.assert_called_with('{attachments_dir}/{paste_id}'.format(
-                attachments_dir=config.ATTACHMENTS_DIR,
-                paste_id=paste.paste_id,
-            ))
-            self.assertEqual(1, mock_open.call_count)
-            mock_open.assert_called_with('{attachments_dir}/{paste_id}/{file_name}'.format(
-                attachments_dir=config.ATTACHMENTS_DIR,
-                paste_id=paste.paste_id,
-                file_name='hash name',
-            ), 'w')
+            database.attachment.create_new_attachment_from_stream(paste.paste_id, 'file', 'text/plain', [b'first'])
+            self.assertRaises(
+                binascii.Error,
+                database.attachment.store_attachment_files,
+                [base64.b64encode(b'first'), base64.b64encode(b'second'), base64.b64encode(b'third'), 'invalid'],
+            )
+            self.assertEqual(sorted(content_hashes[:2]), util.testing.list_blob_files())
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_store_attachment_compressed(self):
+        data = b'text data\n' * 1024
+        content_hash = hashlib.sha256(data).hexdigest()
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()), \
+                mock.patch.object(config, 'ENABLE_ATTACHMENT_COMPRESSION', True):
+            paste = util.testing.PasteFactory.generate()
+            self.assertEqual(
+                (content_hash, 'gzip', True),
+                database.attachment._store_attachment_file(paste.paste_id, base64.b64encode(data), 'text/plain'),
+            )
+            # Only the compressed variant is stored
+            self.assertEqual([content_hash + '.gz'], util.testing.list_blob_files())
+            with open(database.attachment.get_blob_path(content_hash, 'gzip'), 'rb') as blob_file:
+                self.assertEqual(data, gzip.decompress(blob_file.read()))
+
+            # Streamed attachments are compressed identically, and share the stored variant
+            attachment, _ = database.attachment.create_new_attachment_from_stream(
+                paste.paste_id,
+                'file',
+                'application/json',
+                [data[:1000], data[1000:]],
+            )
+            self.assertEqual('gzip', attachment.content_encoding)
+            attachment, _ = database.attachment.create_new_attachment_from_stream(
+                paste.paste_id,
+                'file',
+                'image/png',
+                [data],
+            )
+            self.assertEqual('gzip', attachment.content_encoding)
+            self.assertEqual([content_hash + '.gz'], util.testing.list_blob_files())
+
+            # Attachments that are not text-like, are below the threshold, or don't get smaller are stored raw
+            for file_data, mime_type in [
+                (b'binary data' * 1024, 'image/png'),
+                (b'text data', 'text/plain'),
+                (os.urandom(2048), 'text/plain'),
+            ]:
+                attachment, _ = database.attachment.create_new_attachment_from_stream(
+                    paste.paste_id,
+                    'file',
+                    mime_type,
+                    [file_data],
+                )
+                self.assertIsNone(attachment.content_encoding)
+                with open(database.attachment.get_attachment_file(attachment)[0], 'rb') as attachment_file:
+                    self.assertEqual(file_data, attachment_file.read())
+            self.assertEqual(4, len(util.testing.list_blob_files()))
+
+            # The stored variant is removed along with the blob, once it is no longer referenced
+            database.attachment.remove_attachment_blob_files([content_hash])
+            self.assertEqual(4, len(util.testing.list_blob_files()))
+            db.session.query(models.AttachmentBlob).delete()
+            db.session.commit()
+            database.attachment.remove_attachment_blob_files([content_hash])
+            self.assertEqual(3, len(util.testing.list_blob_files()))
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_add_attachments(self):
+        paste = util.testing.PasteFactory.generate()
+        existing_attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        attachments = database.attachment.add_attachments([
+            (paste.paste_id, 'first file', 1, 'text/plain', existing_attachment.content_hash, None),
+            (paste.paste_id, 'second file', 2, 'text/plain', 'content hash', 'gzip'),
+            (paste.paste_id, 'third file', 3, 'text/plain', 'content hash', 'gzip'),
+        ])
+        db.session.commit()
+
+        self.assertEqual(['first_file', 'second_file', 'third_file'], [attachment.file_name for attachment in attachments])
+        self.assertEqual([None, 'gzip', 'gzip'], [attachment.content_encoding for attachment in attachments])
+        self.assertEqual(4, len(database.attachment.get_attachments_for_paste(paste.paste_id)))
+        self.assertEqual(2, models.AttachmentBlob.query.filter_by(content_hash=existing_attachment.content_hash).first().ref_count)
+        self.assertEqual(2, models.AttachmentBlob.query.filter_by(content_hash='content hash').first().ref_count)
+
+    def test_get_attachment_file(self):
+        attachment = util.testing.AttachmentFactory.generate(paste_id=util.testing.PasteFactory.generate().paste_id)
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            blob_path = os.path.join(
+                config.ATTACHMENTS_DIR,
+                'blobs',
+                attachment.content_hash[:2],
+                attachment.content_hash[2:4],
+                attachment.content_hash,
+            )
+            self.assertEqual(blob_path, database.attachment.get_blob_path(attachment.content_hash))
+            self.assertEqual((blob_path, True), database.attachment.get_attachment_file(attachment))
+
+            # Blobs stored compressed are stored under a distinct key
+            attachment.content_encoding = 'gzip'
+            self.assertEqual((blob_path + '.gz', True), database.attachment.get_attachment_file(attachment))
+            attachment.content_encoding = None
+
+            # Blobs that have not been moved to the sharded layout yet are found in the earlier layout
+            unsharded_blob_path = os.path.join(config.ATTACHMENTS_DIR, 'blobs', attachment.content_hash)
+            os.makedirs(os.path.dirname(unsharded_blob_path))
+            open(unsharded_blob_path, 'wb').close()
+            self.assertEqual((unsharded_blob_path, True), database.attachment.get_attachment_file(attachment))
+            os.makedirs(os.path.dirname(blob_path))
+            open(blob_path, 'wb').close()
+            self.assertEqual((blob_path, True), database.attachment.get_attachment_file(attachment))
+
+            # Attachments stored before attachments were stored by content are stored per paste, under their hashed
+            # name, in either layout
+            attachment.content_hash = None
+            attachment.hash_name = 'hash name'
+            for paste_dir in [
+                os.path.join(config.ATTACHMENTS_DIR, str(attachment.paste_id)),
+                database.attachment.get_paste_attachment_dir(attachment.paste_id),
+            ]:
+                os.makedirs(paste_dir)
+                file_path = os.path.join(paste_dir, 'hash name')
+                self.assertEqual((file_path, False), database.attachment.get_attachment_file(attachment))
+                open(file_path + '.raw', 'wb').close()
+                self.assertEqual((file_path + '.raw', True), database.attachment.get_attachment_file(attachment))
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_get_storage_backend(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', '/attachments'):
+            storage = database.attachment.get_storage_backend()
+            self.assertIsInstance(storage, util.storage.LocalStorageBackend)
+            self.assertEqual('/attachments/blobs', storage.root_dir)
+
+        database.attachment._get_s3_storage_backend.cache_clear()
+        with mock.patch.object(config, 'ATTACHMENTS_STORAGE_BACKEND', 's3'), \
+                mock.patch.object(config, 'ATTACHMENTS_S3_BUCKET', 'bucket'), \
+                mock.patch.object(util.storage, 'S3StorageBackend') as mock_s3_storage_backend:
+            # The backend is created once per process
+            self.assertEqual(mock_s3_storage_backend.return_value, database.attachment.get_storage_backend())
+            self.assertEqual(mock_s3_storage_backend.return_value, database.attachment.get_storage_backend())
+            mock_s3_storage_backend.assert_called_once_with(
+                bucket='bucket',
+                prefix=config.ATTACHMENTS_S3_PREFIX,
+                endpoint_url=None,
+                region_name=None,
+                presigned_url_ttl=config.ATTACHMENTS_S3_PRESIGNED_URL_TTL,
+            )
+
+            # Attachments whose blobs are stored remotely have no local file
+            attachment = util.testing.AttachmentFactory.generate(paste_id=util.testing.PasteFactory.generate().paste_id)
+            mock_s3_storage_backend.return_value.local_path.return_value = None
+            self.assertEqual((None, True), database.attachment.get_attachment_file(attachment))
+        database.attachment._get_s3_storage_backend.cache_clear()
+
+    def test_write_attachment_blob_existing(self):
+        storage = mock.Mock()
+        with mock.patch.object(database.attachment, 'get_storage_backend', return_value=storage):
+            # Identical blobs are only stored once
+            storage.exists.return_value = True
+            self.assertEqual(
+                (hashlib.sha256(b'binary data').hexdigest(), None, False),
+                database.attachment._write_attachment_blob('YmluYXJ5IGRhdGE='),
+            )
+            self.assertFalse(storage.put.called)
+
+            # The variant already stored is reused, even if it is compressed
+            content_hash = hashlib.sha256(b'binary data').hexdigest()
+            storage.exists.side_effect = lambda key: key == content_hash + '.gz'
+            self.assertEqual(
+                (content_hash, 'gzip', False),
+                database.attachment._write_attachment_blob('YmluYXJ5IGRhdGE=', 'image/png'),
+            )
+            self.assertFalse(storage.put.called)
+            storage.exists.side_effect = None
+
+            storage.exists.return_value = False
+            self.assertEqual((content_hash, None, True), database.attachment._write_attachment_blob('YmluYXJ5IGRhdGE='))
+            storage.put.assert_called_once_with(hashlib.sha256(b'binary data').hexdigest(), [b'binary data'])
+
+    def test_shard_attachment_paths(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            paste = util.testing.PasteFactory.generate()
+            content_hash = hashlib.sha256(b'blob data').hexdigest()
+            unsharded_blob_path = os.path.join(config.ATTACHMENTS_DIR, 'blobs', content_hash)
+            unsharded_paste_dir = os.path.join(config.ATTACHMENTS_DIR, str(paste.paste_id))
+            os.makedirs(unsharded_paste_dir)
+            os.makedirs(os.path.join(config.ATTACHMENTS_DIR, 'blobs'))
+            for file_path, data in [
+                (unsharded_blob_path, b'blob data'),
+                (os.path.join(unsharded_paste_dir, 'hash name.raw'), b'attachment data'),
+                (os.path.join(config.ATTACHMENTS_DIR, 'blobs', 'temporary.tmp'), b'partial data'),
+            ]:
+                with open(file_path, 'wb') as attachment_file:
+                    attachment_file.write(data)
+            # Blobs that are already stored in the sharded layout are left as they are
+            database.attachment.create_new_attachment_from_stream(paste.paste_id, 'file', 'text/plain', [b'sharded data'])
+
+            self.assertEqual(
+                [unsharded_blob_path, unsharded_paste_dir],
+                database.attachment.find_unsharded_attachment_paths(),
+            )
+            self.assertEqual(
+                [unsharded_blob_path, unsharded_paste_dir],
+                database.attachment.shard_attachment_paths(),
+            )
+            self.assertEqual([], database.attachment.find_unsharded_attachment_paths())
+            self.assertEqual(
+                sorted([content_hash, hashlib.sha256(b'sharded data').hexdigest(), 'temporary.tmp']),
+                util.testing.list_blob_files(),
+            )
+            with open(database.attachment.get_blob_path(content_hash), 'rb') as attachment_file:
+                self.assertEqual(b'blob data', attachment_file.read())
+            self.assertEqual(
+                ['hash name.raw'],
+                os.listdir(database.attachment.get_paste_attachment_dir(paste.paste_id)),
+            )
+
+            # Moving again is a no-op
+            self.assertEqual([], database.attachment.shard_attachment_paths())
+
+            database.attachment.remove_paste_attachment_dirs(paste.paste_id)
+            self.assertFalse(os.path.exists(database.attachment.get_paste_attachment_dir(paste.paste_id)))
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_dereference_attachment_blobs(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            paste = util.testing.PasteFactory.generate()
+            content_hashes = [
+                database.attachment.create_new_attachment_from_stream(paste.paste_id, file_name, 'text/plain', [data])[1]
+                for file_name, data in [('first', b'shared'), ('second', b'shared'), ('third', b'unique')]
+            ]
+
+            self.assertEqual(
+                [content_hashes[2]],
+                database.attachment.dereference_attachment_blobs([content_hashes[1], content_hashes[2]]),
+            )
+            db.session.commit()
+            self.assertEqual(1, models.AttachmentBlob.query.filter_by(content_hash=content_hashes[0]).first().ref_count)
+            # Blobs that are no longer referenced are kept until their files are removed
+            self.assertEqual(0, models.AttachmentBlob.query.filter_by(content_hash=content_hashes[2]).first().ref_count)
+            self.assertEqual([], database.attachment.dereference_attachment_blobs([]))
+
+            # Files are only removed for blobs that are still unreferenced, along with their entries
+            database.attachment.remove_attachment_blob_files(content_hashes + ['nonexistent'])
+            self.assertEqual([content_hashes[0]], util.testing.list_blob_files())
+            self.assertEqual([content_hashes[0]], [blob.content_hash for blob in models.AttachmentBlob.query.all()])
+
+            # Blobs that are referenced again before their files are removed are kept
+            content_hash = database.attachment.create_new_attachment_from_stream(paste.paste_id, 'fourth', 'text/plain', [b'unique'])[1]
+            database.attachment.dereference_attachment_blobs([content_hash])
+            db.session.commit()
+            database.attachment.create_new_attachment_from_stream(paste.paste_id, 'fifth', 'text/plain', [b'unique'])
+            database.attachment.remove_attachment_blob_files([content_hash])
+            self.assertEqual(sorted([content_hashes[0], content_hash]), util.testing.list_blob_files())
+            self.assertEqual(1, models.AttachmentBlob.query.filter_by(content_hash=content_hash).first().ref_count)
+
+    def test_ensure_attachment_file(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            paste = util.testing.PasteFactory.generate()
+            content_hash = hashlib.sha256(b'binary data').hexdigest()
+            database.attachment.create_new_attachment_from_stream(paste.paste_id, 'first', 'text/plain', [b'binary data'])
+            database.attachment.dereference_attachment_blobs([content_hash])
+            db.session.commit()
+
+            # The file of a blob that is removed, e.g. by a concurrent scrub, after the blob is found to be stored but
+            # before it is referenced is stored again
+            store_attachment_files = database.attachment.store_attachment_files
+
+            def concurrently_scrubbed_store_attachment_files(*args):
+                stored_blobs = store_attachment_files(*args)
+                self.assertEqual([(content_hash, None, False)], stored_blobs)
+                database.attachment.remove_attachment_blob_files([content_hash])
+                self.assertEqual([], util.testing.list_blob_files())
+                return stored_blobs
+
+            with mock.patch.object(database.attachment, 'store_attachment_files', side_effect=concurrently_scrubbed_store_attachment_files):
+                database.paste.create_new_paste_with_attachments(
+                    contents='contents',
+                    attachments=[{'name': 'second', 'size': 11, 'mime_type': 'text/plain', 'data': base64.b64encode(b'binary data')}],
+                )
+            self.assertEqual([content_hash], util.testing.list_blob_files())
+            self.assertEqual(1, models.AttachmentBlob.query.filter_by(content_hash=content_hash).first().ref_count)
+            self.assertEqual((None, False), database.attachment.ensure_attachment_file(content_hash, base64.b64encode(b'binary data')))
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_convert_attachment_files(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            os.makedirs(os.path.join(config.ATTACHMENTS_DIR, '1'))
+            os.makedirs(os.path.join(config.ATTACHMENTS_DIR, '2'))
+            # Blobs are never base64-encoded
+            os.makedirs(os.path.join(config.ATTACHMENTS_DIR, 'blobs'))
+            files = {
+                '1/encoded': base64.b64encode(b'encoded data'),
+                '1/decoded.raw': b'decoded data',
+                '2/encoded': base64.b64encode(b'\x00\xff'),
+                '2/invalid': b'invalid base64 data',
+            }
+            files['blobs/{content_hash}'.format(content_hash=hashlib.sha256(b'blob data').hexdigest())] = b'blob data'
+            # Directories of pastes in the sharded layout are converted as well
+            sharded_paste_dir = os.path.relpath(database.attachment.get_paste_attachment_dir(3), config.ATTACHMENTS_DIR)
+            os.makedirs(os.path.join(config.ATTACHMENTS_DIR, sharded_paste_dir))
+            files[os.path.join(sharded_paste_dir, 'encoded')] = base64.b64encode(b'sharded data')
+            for file_name, data in files.items():
+                with open(os.path.join(config.ATTACHMENTS_DIR, file_name), 'wb') as attachment_file:
+                    attachment_file.write(data)
+
+            encoded_file_paths = [
+                os.path.join(config.ATTACHMENTS_DIR, file_name)
+                for file_name in ['1/encoded', '2/encoded', os.path.join(sharded_paste_dir, 'encoded'), '2/invalid']
+            ]
+            self.assertEqual(
+                sorted(encoded_file_paths),
+                sorted(database.attachment.find_encoded_attachment_files()),
+            )
+            self.assertEqual(
+                (encoded_file_paths[:3], encoded_file_paths[3:]),
+                database.attachment.convert_attachment_files(),
+            )
+            self.assertEqual(encoded_file_paths[3:], database.attachment.find_encoded_attachment_files())
+            self.assertEqual(
+                ['decoded.raw', 'encoded.raw'],
+                sorted(os.listdir(os.path.join(config.ATTACHMENTS_DIR, '1'))),
+            )
+            for file_name, data in [
+                ('1/encoded.raw', b'encoded data'),
+                ('1/decoded.raw', b'decoded data'),
+                ('2/encoded.raw', b'\x00\xff'),
+                (os.path.join(sharded_paste_dir, 'encoded.raw'), b'sharded data'),
+            ]:
+                with open(os.path.join(config.ATTACHMENTS_DIR, file_name), 'rb') as attachment_file:
+                    self.assertEqual(data, attachment_file.read())
+
+            # Converting again is a no-op
+            self.assertEqual(([], encoded_file_paths[3:]), database.attachment.convert_attachment_files())
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_find_encoded_attachment_files_no_dir(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', '/nonexistent/attachments'):
+            self.assertEqual([], database.attachment.find_encoded_attachment_files())
 
     def test_get_attachment_by_id(self):
         self.assertRaises(
@@ -118,6 +590,7 @@ class TestAttachment(util.testing.DatabaseTestCase):
 
         # Attachment should not be fetched if the corresponding paste is deactivated and the active_only flag
         # is specified as True
+        self.assertEqual(attachment, database.attachment.get_attachment_by_id(attachment.attachment_id, active_only=True))
         database.paste.deactivate_paste(paste.paste_id)
         self.assertRaises(
             AttachmentDoesNotExistException,
@@ -126,6 +599,16 @@ class TestAttachment(util.testing.DatabaseTestCase):
             active_only=True,
         )
 
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 1000)
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        self.assertEqual(attachment, database.attachment.get_attachment_by_id(attachment.attachment_id))
+        self.assertRaises(
+            AttachmentDoesNotExistException,
+            database.attachment.get_attachment_by_id,
+            attachment.attachment_id,
+            active_only=True,
+        )
+
     def test_get_attachment_by_name(self):
         self.assertRaises(
             PasteDoesNotExistException,
@@ -155,6 +638,48 @@ class TestAttachment(util.testing.DatabaseTestCase):
             active_only=True,
         )
 
+    def test_get_attachment_and_post_time_by_name(self):
+        paste = util.testing.PasteFactory.generate(contents='contents')
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        db.session.remove()
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            queried_attachment, post_time = database.attachment.get_attachment_and_post_time_by_name(
+                paste.paste_id,
+                attachment.file_name,
+                active_only=True,
+            )
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+        self.assertEqual(attachment.attachment_id, queried_attachment.attachment_id)
+        self.assertEqual(paste.post_time, post_time)
+        # The paste is checked and the attachment is fetched in a single query, without the paste's contents
+        self.assertEqual(1, len(statements))
+        self.assertNotIn('contents', statements[0])
+
+        self.assertRaises(
+            AttachmentDoesNotExistException,
+            database.attachment.get_attachment_and_post_time_by_name,
+            paste.paste_id,
+            'nonexistent',
+            active_only=True,
+        )
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 1000)
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.attachment.get_attachment_and_post_time_by_name,
+            paste.paste_id,
+            attachment.file_name,
+            active_only=True,
+        )
+
     def test_get_attachments_for_paste(self):
         self.assertRaises(
             PasteDoesNotExistException,
@@ -169,9 +694,8 @@ class TestAttachment(util.testing.DatabaseTestCase):
         ]
 
         queried_attachments = database.attachment.get_attachments_for_paste(paste.paste_id)
-        self.assertEqual(5, len(queried_attachments))
-        for expect_attachment in attachments:
-            self.assertIn(expect_attachment, queried_attachments)
+        self.assertEqual(attachments, queried_attachments)
+        self.assertEqual([], database.attachment.get_attachments_for_paste(util.testing.PasteFactory.generate().paste_id))
 
         # Attachments should only be retrieved if the paste is active
         database.paste.deactivate_paste(paste.paste_id)
@@ -1,16 +1,26 @@
 # coding=utf-8
 
+import base64
+import hashlib
 import random
 import shutil
+import tempfile
 import time
+import warnings
 import errno
 
 import mock
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import SAWarning
 
+import config
 import database.attachment
 import database.paste
+import models
 import util.cryptography
 import util.testing
+from modern_paste import db
 from util.exception import *
 
 
@@ -23,7 +33,7 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual('title', paste.title)
         self.assertEqual('python', paste.language)
         self.assertEqual('python', paste.language)
-        self.assertEqual(util.cryptography.secure_hash('password'), paste.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', paste.password_hash))
         self.assertTrue(paste.is_api_post)
 
         # Should also be able to create pastes with all optional fields blank
@@ -71,6 +81,286 @@ class TestPaste(util.testing.DatabaseTestCase):
             active_only=True,
         )
 
+    def test_create_new_paste_compressed(self):
+        config.ENABLE_PASTE_COMPRESSION = True
+        config.PASTE_COMPRESSION_THRESHOLD = 100
+        for codec in ['zlib', 'bz2', 'lzma']:
+            config.PASTE_COMPRESSION_CODEC = codec
+            paste = util.testing.PasteFactory.generate(contents='contents\u2603' * 100)
+            db.session.remove()
+            paste = database.paste.get_paste_by_id(paste.paste_id)
+            self.assertIsNone(paste.content.plain_contents)
+            self.assertEqual(codec, paste.content.contents_codec)
+            self.assertLess(len(paste.content.compressed_contents), 1100)
+            self.assertEqual(1100, paste.content.uncompressed_size)
+            self.assertEqual('contents\u2603' * 100, paste.contents)
+            # Identical contents would share the content compressed with the previous codec
+            database.paste.deactivate_paste(paste.paste_id)
+            database.paste.scrub_inactive_pastes()
+            # SQLite reuses the ID of the scrubbed paste
+            db.session.remove()
+
+        # Small and incompressible contents are stored uncompressed
+        for contents in ['contents', util.testing.random_alphanumeric_string(length=100)]:
+            paste = util.testing.PasteFactory.generate(contents=contents)
+            self.assertEqual(contents, paste.content.plain_contents)
+            self.assertIsNone(paste.content.contents_codec)
+            self.assertEqual(contents, paste.contents)
+
+    def test_create_new_paste_deduplicated(self):
+        pastes = [util.testing.PasteFactory.generate(contents='contents') for i in range(3)]
+        other_paste = util.testing.PasteFactory.generate(contents='other contents')
+        self.assertEqual(2, models.PasteContent.query.count())
+        self.assertEqual(1, len(set(paste.content_hash for paste in pastes)))
+        self.assertNotEqual(pastes[0].content_hash, other_paste.content_hash)
+        self.assertEqual(3, models.PasteContent.query.filter_by(content_hash=pastes[0].content_hash).first().ref_count)
+        for paste in pastes:
+            self.assertEqual('contents', database.paste.get_paste_by_id(paste.paste_id).contents)
+
+    def test_create_new_paste_scrubbed_contents(self):
+        paste = util.testing.PasteFactory.generate(contents='contents')
+        other_paste = util.testing.PasteFactory.generate(contents='other contents')
+        self.assertEqual('contents', paste.content.plain_contents)
+        database.paste.deactivate_paste(paste.paste_id)
+        database.paste.scrub_inactive_pastes()
+        self.assertEqual(1, models.PasteContent.query.count())
+
+        # The stale instance of the scrubbed contents, still loaded in the session, does not conflict with them
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', SAWarning)
+            paste = util.testing.PasteFactory.generate(contents='contents')
+        self.assertEqual(2, models.PasteContent.query.count())
+        self.assertEqual(1, models.PasteContent.query.filter_by(content_hash=paste.content_hash).first().ref_count)
+        self.assertEqual('contents', database.paste.get_paste_by_id(paste.paste_id).contents)
+        self.assertEqual('other contents', database.paste.get_paste_by_id(other_paste.paste_id).contents)
+
+    def test_create_new_paste_concurrently_deduplicated(self):
+        paste = util.testing.PasteFactory.generate(contents='contents')
+        # Another transaction stores the same contents between checking for them and storing them
+        reference_paste_content = database.paste._reference_paste_content
+
+        def concurrently_reference_paste_content(contents):
+            if mock_reference.call_count == 1:
+                raise IntegrityError('statement', {}, Exception())
+            return reference_paste_content(contents)
+
+        with mock.patch.object(database.paste, '_reference_paste_content') as mock_reference:
+            mock_reference.side_effect = concurrently_reference_paste_content
+            other_paste = database.paste.create_new_paste('contents')
+        self.assertEqual(2, mock_reference.call_count)
+        self.assertEqual(paste.content_hash, other_paste.content_hash)
+        self.assertEqual(2, models.PasteContent.query.filter_by(content_hash=paste.content_hash).first().ref_count)
+
+    def test_create_new_paste_with_attachments(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            with mock.patch.object(db.session, 'commit', wraps=db.session.commit) as mock_commit:
+                paste, attachments = database.paste.create_new_paste_with_attachments(
+                    contents='contents',
+                    attachments=[
+                        {'name': 'first file', 'size': 5, 'mime_type': 'text/plain', 'data': base64.b64encode(b'first')},
+                        {'name': 'second file', 'size': 6, 'mime_type': 'image/png', 'data': base64.b64encode(b'second')},
+                    ],
+                    title='title',
+                )
+                # The paste and its attachments are added in a single transaction
+                self.assertEqual(1, mock_commit.call_count)
+            self.assertEqual('title', paste.title)
+            self.assertEqual(['first_file', 'second_file'], [attachment.file_name for attachment in attachments])
+            self.assertEqual([paste.paste_id] * 2, [attachment.paste_id for attachment in attachments])
+            db.session.remove()
+            self.assertEqual(2, len(database.attachment.get_attachments_for_paste(paste.paste_id)))
+            file_path, _ = database.attachment.get_attachment_file(
+                database.attachment.get_attachment_by_name(paste.paste_id, 'second_file'),
+            )
+            with open(file_path, 'rb') as attachment_file:
+                self.assertEqual(b'second', attachment_file.read())
+
+            # If the paste can't be created, nothing is stored, including the attachment files created for it; files
+            # that were already stored are kept
+            paste_count = models.Paste.query.count()
+            # E.g. uploaded concurrently for another paste, which is yet to be committed
+            database.attachment.store_attachment_files([base64.b64encode(b'fourth')])
+            with mock.patch.object(db.session, 'commit', side_effect=IntegrityError('statement', {}, Exception())):
+                self.assertRaises(
+                    IntegrityError,
+                    database.paste.create_new_paste_with_attachments,
+                    contents='contents',
+                    attachments=[
+                        {'name': 'file', 'size': 5, 'mime_type': 'text/plain', 'data': base64.b64encode(b'first')},
+                        {'name': 'file', 'size': 5, 'mime_type': 'text/plain', 'data': base64.b64encode(b'third')},
+                        {'name': 'file', 'size': 6, 'mime_type': 'text/plain', 'data': base64.b64encode(b'fourth')},
+                    ],
+                )
+            self.assertEqual(paste_count, models.Paste.query.count())
+            self.assertEqual(2, models.Attachment.query.count())
+            self.assertEqual(
+                sorted(hashlib.sha256(data).hexdigest() for data in [b'first', b'second', b'fourth']),
+                util.testing.list_blob_files(),
+            )
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_convert_paste_contents(self):
+        pastes = [util.testing.PasteFactory.generate(contents=str(i) * 2000) for i in range(5)]
+        small_paste = util.testing.PasteFactory.generate(contents='contents')
+        config.ENABLE_PASTE_COMPRESSION = True
+        self.assertEqual(5, database.paste.convert_paste_contents(batch_size=2))
+        self.assertEqual(0, database.paste.convert_paste_contents(batch_size=2))
+        db.session.remove()
+        for i, paste in enumerate(pastes):
+            paste = database.paste.get_paste_by_id(paste.paste_id)
+            self.assertEqual('zlib', paste.content.contents_codec)
+            self.assertEqual(str(i) * 2000, paste.contents)
+        self.assertIsNone(database.paste.get_paste_by_id(small_paste.paste_id).content.contents_codec)
+
+        config.ENABLE_PASTE_COMPRESSION = False
+        self.assertEqual(5, database.paste.convert_paste_contents())
+        db.session.remove()
+        for i, paste in enumerate(pastes):
+            paste = database.paste.get_paste_by_id(paste.paste_id)
+            self.assertIsNone(paste.content.contents_codec)
+            self.assertEqual(str(i) * 2000, paste.content.plain_contents)
+
+    def test_convert_paste_contents_deduplicated(self):
+        # Pastes created before contents were deduplicated store their own contents
+        pastes = [util.testing.PasteFactory.generate(contents='contents') for i in range(3)]
+        other_paste = util.testing.PasteFactory.generate(contents='other contents')
+        models.PasteContent.query.delete()
+        for paste in pastes + [other_paste]:
+            paste.content_hash = None
+            paste.plain_contents = 'contents' if paste is not other_paste else 'other contents'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual('contents', database.paste.get_paste_by_id(pastes[0].paste_id).contents)
+
+        self.assertEqual(4, database.paste.convert_paste_contents(batch_size=3))
+        self.assertEqual(0, database.paste.convert_paste_contents(batch_size=3))
+        db.session.remove()
+        for paste in pastes + [other_paste]:
+            paste = database.paste.get_paste_by_id(paste.paste_id)
+            self.assertIsNotNone(paste.content_hash)
+            self.assertIsNone(paste.plain_contents)
+        self.assertEqual('other contents', database.paste.get_paste_by_id(other_paste.paste_id).contents)
+        self.assertEqual(2, models.PasteContent.query.count())
+        self.assertEqual(3, models.PasteContent.query.filter_by(content_hash=models.PasteContent.hash_contents('contents')).first().ref_count)
+
+    def test_get_paste_by_id_without_contents(self):
+        paste = util.testing.PasteFactory.generate(contents='contents')
+        db.session.remove()
+        paste = database.paste.get_paste_by_id(paste.paste_id, active_only=True, include_contents=False)
+        self.assertNotIn('content', paste.__dict__)
+        self.assertNotIn('plain_contents', paste.__dict__)
+        # The contents are loaded once they are accessed
+        self.assertEqual('contents', paste.contents)
+
+        db.session.remove()
+        paste, _ = database.paste.view_paste(paste.paste_id, include_contents=False)
+        self.assertNotIn('content', paste.__dict__)
+        self.assertEqual(1, paste.views)
+        self.assertEqual('contents', paste.contents)
+
+    def test_get_paste_by_id_cached_compressed(self):
+        config.ENABLE_PASTE_CACHE = True
+        config.ENABLE_PASTE_COMPRESSION = True
+        paste = util.testing.PasteFactory.generate(contents='contents' * 1000, password=None, expiry_time=None)
+        database.paste.get_paste_by_id(paste.paste_id)
+        db.session.remove()
+        with mock.patch.object(models.Paste, 'query'):
+            cached_paste = database.paste.get_paste_by_id(paste.paste_id)
+        self.assertEqual('zlib', cached_paste.content.contents_codec)
+        self.assertEqual('contents' * 1000, cached_paste.contents)
+
+    def test_get_paste_by_id_cached(self):
+        config.ENABLE_PASTE_CACHE = True
+        paste = util.testing.PasteFactory.generate(password=None, expiry_time=None)
+        contents = paste.contents
+
+        # The first lookup populates the cache; subsequent lookups in a fresh session are served from it
+        self.assertEqual(contents, database.paste.get_paste_by_id(paste.paste_id).contents)
+        db.session.remove()
+        with mock.patch.object(models.Paste, 'query') as mock_query:
+            cached_paste = database.paste.get_paste_by_id(paste.paste_id, active_only=True)
+            self.assertEqual(0, mock_query.filter_by.call_count)
+        self.assertEqual(contents, cached_paste.contents)
+        self.assertEqual(paste.paste_id, cached_paste.paste_id)
+        self.assertEqual(1, database.paste.paste_cache.stats()['hits'])
+        self.assertEqual(1, database.paste.paste_cache.stats()['misses'])
+
+        # Cached pastes are attached to the session, so modifications to them are persisted
+        database.paste.set_paste_password(paste.paste_id, 'password')
+        db.session.remove()
+        self.assertTrue(util.cryptography.verify_password(
+            'password',
+            database.paste.get_paste_by_id(paste.paste_id).password_hash,
+        ))
+
+        # Deactivation evicts the paste from the cache
+        database.paste.deactivate_paste(paste.paste_id)
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.get_paste_by_id,
+            paste.paste_id,
+            active_only=True,
+        )
+        self.assertFalse(database.paste.get_paste_by_id(paste.paste_id).is_active)
+
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.get_paste_by_id,
+            -1,
+        )
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.get_paste_by_id,
+            'invalid',
+        )
+
+    def test_get_paste_by_id_cached_expiry(self):
+        config.ENABLE_PASTE_CACHE = True
+        paste = util.testing.PasteFactory.generate(password=None, expiry_time=int(time.time()) + 10)
+        database.paste.get_paste_by_id(paste.paste_id, active_only=True)
+        self.assertEqual(1, database.paste.paste_cache.stats()['size'])
+
+        # The cache entry must not outlive the paste
+        with mock.patch.object(time, 'time', return_value=time.time() + 20):
+            self.assertRaises(
+                PasteDoesNotExistException,
+                database.paste.get_paste_by_id,
+                paste.paste_id,
+                active_only=True,
+            )
+        self.assertEqual(0, database.paste.paste_cache.stats()['hits'])
+
+        # Expired pastes are never cached
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 1000)
+        database.paste.get_paste_by_id(paste.paste_id)
+        self.assertEqual(0, database.paste.paste_cache.stats()['size'])
+
+    def test_get_paste_by_id_cached_password(self):
+        config.ENABLE_PASTE_CACHE = True
+        paste = util.testing.PasteFactory.generate(password='password', expiry_time=None)
+        token = database.paste.get_paste_unlock_token(paste)
+
+        # Password-protected pastes are never cached
+        database.paste.get_paste_by_id(paste.paste_id, active_only=True)
+        self.assertEqual(0, database.paste.paste_cache.stats()['size'])
+
+        # A password changed by another process, which can't evict the paste from this process's cache, takes effect
+        # immediately, along with the invalidation of outstanding unlock tokens
+        models.Paste.query.filter_by(paste_id=paste.paste_id).update({
+            models.Paste.password_hash: util.cryptography.hash_password('new password'),
+        })
+        db.session.commit()
+        db.session.remove()
+        paste = database.paste.get_paste_by_id(paste.paste_id, active_only=True)
+        self.assertFalse(database.paste.check_paste_password(paste, 'password'))
+        self.assertTrue(database.paste.check_paste_password(paste, 'new password'))
+        self.assertFalse(database.paste.check_paste_unlock_token(paste, token))
+
+        # Once its password is removed, the paste is cached again
+        database.paste.set_paste_password(paste.paste_id, None)
+        database.paste.get_paste_by_id(paste.paste_id, active_only=True)
+        self.assertEqual(1, database.paste.paste_cache.stats()['size'])
+
     def test_is_paste_active(self):
         self.assertFalse(database.paste.is_paste_active(-1))
 
@@ -89,7 +379,7 @@ class TestPaste(util.testing.DatabaseTestCase):
         old_password_hash = str(paste.password_hash)
         database.paste.set_paste_password(paste.paste_id, 'new password')
         new_password_hash = str(database.paste.get_paste_by_id(paste.paste_id).password_hash)
-        self.assertEqual(util.cryptography.secure_hash('new password'), new_password_hash)
+        self.assertTrue(util.cryptography.verify_password('new password', new_password_hash))
         self.assertNotEqual(new_password_hash, old_password_hash)
 
         paste = util.testing.PasteFactory.generate()
@@ -101,6 +391,56 @@ class TestPaste(util.testing.DatabaseTestCase):
             password='password',
         )
 
+    def test_check_paste_password(self):
+        paste = util.testing.PasteFactory.generate(password='password')
+        self.assertTrue(database.paste.check_paste_password(paste, 'password'))
+        self.assertFalse(database.paste.check_paste_password(paste, 'other password'))
+        self.assertFalse(database.paste.check_paste_password(paste, None))
+
+        # Legacy hashes are verified, and replaced once the password is known
+        legacy_hash = util.cryptography.secure_hash('password')
+        paste.password_hash = legacy_hash
+        db.session.commit()
+        paste = database.paste.get_paste_by_id(paste.paste_id)
+        self.assertFalse(database.paste.check_paste_password(paste, 'other password'))
+        self.assertEqual(legacy_hash, database.paste.get_paste_by_id(paste.paste_id).password_hash)
+        self.assertTrue(database.paste.check_paste_password(paste, 'password'))
+        self.assertNotEqual(legacy_hash, paste.password_hash)
+        self.assertFalse(util.cryptography.password_needs_rehash(paste.password_hash))
+        db.session.remove()
+        self.assertEqual(paste.password_hash, database.paste.get_paste_by_id(paste.paste_id).password_hash)
+
+        # A hash that was changed in the meantime is not overwritten
+        models.Paste.query.filter_by(paste_id=paste.paste_id).update({models.Paste.password_hash: legacy_hash})
+        db.session.commit()
+        stale_paste = database.paste.get_paste_by_id(paste.paste_id)
+        db.session.expunge(stale_paste)
+        database.paste.set_paste_password(paste.paste_id, 'new password')
+        new_password_hash = database.paste.get_paste_by_id(paste.paste_id).password_hash
+        self.assertTrue(database.paste.check_paste_password(stale_paste, 'password'))
+        db.session.remove()
+        self.assertEqual(new_password_hash, database.paste.get_paste_by_id(paste.paste_id).password_hash)
+
+    def test_paste_unlock_token(self):
+        paste = util.testing.PasteFactory.generate(password='password')
+        token = database.paste.get_paste_unlock_token(paste)
+        self.assertTrue(database.paste.check_paste_unlock_token(paste, token))
+        self.assertFalse(database.paste.check_paste_unlock_token(paste, None))
+        self.assertFalse(database.paste.check_paste_unlock_token(paste, 'invalid'))
+        # Tokens are scoped to a single paste
+        other_paste = util.testing.PasteFactory.generate(password='password')
+        self.assertFalse(database.paste.check_paste_unlock_token(other_paste, token))
+
+        # Changing the password invalidates outstanding tokens, even if the password stays the same
+        paste = database.paste.set_paste_password(paste.paste_id, 'password')
+        self.assertFalse(database.paste.check_paste_unlock_token(paste, token))
+        token = database.paste.get_paste_unlock_token(paste)
+        self.assertTrue(database.paste.check_paste_unlock_token(paste, token))
+
+        with mock.patch.object(config, 'PASTE_UNLOCK_TOKEN_TTL', 0):
+            self.assertIsNone(database.paste.get_paste_unlock_token(paste))
+            self.assertFalse(database.paste.check_paste_unlock_token(paste, token))
+
     def test_add_paste_password(self):
         paste = util.testing.PasteFactory.generate(password=None)
         self.assertIsNone(database.paste.get_paste_by_id(paste.paste_id).password_hash)
@@ -133,6 +473,185 @@ class TestPaste(util.testing.DatabaseTestCase):
             database.paste.increment_paste_views(paste.paste_id)
         self.assertEqual(51, database.paste.get_paste_by_id(paste.paste_id).views)
 
+    def test_view_paste(self):
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.view_paste,
+            -1,
+        )
+
+        paste = util.testing.PasteFactory.generate(password=None)
+        viewed_paste, is_first_view = database.paste.view_paste(paste.paste_id)
+        self.assertEqual(paste.paste_id, viewed_paste.paste_id)
+        self.assertEqual(1, viewed_paste.views)
+        self.assertTrue(is_first_view)
+        viewed_paste, is_first_view = database.paste.view_paste(paste.paste_id)
+        self.assertEqual(2, viewed_paste.views)
+        self.assertFalse(is_first_view)
+
+        # Inactive and expired pastes are neither returned nor counted
+        database.paste.deactivate_paste(paste.paste_id)
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.view_paste,
+            paste.paste_id,
+        )
+        self.assertEqual(2, database.paste.get_paste_by_id(paste.paste_id).views)
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 1000)
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.view_paste,
+            paste.paste_id,
+        )
+        self.assertEqual(0, database.paste.get_paste_by_id(paste.paste_id).views)
+
+    def test_view_paste_single_statement(self):
+        paste = util.testing.PasteFactory.generate()
+        with mock.patch.object(database.paste, 'get_paste_by_id') as mock_get_paste_by_id:
+            database.paste.view_paste(paste.paste_id)
+            self.assertEqual(0, mock_get_paste_by_id.call_count)
+
+    def test_view_paste_protected(self):
+        paste = util.testing.PasteFactory.generate(password='password')
+
+        # The view of a password-protected paste can be left for the caller to count
+        viewed_paste, is_first_view = database.paste.view_paste(paste.paste_id, count_protected=False)
+        self.assertEqual(paste.paste_id, viewed_paste.paste_id)
+        self.assertFalse(is_first_view)
+        db.session.remove()
+        self.assertEqual(0, database.paste.get_paste_by_id(paste.paste_id).views)
+
+        viewed_paste, is_first_view = database.paste.view_paste(paste.paste_id)
+        self.assertTrue(is_first_view)
+        self.assertEqual(1, viewed_paste.views)
+
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.view_paste,
+            -1,
+            count_protected=False,
+        )
+
+    def test_view_paste_buffered(self):
+        config.PASTE_VIEW_FLUSH_INTERVAL = 60
+        paste = util.testing.PasteFactory.generate(password=None)
+        protected_paste = util.testing.PasteFactory.generate(password='password')
+
+        with mock.patch.object(database.paste.paste_view_counter, '_ensure_flush_thread'), \
+                mock.patch.object(database.paste.paste_view_counter, 'flush_interval', 60):
+            database.paste.flush_paste_views()
+            self.assertTrue(database.paste.view_paste(paste.paste_id)[1])
+            self.assertFalse(database.paste.view_paste(paste.paste_id)[1])
+            self.assertEqual(1, database.paste.paste_view_counter.pending(paste.paste_id))
+
+            self.assertFalse(database.paste.view_paste(protected_paste.paste_id, count_protected=False)[1])
+            db.session.remove()
+            self.assertEqual(0, database.paste.get_paste_by_id(protected_paste.paste_id).views)
+            self.assertEqual(0, database.paste.paste_view_counter.pending(protected_paste.paste_id))
+
+            self.assertRaises(
+                PasteDoesNotExistException,
+                database.paste.view_paste,
+                -1,
+            )
+
+    def test_record_paste_view(self):
+        paste = util.testing.PasteFactory.generate()
+
+        # Only the first view of the paste is reported as such
+        self.assertTrue(database.paste.record_paste_view(paste.paste_id, views=0))
+        self.assertFalse(database.paste.record_paste_view(paste.paste_id, views=0))
+        self.assertFalse(database.paste.record_paste_view(paste.paste_id, views=2))
+        self.assertFalse(database.paste.record_paste_view(paste.paste_id))
+        db.session.remove()
+        self.assertEqual(4, database.paste.get_paste_by_id(paste.paste_id).views)
+
+    def test_record_paste_view_buffered(self):
+        config.PASTE_VIEW_FLUSH_INTERVAL = 60
+        paste = util.testing.PasteFactory.generate()
+        other_paste = util.testing.PasteFactory.generate()
+
+        with mock.patch.object(database.paste.paste_view_counter, '_ensure_flush_thread'), \
+                mock.patch.object(database.paste.paste_view_counter, 'flush_interval', 60):
+            database.paste.flush_paste_views()
+            # The first view is written through immediately; subsequent views are buffered
+            self.assertTrue(database.paste.record_paste_view(paste.paste_id, views=0))
+            for i in range(10):
+                self.assertFalse(database.paste.record_paste_view(paste.paste_id, views=1))
+            database.paste.record_paste_view(other_paste.paste_id, views=5)
+            db.session.remove()
+            self.assertEqual(1, database.paste.get_paste_by_id(paste.paste_id).views)
+            self.assertEqual(0, database.paste.get_paste_by_id(other_paste.paste_id).views)
+            self.assertEqual(10, database.paste.paste_view_counter.pending(paste.paste_id))
+
+            database.paste.flush_paste_views()
+            db.session.remove()
+            self.assertEqual(11, database.paste.get_paste_by_id(paste.paste_id).views)
+            self.assertEqual(1, database.paste.get_paste_by_id(other_paste.paste_id).views)
+            self.assertEqual(0, database.paste.paste_view_counter.pending(paste.paste_id))
+
+    def test_flush_paste_views_threshold(self):
+        config.PASTE_VIEW_FLUSH_INTERVAL = 60
+        pastes = [util.testing.PasteFactory.generate() for _ in range(5)]
+
+        with mock.patch.object(database.paste.paste_view_counter, '_ensure_flush_thread'), \
+                mock.patch.object(database.paste.paste_view_counter, 'flush_interval', 60), \
+                mock.patch.object(database.paste.paste_view_counter, 'flush_threshold', 5):
+            database.paste.flush_paste_views()
+            for paste in pastes[:4]:
+                database.paste.record_paste_view(paste.paste_id, views=1)
+            self.assertEqual(4, database.paste.paste_view_counter.stats()['pending_keys'])
+            # Reaching the threshold flushes all pending views in one batch
+            database.paste.record_paste_view(pastes[4].paste_id, views=1)
+            self.assertEqual(0, database.paste.paste_view_counter.stats()['pending_keys'])
+            db.session.remove()
+            for paste in pastes:
+                self.assertEqual(1, database.paste.get_paste_by_id(paste.paste_id).views)
+
+    def test_flush_paste_views_threshold_session(self):
+        config.PASTE_VIEW_FLUSH_INTERVAL = 60
+        pastes = [util.testing.PasteFactory.generate(title='title') for _ in range(2)]
+        paste_ids = [paste.paste_id for paste in pastes]
+
+        with mock.patch.object(database.paste.paste_view_counter, '_ensure_flush_thread'), \
+                mock.patch.object(database.paste.paste_view_counter, 'flush_interval', 60), \
+                mock.patch.object(database.paste.paste_view_counter, 'flush_threshold', 2):
+            database.paste.flush_paste_views()
+            # The inline flush neither commits nor rolls back the changes pending in the request's session
+            pastes[0].title = 'pending title'
+            for paste in pastes:
+                database.paste.record_paste_view(paste.paste_id, views=1)
+            self.assertEqual(0, database.paste.paste_view_counter.stats()['pending_keys'])
+            self.assertIn(pastes[0], db.session.dirty)
+            self.assertEqual('pending title', pastes[0].title)
+            db.session.rollback()
+            db.session.remove()
+            self.assertEqual('title', database.paste.get_paste_by_id(paste_ids[0]).title)
+            for paste_id in paste_ids:
+                self.assertEqual(1, database.paste.get_paste_by_id(paste_id).views)
+
+    def test_flush_paste_views_failure(self):
+        config.PASTE_VIEW_FLUSH_INTERVAL = 60
+        paste = util.testing.PasteFactory.generate()
+
+        with mock.patch.object(database.paste.paste_view_counter, '_ensure_flush_thread'), \
+                mock.patch.object(database.paste.paste_view_counter, 'flush_interval', 60):
+            database.paste.flush_paste_views()
+            database.paste.record_paste_view(paste.paste_id, views=1)
+
+            # Views that aren't written remain pending, and the session remains usable
+            with mock.patch.object(db.session, 'commit', side_effect=IntegrityError('statement', {}, Exception())):
+                self.assertRaises(IntegrityError, database.paste.flush_paste_views)
+            self.assertEqual(1, database.paste.paste_view_counter.pending(paste.paste_id))
+            self.assertEqual(0, database.paste.get_paste_by_id(paste.paste_id).views)
+
+            # Views that are written are not counted again if the leaderboard can't be updated
+            with mock.patch.object(database.paste, '_update_top_pastes', side_effect=IntegrityError('statement', {}, Exception())):
+                database.paste.flush_paste_views()
+            self.assertEqual(0, database.paste.paste_view_counter.pending(paste.paste_id))
+            db.session.remove()
+            self.assertEqual(1, database.paste.get_paste_by_id(paste.paste_id).views)
+
     def test_get_recent_pastes(self):
         pastes = []
         for i in range(15):
@@ -145,6 +664,36 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual([], database.paste.get_recent_pastes(3, 5))
         self.assertEqual([], database.paste.get_recent_pastes(4, 5))
 
+    def test_get_recent_pastes_summary(self):
+        util.testing.PasteFactory.generate(contents='contents' * 100, expiry_time=None)
+        db.session.remove()
+        paste = database.paste.get_recent_pastes(0, 5)[0]
+        # Contents are not loaded by default, but their size and preview are
+        self.assertNotIn('plain_contents', paste.__dict__)
+        self.assertNotIn('content', paste.__dict__)
+        self.assertEqual(800, paste.__dict__['contents_size'])
+        self.assertEqual(('contents' * 100)[:models.paste.CONTENTS_PREVIEW_LENGTH], paste.__dict__['contents_preview'])
+        summary = paste.as_dict(include_contents=False)
+        self.assertNotIn('contents', summary)
+        self.assertEqual(800, summary['contents_size'])
+        self.assertNotIn('content', paste.__dict__)
+
+        db.session.remove()
+        paste = database.paste.get_recent_pastes(0, 5, include_contents=True)[0]
+        self.assertEqual('contents' * 100, paste.__dict__['content'].__dict__['plain_contents'])
+        self.assertNotIn('contents_size', paste.__dict__)
+
+    def test_get_recent_pastes_summary_compressed(self):
+        config.ENABLE_PASTE_COMPRESSION = True
+        util.testing.PasteFactory.generate(contents='contents' * 1000, expiry_time=None)
+        db.session.remove()
+        paste = database.paste.get_recent_pastes(0, 5)[0]
+        self.assertNotIn('content', paste.__dict__)
+        summary = paste.as_dict(include_contents=False)
+        self.assertEqual(8000, summary['contents_size'])
+        self.assertEqual(('contents' * 1000)[:models.paste.CONTENTS_PREVIEW_LENGTH], paste.contents_preview)
+        self.assertNotIn('content', paste.__dict__)
+
     def test_get_top_pastes(self):
         pastes = [util.testing.PasteFactory.generate() for i in range(15)]
         for paste in pastes:
@@ -157,6 +706,191 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual([], database.paste.get_top_pastes(3, 5))
         self.assertEqual([], database.paste.get_top_pastes(4, 5))
 
+    def test_get_recent_pastes_cursor(self):
+        pastes = []
+        for i in range(15):
+            # Include pastes with identical post times, which are ordered by paste ID
+            with mock.patch.object(time, 'time', return_value=time.time() + random.randint(-10, 10)):
+                pastes.append(util.testing.PasteFactory.generate(expiry_time=None))
+        recent_pastes_sorted = sorted(pastes, key=lambda paste: (paste.post_time, paste.paste_id), reverse=True)
+        queried_pastes = database.paste.get_recent_pastes(0, 5)
+        self.assertEqual(recent_pastes_sorted[0:5], queried_pastes)
+        for page_num in [1, 2]:
+            cursor = database.paste.get_recent_pastes_cursor(queried_pastes[-1])
+            # The page number is ignored when a cursor is specified
+            queried_pastes = database.paste.get_recent_pastes(0, 5, cursor=cursor)
+            self.assertEqual(recent_pastes_sorted[page_num * 5:(page_num + 1) * 5], queried_pastes)
+            self.assertEqual(queried_pastes, database.paste.get_recent_pastes(page_num, 5))
+        cursor = database.paste.get_recent_pastes_cursor(queried_pastes[-1])
+        self.assertEqual([], database.paste.get_recent_pastes(None, 5, cursor=cursor))
+
+    def test_get_top_pastes_cursor(self):
+        pastes = [util.testing.PasteFactory.generate() for i in range(15)]
+        for paste in pastes:
+            for i in range(random.randint(0, 5)):
+                database.paste.increment_paste_views(paste.paste_id)
+        top_pastes_sorted = sorted(pastes, key=lambda paste: (paste.views, paste.paste_id), reverse=True)
+        queried_pastes = database.paste.get_top_pastes(0, 5)
+        self.assertEqual(top_pastes_sorted[0:5], queried_pastes)
+        for page_num in [1, 2]:
+            cursor = database.paste.get_top_pastes_cursor(queried_pastes[-1])
+            queried_pastes = database.paste.get_top_pastes(None, 5, cursor=cursor)
+            self.assertEqual(top_pastes_sorted[page_num * 5:(page_num + 1) * 5], queried_pastes)
+        cursor = database.paste.get_top_pastes_cursor(queried_pastes[-1])
+        self.assertEqual([], database.paste.get_top_pastes(None, 5, cursor=cursor))
+
+    def test_get_pastes_invalid_cursor(self):
+        paste = util.testing.PasteFactory.generate()
+        for cursor in ['invalid', 'W10=', '\u2603', 12345]:
+            self.assertRaises(InvalidCursorException, database.paste.get_recent_pastes, None, 5, cursor=cursor)
+        # Cursors can't be used across lists with different sort orders
+        self.assertRaises(
+            InvalidCursorException,
+            database.paste.get_top_pastes,
+            None,
+            5,
+            cursor=database.paste.get_recent_pastes_cursor(paste),
+        )
+
+    def test_top_pastes_leaderboard(self):
+        def leaderboard_paste_ids():
+            return [
+                top_paste.paste_id
+                for top_paste in models.TopPaste.query.order_by(models.TopPaste.views.desc(), models.TopPaste.paste_id.desc())
+            ]
+
+        def top_paste_ids():
+            return [
+                paste.paste_id
+                for paste in sorted(pastes, key=lambda paste: (paste.views, paste.paste_id), reverse=True)
+                if paste.is_active
+            ]
+
+        with mock.patch.object(config, 'TOP_PASTES_LEADERBOARD_SIZE', 5):
+            pastes = [util.testing.PasteFactory.generate(expiry_time=None) for i in range(10)]
+            for views, paste in enumerate(pastes):
+                for i in range(views):
+                    database.paste.increment_paste_views(paste.paste_id)
+            # The leaderboard fills up as pastes are viewed
+            self.assertEqual(top_paste_ids()[0:5], leaderboard_paste_ids())
+            database.paste.rebuild_top_pastes()
+            self.assertEqual(top_paste_ids()[0:5], leaderboard_paste_ids())
+
+            # Pastes that overtake the lowest paste on the leaderboard replace it
+            for i in range(6):
+                database.paste.increment_paste_views(pastes[0].paste_id)
+            self.assertEqual(top_paste_ids()[0:5], leaderboard_paste_ids())
+            self.assertIn(pastes[0].paste_id, leaderboard_paste_ids())
+            database.paste.record_paste_view(pastes[1].paste_id)
+            db.session.refresh(pastes[1])
+            self.assertEqual(top_paste_ids()[0:5], leaderboard_paste_ids())
+
+            # Deactivated pastes are replaced on the leaderboard by the next pastes below it, and chunks beyond it are
+            # queried by sorting
+            database.paste.deactivate_paste(pastes[9].paste_id)
+            self.assertEqual(top_paste_ids()[0:5], leaderboard_paste_ids())
+            for page_num in [0, 1]:
+                self.assertEqual(
+                    top_paste_ids()[page_num * 5:(page_num + 1) * 5],
+                    [paste.paste_id for paste in database.paste.get_top_pastes(page_num, 5)],
+                )
+
+            # Scrubbing rebuilds the leaderboard
+            database.paste.scrub_inactive_pastes()
+            pastes.remove(pastes[9])
+            self.assertEqual(top_paste_ids()[0:5], leaderboard_paste_ids())
+
+    def test_top_pastes_leaderboard_seeded(self):
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with mock.patch.object(config, 'TOP_PASTES_LEADERBOARD_SIZE', 4):
+            # Starting from an empty leaderboard, with pastes that were never viewed
+            pastes = [util.testing.PasteFactory.generate(expiry_time=None, password=None) for i in range(6)]
+            self.assertEqual(0, models.TopPaste.query.count())
+            for views, paste in enumerate(pastes[:5]):
+                for i in range(views + 1):
+                    database.paste.view_paste(paste.paste_id)
+            self.assertEqual(4, models.TopPaste.query.count())
+            db.session.remove()
+
+            # Chunks within the leaderboard are served from it, without sorting all pastes
+            event.listen(db.engine, 'before_cursor_execute', record_statement)
+            try:
+                top_pastes = database.paste.get_top_pastes(0, 2) + database.paste.get_top_pastes(1, 2)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record_statement)
+            self.assertEqual([paste.paste_id for paste in reversed(pastes[1:5])], [paste.paste_id for paste in top_pastes])
+            self.assertEqual(2, len(statements))
+            self.assertTrue(all('top_paste' in statement for statement in statements))
+
+            # Expired pastes are replaced on the leaderboard by the next pastes below it once they cut a chunk short
+            models.Paste.query.filter_by(paste_id=pastes[4].paste_id).update({models.Paste.expiry_time: int(time.time()) - 1})
+            db.session.commit()
+            self.assertEqual(
+                [paste.paste_id for paste in reversed(pastes[0:4])],
+                [paste.paste_id for paste in database.paste.get_top_pastes(0, 4)],
+            )
+            self.assertEqual(
+                {paste.paste_id for paste in pastes[0:4]},
+                {top_paste.paste_id for top_paste in models.TopPaste.query.all()},
+            )
+
+    def test_top_pastes_leaderboard_floor(self):
+        with mock.patch.object(config, 'TOP_PASTES_LEADERBOARD_SIZE', 2):
+            pastes = [util.testing.PasteFactory.generate(expiry_time=None, password=None) for i in range(3)]
+            for views, paste in enumerate(pastes):
+                for i in range(views * 2):
+                    database.paste.increment_paste_views(paste.paste_id)
+            database.paste.rebuild_top_pastes()
+            database.paste.view_paste(pastes[0].paste_id)
+            db.session.remove()
+
+            statements = []
+
+            def record_statement(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            # Views of pastes below the leaderboard don't touch it
+            event.listen(db.engine, 'before_cursor_execute', record_statement)
+            try:
+                database.paste.view_paste(pastes[0].paste_id)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record_statement)
+            self.assertFalse([statement for statement in statements if 'top_paste' in statement])
+
+            # Pastes that overtake the lowest paste on the leaderboard replace it
+            database.paste.view_paste(pastes[0].paste_id)
+            self.assertEqual(
+                {pastes[0].paste_id, pastes[2].paste_id},
+                {top_paste.paste_id for top_paste in models.TopPaste.query.all()},
+            )
+
+    def test_top_pastes_leaderboard_cursor(self):
+        with mock.patch.object(config, 'TOP_PASTES_LEADERBOARD_SIZE', 5):
+            pastes = [util.testing.PasteFactory.generate(expiry_time=None) for i in range(8)]
+            for paste in pastes:
+                for i in range(random.randint(0, 5)):
+                    database.paste.increment_paste_views(paste.paste_id)
+            top_pastes_sorted = sorted(pastes, key=lambda paste: (paste.views, paste.paste_id), reverse=True)
+            database.paste.rebuild_top_pastes()
+            queried_pastes = database.paste.get_top_pastes(0, 2)
+            self.assertEqual(top_pastes_sorted[0:2], queried_pastes)
+            for page_num in [1, 2, 3]:
+                cursor = database.paste.get_top_pastes_cursor(queried_pastes[-1])
+                queried_pastes = database.paste.get_top_pastes(None, 2, cursor=cursor)
+                self.assertEqual(top_pastes_sorted[page_num * 2:(page_num + 1) * 2], queried_pastes)
+
+    def test_top_pastes_leaderboard_disabled(self):
+        with mock.patch.object(config, 'TOP_PASTES_LEADERBOARD_SIZE', 0):
+            pastes = [util.testing.PasteFactory.generate() for i in range(3)]
+            database.paste.increment_paste_views(pastes[0].paste_id)
+            self.assertEqual(pastes[0], database.paste.get_top_pastes(0, 5)[0])
+            database.paste.rebuild_top_pastes()
+            self.assertEqual(0, models.TopPaste.query.count())
+
     def test_get_all_pastes_for_user(self):
         user = util.testing.UserFactory.generate()
         pastes = []
@@ -195,7 +929,8 @@ class TestPaste(util.testing.DatabaseTestCase):
         deactivated_pastes = [database.paste.deactivate_paste(paste.paste_id) for paste in pastes[:10]]
         with mock.patch.object(shutil, 'rmtree') as mock_rmtree:
             database.paste.scrub_inactive_pastes()
-            self.assertEqual(10, mock_rmtree.call_count)
+            # The directories of attachments stored per paste are removed in both the sharded and the earlier layout
+            self.assertEqual(20, mock_rmtree.call_count)
             for deactivated_paste in deactivated_pastes:
                 self.assertRaises(
                     PasteDoesNotExistException,
@@ -215,6 +950,120 @@ class TestPaste(util.testing.DatabaseTestCase):
                     self.assertIsNotNone(database.paste.get_paste_by_id(paste.paste_id))
                     self.assertIsNotNone(database.attachment.get_attachment_by_name(paste.paste_id, 'file', active_only=True))
 
+    def test_scrub_inactive_pastes_deduplicated(self):
+        pastes = [util.testing.PasteFactory.generate(contents='contents', expiry_time=None) for _ in range(3)]
+        other_paste = util.testing.PasteFactory.generate(contents='other contents', expiry_time=None)
+        content_hash = pastes[0].content_hash
+        database.paste.deactivate_paste(pastes[0].paste_id)
+        database.paste.deactivate_paste(pastes[1].paste_id)
+        database.paste.deactivate_paste(other_paste.paste_id)
+        with mock.patch.object(shutil, 'rmtree'):
+            database.paste.scrub_inactive_pastes()
+        db.session.remove()
+
+        # Contents are deleted only once no paste references them
+        self.assertEqual(1, models.PasteContent.query.filter_by(content_hash=content_hash).first().ref_count)
+        self.assertIsNone(models.PasteContent.query.filter_by(content_hash=other_paste.content_hash).first())
+        self.assertEqual('contents', database.paste.get_paste_by_id(pastes[2].paste_id).contents)
+
+        database.paste.deactivate_paste(pastes[2].paste_id)
+        with mock.patch.object(shutil, 'rmtree'):
+            database.paste.scrub_inactive_pastes()
+        self.assertEqual(0, models.PasteContent.query.count())
+
+    def test_scrub_inactive_pastes_attachment_blobs(self):
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()):
+            pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(3)]
+            shared_hash = [
+                database.attachment.create_new_attachment_from_stream(paste.paste_id, 'file', 'text/plain', [b'shared'])[1]
+                for paste in pastes[:2]
+            ][0]
+            _, unique_hash = database.attachment.create_new_attachment_from_stream(pastes[2].paste_id, 'file', 'text/plain', [b'unique'])
+            database.paste.deactivate_paste(pastes[0].paste_id)
+            database.paste.deactivate_paste(pastes[2].paste_id)
+            database.paste.scrub_inactive_pastes()
+
+            # Blobs are deleted, along with their files, only once no attachment references them
+            self.assertEqual(1, models.AttachmentBlob.query.filter_by(content_hash=shared_hash).first().ref_count)
+            self.assertIsNone(models.AttachmentBlob.query.filter_by(content_hash=unique_hash).first())
+            self.assertEqual([shared_hash], util.testing.list_blob_files())
+            file_path, _ = database.attachment.get_attachment_file(
+                database.attachment.get_attachment_by_name(pastes[1].paste_id, 'file'),
+            )
+            with open(file_path, 'rb') as attachment_file:
+                self.assertEqual(b'shared', attachment_file.read())
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
+    def test_scrub_inactive_pastes_batches(self):
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(12)]
+        [util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_name='file') for paste in pastes]
+        inactive_pastes = pastes[:7]
+        for paste in inactive_pastes[:6]:
+            database.paste.deactivate_paste(paste.paste_id)
+        inactive_pastes[6].expiry_time = int(time.time()) - 1
+        db.session.commit()
+
+        progress = []
+        with mock.patch.object(shutil, 'rmtree'), \
+                mock.patch.object(db.session, 'commit', wraps=db.session.commit) as mock_commit:
+            # Resuming after a paste skips the pastes up to it
+            final_progress = database.paste.scrub_inactive_pastes(
+                batch_size=3,
+                after_paste_id=inactive_pastes[0].paste_id,
+                on_batch=progress.append,
+            )
+            # Each batch is committed on its own, followed by the removal of its orphaned blobs, and then by the rebuilt
+            # leaderboard
+            self.assertEqual(5, mock_commit.call_count)
+        self.assertEqual([3, 6], [batch_progress['pastes'] for batch_progress in progress])
+        self.assertEqual([3, 6], [batch_progress['attachments'] for batch_progress in progress])
+        self.assertEqual(
+            [inactive_pastes[3].paste_id, inactive_pastes[6].paste_id],
+            [batch_progress['last_paste_id'] for batch_progress in progress],
+        )
+        self.assertEqual(2, final_progress['batches'])
+        self.assertEqual(6, final_progress['pastes'])
+        self.assertEqual(6, final_progress['blobs'])
+        self.assertIsNotNone(database.paste.get_paste_by_id(inactive_pastes[0].paste_id))
+        for paste in inactive_pastes[1:]:
+            self.assertRaises(PasteDoesNotExistException, database.paste.get_paste_by_id, paste.paste_id)
+        for paste in pastes[7:]:
+            self.assertIsNotNone(database.paste.get_paste_by_id(paste.paste_id))
+        self.assertEqual(6, models.Attachment.query.count())
+
+    def test_scrub_inactive_pastes_dry_run(self):
+        pastes = [util.testing.PasteFactory.generate(contents='contents', expiry_time=None) for _ in range(5)]
+        [util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_name='file') for paste in pastes]
+        [database.paste.deactivate_paste(paste.paste_id) for paste in pastes[:3]]
+        with mock.patch.object(shutil, 'rmtree') as mock_rmtree:
+            progress = database.paste.scrub_inactive_pastes(dry_run=True)
+            self.assertEqual(0, mock_rmtree.call_count)
+        self.assertEqual(1, progress['batches'])
+        self.assertEqual(3, progress['pastes'])
+        self.assertEqual(3, progress['attachments'])
+        self.assertEqual(3, progress['blobs'])
+        self.assertEqual(pastes[2].paste_id, progress['last_paste_id'])
+
+        # Nothing is deleted
+        paste_ids = [paste.paste_id for paste in pastes]
+        db.session.remove()
+        for paste_id in paste_ids:
+            self.assertIsNotNone(database.paste.get_paste_by_id(paste_id))
+        self.assertEqual(5, models.Attachment.query.count())
+        self.assertEqual(5, models.AttachmentBlob.query.count())
+        self.assertEqual(5, models.PasteContent.query.first().ref_count)
+
+    def test_scrub_inactive_pastes_rate_limit(self):
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(4)]
+        [database.paste.deactivate_paste(paste.paste_id) for paste in pastes]
+        with mock.patch.object(shutil, 'rmtree'), \
+                mock.patch.object(time, 'sleep') as mock_sleep:
+            database.paste.scrub_inactive_pastes(batch_size=2, max_rate=1)
+            # Scrubbing waits after each batch until it is back under the rate limit
+            self.assertEqual(2, mock_sleep.call_count)
+            self.assertAlmostEqual(2, mock_sleep.call_args_list[0][0][0], delta=1)
+        self.assertEqual(0, models.Paste.query.count())
+
     def test_scrub_inactive_pastes_none(self):
         pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(15)]
         with mock.patch.object(shutil, 'rmtree') as mock_rmtree:
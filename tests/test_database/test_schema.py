@@ -0,0 +1,70 @@
+import sqlalchemy
+
+import database.schema
+import models
+import util.testing
+from modern_paste import db
+
+
+class TestSchema(util.testing.DatabaseTestCase):
+    def assertSchemaUpToDate(self):
+        self.assertEqual(
+            {
+                'tables': [],
+                'columns': [],
+                'indexes': [],
+            },
+            database.schema.get_missing_schema(),
+        )
+        self.assertEqual([], database.schema.get_migration_statements())
+
+    def execute(self, statement):
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text(statement))
+
+    def drop_paste_index(self, name):
+        # Dropped through the model, so that the statement is valid in the test database's dialect
+        next(index for index in models.Paste.__table__.indexes if index.name == name).drop(db.engine)
+
+    def test_get_missing_schema_up_to_date(self):
+        self.assertSchemaUpToDate()
+        self.assertEqual([], database.schema.migrate_schema())
+
+    def test_missing_table(self):
+        models.Attachment.__table__.drop(db.engine)
+        missing = database.schema.get_missing_schema()
+        self.assertEqual([models.Attachment.__table__], missing['tables'])
+        self.assertEqual([], missing['indexes'])
+        statements = database.schema.migrate_schema()
+        self.assertEqual(1 + len(models.Attachment.__table__.indexes), len(statements))
+        self.assertSchemaUpToDate()
+        util.testing.AttachmentFactory.generate()
+
+    def test_missing_column(self):
+        self.execute('ALTER TABLE paste DROP COLUMN is_api_post')
+        missing = database.schema.get_missing_schema()
+        self.assertEqual([models.Paste.__table__.c.is_api_post], missing['columns'])
+        database.schema.migrate_schema()
+        self.assertSchemaUpToDate()
+        self.assertFalse(util.testing.PasteFactory.generate().is_api_post)
+
+    def test_missing_index(self):
+        self.drop_paste_index('ix_paste_is_active_views_paste_id')
+        self.drop_paste_index('ix_paste_expiry_time')
+        missing = database.schema.get_missing_schema()
+        self.assertEqual(
+            ['ix_paste_expiry_time', 'ix_paste_is_active_views_paste_id'],
+            [index.name for index in missing['indexes']],
+        )
+        statements = database.schema.get_migration_statements(missing)
+        self.assertEqual(2, len(statements))
+        for statement in statements:
+            self.assertTrue(statement.startswith('CREATE INDEX'))
+        self.assertEqual(statements, database.schema.migrate_schema(statements))
+        self.assertSchemaUpToDate()
+
+    def test_missing_index_equivalent(self):
+        # An index on the same columns, but with a different name, is sufficient
+        self.drop_paste_index('ix_paste_expiry_time')
+        self.execute('CREATE INDEX paste_expiry_time ON paste (expiry_time)')
+        self.assertSchemaUpToDate()
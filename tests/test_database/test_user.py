@@ -1,3 +1,5 @@
+import mock
+
 from util.exception import *
 
 import util.testing
@@ -41,7 +43,7 @@ class TestUser(util.testing.DatabaseTestCase):
         new_user = database.user.get_user_by_id(user.user_id)
         self.assertEqual('new_name', new_user.name)
         self.assertEqual('new@email.com', new_user.email)
-        self.assertEqual(util.cryptography.secure_hash('new_password'), new_user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('new_password', new_user.password_hash))
 
     def test_remove_user_details(self):
         user = util.testing.UserFactory.generate(name='old_name', email='old@email.com', password='old_password')
@@ -49,7 +51,7 @@ class TestUser(util.testing.DatabaseTestCase):
         new_user = database.user.get_user_by_id(user.user_id)
         self.assertIsNone(new_user.name)
         self.assertIsNone(new_user.email)
-        self.assertEqual(util.cryptography.secure_hash('old_password'), new_user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('old_password', new_user.password_hash))
 
     def test_get_user_by_id(self):
         self.assertRaises(
@@ -60,7 +62,7 @@ class TestUser(util.testing.DatabaseTestCase):
         database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.get_user_by_id(1)
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
@@ -84,7 +86,7 @@ class TestUser(util.testing.DatabaseTestCase):
         database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.get_user_by_username('username')
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
@@ -109,7 +111,7 @@ class TestUser(util.testing.DatabaseTestCase):
         generated_user = database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.get_user_by_api_key(generated_user.api_key)
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
@@ -149,6 +151,41 @@ class TestUser(util.testing.DatabaseTestCase):
         database.user.deactivate_user(user.user_id)
         self.assertFalse(database.user.authenticate_user('username', 'password'))
 
+    def test_authenticate_user_rehash(self):
+        user = util.testing.UserFactory.generate(username='username', password='password')
+        user.password_hash = util.cryptography.secure_hash('password')
+        database.user.session.commit()
+
+        # Legacy hashes are verified, and replaced once the password is known
+        self.assertFalse(database.user.authenticate_user('username', 'wrong password'))
+        self.assertEqual(util.cryptography.secure_hash('password'), database.user.get_user_by_id(user.user_id).password_hash)
+        self.assertTrue(database.user.authenticate_user('username', 'password'))
+        password_hash = database.user.get_user_by_id(user.user_id).password_hash
+        self.assertFalse(util.cryptography.password_needs_rehash(password_hash))
+        self.assertTrue(util.cryptography.verify_password('password', password_hash))
+
+        # Hashes of the current settings are kept
+        self.assertTrue(database.user.authenticate_user('username', 'password'))
+        self.assertEqual(password_hash, database.user.get_user_by_id(user.user_id).password_hash)
+
+    def test_authenticate_user_hashing_overloaded(self):
+        user = util.testing.UserFactory.generate(username='username', password='password')
+        legacy_hash = util.cryptography.secure_hash('password')
+        user.password_hash = legacy_hash
+        database.user.session.commit()
+
+        # If the password can be verified, but not hashed again, the legacy hash is kept until a later login
+        with mock.patch.object(util.cryptography, 'hash_password', side_effect=PasswordHashingOverloadedException):
+            self.assertTrue(database.user.authenticate_user('username', 'password'))
+        self.assertEqual(legacy_hash, database.user.get_user_by_id(user.user_id).password_hash)
+        with mock.patch.object(util.cryptography, 'verify_password', side_effect=PasswordHashingOverloadedException):
+            self.assertRaises(
+                PasswordHashingOverloadedException,
+                database.user.authenticate_user,
+                'username',
+                'password',
+            )
+
     def test_deactivate_user(self):
         user = util.testing.UserFactory.generate()
         [util.testing.PasteFactory.generate(user_id=user.user_id) for i in range(15)]
@@ -181,7 +218,7 @@ class TestUser(util.testing.DatabaseTestCase):
         database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.load_user(1)
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
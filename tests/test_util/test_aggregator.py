@@ -0,0 +1,98 @@
+import os
+import time
+import unittest
+
+import mock
+
+import util.aggregator
+
+
+class TestAggregator(unittest.TestCase):
+    def setUp(self):
+        # Don't start background flush threads during tests
+        self.ensure_flush_thread_patcher = mock.patch.object(util.aggregator.DeltaAggregator, '_ensure_flush_thread')
+        self.ensure_flush_thread_patcher.start()
+
+    def tearDown(self):
+        self.ensure_flush_thread_patcher.stop()
+
+    def test_add(self):
+        flush = mock.Mock()
+        aggregator = util.aggregator.DeltaAggregator(flush=flush, flush_interval=60, flush_threshold=3)
+        aggregator.add(1)
+        aggregator.add(1)
+        aggregator.add(2, delta=5)
+        self.assertEqual(2, aggregator.pending(1))
+        self.assertEqual(5, aggregator.pending(2))
+        self.assertEqual(0, aggregator.pending(3))
+        self.assertEqual(0, flush.call_count)
+        self.assertEqual(2, aggregator.stats()['pending_keys'])
+        self.assertEqual(7, aggregator.stats()['pending_total'])
+
+    def test_flush_threshold(self):
+        flush = mock.Mock()
+        aggregator = util.aggregator.DeltaAggregator(flush=flush, flush_interval=60, flush_threshold=3)
+        aggregator.add(1)
+        aggregator.add(2)
+        aggregator.add(1)
+        self.assertEqual(0, flush.call_count)
+        aggregator.add(3)
+        flush.assert_called_once_with({1: 2, 2: 1, 3: 1})
+        self.assertEqual(0, aggregator.pending(1))
+        self.assertEqual(1, aggregator.stats()['flush_count'])
+
+    def test_flush_interval(self):
+        flush = mock.Mock()
+        aggregator = util.aggregator.DeltaAggregator(flush=flush, flush_interval=60, flush_threshold=1000)
+        aggregator.add(1)
+        self.assertEqual(0, flush.call_count)
+        with mock.patch.object(time, 'time', return_value=time.time() + 120):
+            aggregator.add(1)
+        flush.assert_called_once_with({1: 2})
+
+    def test_flush_error(self):
+        flush = mock.Mock(side_effect=Exception)
+        aggregator = util.aggregator.DeltaAggregator(flush=flush, flush_interval=60, flush_threshold=2)
+        aggregator.add(1)
+        # Errors are suppressed when adding, and the deltas stay pending
+        aggregator.add(2)
+        self.assertEqual(1, flush.call_count)
+        self.assertEqual(1, aggregator.pending(1))
+        self.assertEqual(1, aggregator.pending(2))
+        # Errors are propagated when flushing explicitly
+        self.assertRaises(Exception, aggregator.flush)
+        self.assertEqual(1, aggregator.pending(1))
+
+        flush.side_effect = None
+        aggregator.flush()
+        flush.assert_called_with({1: 1, 2: 1})
+        self.assertEqual(0, aggregator.pending(1))
+
+    def test_flush_empty(self):
+        flush = mock.Mock()
+        aggregator = util.aggregator.DeltaAggregator(flush=flush, flush_interval=60, flush_threshold=2)
+        aggregator.flush()
+        self.assertEqual(0, flush.call_count)
+
+    def test_clear(self):
+        flush = mock.Mock()
+        aggregator = util.aggregator.DeltaAggregator(flush=flush, flush_interval=60, flush_threshold=2)
+        aggregator.add(1)
+        aggregator.clear()
+        aggregator.flush()
+        self.assertEqual(0, aggregator.pending(1))
+        self.assertEqual(0, flush.call_count)
+
+    def test_ensure_flush_thread(self):
+        self.ensure_flush_thread_patcher.stop()
+        aggregator = util.aggregator.DeltaAggregator(flush=mock.Mock(), flush_interval=60, flush_threshold=2)
+        with mock.patch('threading.Thread') as mock_thread:
+            aggregator.add(1)
+            aggregator.add(1)
+            # Only one flush thread is started per process
+            self.assertEqual(1, mock_thread.call_count)
+            self.assertEqual(1, mock_thread.return_value.start.call_count)
+            with mock.patch.object(os, 'getpid', return_value=-1):
+                aggregator.add(1)
+            self.assertEqual(2, mock_thread.call_count)
+        self.ensure_flush_thread_patcher.start()
@@ -0,0 +1,103 @@
+import time
+import unittest
+
+import mock
+
+import util.cache
+
+
+class TestCache(unittest.TestCase):
+    def test_lru_cache_get_set(self):
+        cache = util.cache.LRUCache(capacity=3)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', 'value')
+        self.assertEqual('value', cache.get('key'))
+        cache.set('key', 'new value')
+        self.assertEqual('new value', cache.get('key'))
+        self.assertEqual(1, len(cache))
+
+        cache.delete('key')
+        self.assertIsNone(cache.get('key'))
+        cache.delete('nonexistent')
+
+    def test_lru_cache_eviction(self):
+        cache = util.cache.LRUCache(capacity=3)
+        for key in range(3):
+            cache.set(key, str(key))
+        # Touching the oldest key should cause the next oldest key to be evicted instead
+        self.assertEqual('0', cache.get(0))
+        cache.set(3, '3')
+        self.assertEqual(3, len(cache))
+        self.assertEqual('0', cache.get(0))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual('2', cache.get(2))
+        self.assertEqual('3', cache.get(3))
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+        # Zero capacity disables the cache entirely
+        cache = util.cache.LRUCache(capacity=0)
+        cache.set('key', 'value')
+        self.assertIsNone(cache.get('key'))
+
+    def test_lru_cache_ttl(self):
+        cache = util.cache.LRUCache(capacity=3)
+        cache.set('key', 'value', ttl=10)
+        self.assertEqual('value', cache.get('key'))
+        with mock.patch.object(time, 'time', return_value=time.time() + 20):
+            self.assertIsNone(cache.get('key'))
+        self.assertEqual(0, len(cache))
+
+    def test_read_through_cache(self):
+        cache = util.cache.ReadThroughCache(local=util.cache.LRUCache(capacity=3))
+        loader = mock.Mock(return_value='value')
+
+        self.assertEqual('value', cache.get('key', loader))
+        self.assertEqual('value', cache.get('key', loader))
+        self.assertEqual(1, loader.call_count)
+        self.assertEqual(1, cache.stats()['hits'])
+        self.assertEqual(1, cache.stats()['misses'])
+        self.assertEqual(0.5, cache.stats()['hit_ratio'])
+
+        cache.invalidate('key')
+        self.assertEqual('value', cache.get('key', loader))
+        self.assertEqual(2, loader.call_count)
+
+        # Values for which the loader returns None are not cached
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(cache.get('nonexistent', loader))
+        self.assertIsNone(cache.get('nonexistent', loader))
+        self.assertEqual(2, loader.call_count)
+
+        # Values with a non-positive TTL are not cached
+        loader = mock.Mock(return_value='value')
+        self.assertEqual('value', cache.get('uncacheable', loader, ttl=lambda value: 0))
+        self.assertEqual('value', cache.get('uncacheable', loader, ttl=lambda value: 0))
+        self.assertEqual(2, loader.call_count)
+
+        cache.clear()
+        self.assertEqual(0, cache.stats()['hits'])
+        self.assertEqual(0, cache.stats()['misses'])
+        self.assertEqual(0, cache.stats()['size'])
+
+    def test_read_through_cache_shared(self):
+        shared = mock.Mock()
+        shared.get.return_value = None
+        cache = util.cache.ReadThroughCache(local=util.cache.LRUCache(capacity=3), shared=shared)
+        loader = mock.Mock(return_value='value')
+
+        # A miss in both tiers writes the loaded value to both tiers
+        self.assertEqual('value', cache.get('key', loader))
+        shared.set.assert_called_with('key', 'value', None)
+
+        # A hit in the shared tier populates the local tier
+        shared.get.return_value = 'shared value'
+        self.assertEqual('shared value', cache.get('other key', loader))
+        self.assertEqual('shared value', cache.get('other key', loader))
+        self.assertEqual(1, loader.call_count)
+        self.assertEqual(1, cache.stats()['shared_hits'])
+        self.assertEqual(1, cache.stats()['local_hits'])
+
+        cache.invalidate('key')
+        shared.delete.assert_called_with('key')
@@ -0,0 +1,50 @@
+import gzip
+import io
+import unittest
+
+import mock
+
+import util.compression
+from util.exception import *
+
+
+class TestCompression(unittest.TestCase):
+    def test_compress_decompress(self):
+        text = 'contents☃' * 100
+        for codec in util.compression.CODECS:
+            compressed = util.compression.compress(text, codec)
+            self.assertLess(len(compressed), len(text))
+            self.assertEqual(text, util.compression.decompress(compressed, codec))
+
+    def test_invalid_codec(self):
+        self.assertRaises(InvalidCodecException, util.compression.compress, 'text', 'invalid')
+        self.assertRaises(InvalidCodecException, util.compression.decompress, b'text', 'invalid')
+
+    def test_is_text_mime_type(self):
+        for mime_type in ['text/plain', 'text/html; charset=utf-8', 'application/json', 'application/vnd.api+json', 'image/svg+xml', 'APPLICATION/XML']:
+            self.assertTrue(util.compression.is_text_mime_type(mime_type))
+        for mime_type in ['image/png', 'application/octet-stream', 'application/gzip', '', None]:
+            self.assertFalse(util.compression.is_text_mime_type(mime_type))
+
+    def test_gzip(self):
+        data = b'contents' * 10000
+        compressor = util.compression.gzip_compressor()
+        compressed = compressor.compress(data[:1000]) + compressor.compress(data[1000:]) + compressor.flush()
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(data, gzip.decompress(compressed))
+
+        # The compressed data is decompressed in chunks, without reading the whole file at once
+        open_file = mock.Mock(side_effect=lambda: io.BytesIO(compressed))
+        chunks = util.compression.iter_gunzip_file(open_file, chunk_size=16)
+        self.assertFalse(open_file.called)
+        self.assertEqual(data, b''.join(chunks))
+        self.assertEqual(b'', b''.join(util.compression.iter_gunzip_file(lambda: io.BytesIO(gzip.compress(b'')))))
+
+    def test_iter_gunzip_file_bounded(self):
+        # A single chunk of highly compressible data doesn't expand beyond the chunk size at once
+        data = b'\x00' * (64 * util.compression.GZIP_CHUNK_SIZE)
+        compressed = gzip.compress(data)
+        self.assertLess(len(compressed), util.compression.GZIP_CHUNK_SIZE)
+        chunks = list(util.compression.iter_gunzip_file(lambda: io.BytesIO(compressed)))
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), util.compression.GZIP_CHUNK_SIZE)
+        self.assertEqual(data, b''.join(chunks))
@@ -1,5 +1,8 @@
+import time
 import unittest
 
+import mock
+
 import config
 import util.cryptography
 from util.exception import *
@@ -68,6 +71,92 @@ class TestCryptography(unittest.TestCase):
         self.assertEqual(decid, util.cryptography.get_id_repr(decid))
         self.assertEqual(decid, util.cryptography.get_id_repr(encid))
 
+    def test_id_codec(self):
+        codec = util.cryptography.AESIDCodec(config.ID_ENCRYPTION_KEY.encode(), config.ID_ENCRYPTION_IV.encode(), cache_size=2)
+        # The codec is compatible with IDs encrypted by earlier versions, including IDs spanning several blocks
+        self.assertEqual('R24v4GyxJAMHOe9tR7cLyg', codec.encode(15))
+        self.assertEqual(15, codec.decode('R24v4GyxJAMHOe9tR7cLyg'))
+        decids = [15, 10 ** 20, 3, 15, 10 ** 40]
+        encids = codec.encode_many(decids)
+        self.assertEqual('R24v4GyxJAMHOe9tR7cLyg', encids[0])
+        self.assertEqual(encids[0], encids[3])
+        self.assertEqual(43, len(encids[1]))
+        self.assertEqual(decids, codec.decode_many(encids))
+        self.assertEqual(decids, util.cryptography.AESIDCodec(config.ID_ENCRYPTION_KEY.encode(), config.ID_ENCRYPTION_IV.encode()).decode_many(encids))
+        self.assertEqual([], codec.encode_many([]))
+        self.assertEqual([], codec.decode_many([]))
+
+        # Recently used pairs are memoized in both directions, up to the cache size
+        codec.encode_many([3, 10 ** 40])
+        with mock.patch.object(codec, '_cipher', wraps=codec._cipher) as mock_cipher:
+            self.assertEqual(encids[4], codec.encode(10 ** 40))
+            self.assertEqual(3, codec.decode(encids[2]))
+            self.assertFalse(mock_cipher.encrypt.called)
+            self.assertFalse(mock_cipher.decrypt.called)
+            self.assertEqual(encids[1], codec.encode(10 ** 20))
+            self.assertEqual(2, mock_cipher.encrypt.call_count)
+        self.assertEqual(4, len(codec._cache))
+
+        for invalid_encid in ['invalid', '', 'AAAA', u'\ue863', encids[0][:-1]]:
+            self.assertRaises(InvalidIDException, codec.decode, invalid_encid)
+        self.assertRaises(InvalidIDException, codec.decode_many, [encids[0], 'invalid'])
+        self.assertRaises(InvalidIDException, codec.encode, [])
+        self.assertRaises(InvalidIDException, codec.encode_many, [1, 'invalid'])
+
+        # The codec of the configured key is shared
+        self.assertIs(util.cryptography.get_id_codec(), util.cryptography.get_id_codec())
+
+    def test_permutation_id_codec(self):
+        codec = util.cryptography.PermutationIDCodec(b'key')
+        decids = [1, 2, 3, 2 ** 32, 2 ** 64 - 1, 0]
+        encids = codec.encode_many(decids)
+        # Encrypted IDs are short, URL-safe, and distinct
+        for encid in encids:
+            self.assertRegex(encid, '^[0-9A-Za-z]{11}$')
+        self.assertEqual(len(decids), len(set(encids)))
+        self.assertEqual(decids, util.cryptography.PermutationIDCodec(b'key').decode_many(encids))
+        self.assertEqual(encids[0], codec.encode('1'))
+        self.assertEqual(1, codec.decode(encids[0]))
+        # Encrypted IDs depend on the key
+        self.assertNotEqual(encids, util.cryptography.PermutationIDCodec(b'other key').encode_many(decids))
+
+        for invalid_decid in [-1, 2 ** 64, 'invalid', []]:
+            self.assertRaises(InvalidIDException, codec.encode, invalid_decid)
+        # Numbers of 11 base62 digits beyond 64 bits, and IDs of the AES scheme, are not valid
+        for invalid_encid in ['zzzzzzzzzzz', encids[0][:-1], encids[0] + '0', encids[0][:-1] + '-', util.cryptography.get_encid(1)]:
+            self.assertRaises(InvalidIDException, util.cryptography.PermutationIDCodec(b'key').decode, invalid_encid)
+
+    def test_encrypted_id_scheme(self):
+        aes_encid = util.cryptography.get_encid(15)
+        config.USE_ENCRYPTED_IDS = True
+        with mock.patch.object(config, 'ENCRYPTED_ID_SCHEME', 'permutation'):
+            encid = util.cryptography.get_encid(15)
+            self.assertEqual(11, len(encid))
+            self.assertEqual(encid, util.cryptography.get_id_repr(15))
+            self.assertEqual(15, util.cryptography.get_decid(encid))
+            # IDs of the AES scheme are still accepted during the transition
+            self.assertEqual(15, util.cryptography.get_decid(aes_encid))
+            with mock.patch.object(config, 'ACCEPT_LEGACY_ENCRYPTED_IDS', False):
+                self.assertRaises(InvalidIDException, util.cryptography.get_decid, aes_encid)
+                self.assertEqual(15, util.cryptography.get_decid(encid))
+            self.assertRaises(InvalidIDException, util.cryptography.get_decid, 'invalid')
+        self.assertRaises(InvalidIDException, util.cryptography.get_decid, encid)
+        config.USE_ENCRYPTED_IDS = False
+
+    def test_get_id_reprs(self):
+        config.USE_ENCRYPTED_IDS = True
+        self.assertEqual(
+            [util.cryptography.get_encid(1), util.cryptography.get_encid(2)],
+            util.cryptography.get_id_reprs([1, 2]),
+        )
+        self.assertEqual(
+            [util.cryptography.get_encid(1), util.cryptography.get_encid(2)],
+            util.cryptography.get_id_reprs([1, util.cryptography.get_encid(2)]),
+        )
+
+        config.USE_ENCRYPTED_IDS = False
+        self.assertEqual([1, 2], util.cryptography.get_id_reprs([1, util.cryptography.get_encid(2)]))
+
     def test_secure_hash(self):
         # Given the same number of iterations (10000), this result should always be the same
         self.assertEqual(
@@ -79,3 +168,66 @@ class TestCryptography(unittest.TestCase):
             'd5579c46dfcc7f18207013e65b44e4cb4e2c2298f4ac457ba8f82743f31e930b',
             util.cryptography.secure_hash('test string'),
         )
+
+    def test_password_hashers(self):
+        for hasher in [
+            util.cryptography.PBKDF2PasswordHasher(1000),
+            util.cryptography.ScryptPasswordHasher(1024, 8, 1),
+        ]:
+            password_hash = hasher.hash('password')
+            self.assertTrue(password_hash.startswith(hasher.algorithm + '$'))
+            self.assertTrue(util.cryptography.verify_password('password', password_hash))
+            self.assertFalse(util.cryptography.verify_password('other password', password_hash))
+            self.assertFalse(util.cryptography.verify_password(None, password_hash))
+            # Each hash has its own salt
+            self.assertNotEqual(password_hash, hasher.hash('password'))
+            self.assertEqual(hasher.hash('password', salt=b'salt'), hasher.hash('password', salt=b'salt'))
+
+        for invalid_hash in [None, '', 'unknown$1$c2FsdA$a2V5', 'pbkdf2_sha256$invalid$c2FsdA$a2V5', 'scrypt$1024$8$c2FsdA']:
+            self.assertFalse(util.cryptography.verify_password('password', invalid_hash))
+
+    def test_hash_password(self):
+        self.assertIsNone(util.cryptography.hash_password(None))
+        with mock.patch.object(config, 'PASSWORD_PBKDF2_ITERATIONS', 1000):
+            password_hash = util.cryptography.hash_password('password')
+            self.assertTrue(password_hash.startswith('pbkdf2_sha256$1000$'))
+            self.assertTrue(util.cryptography.verify_password('password', password_hash))
+            self.assertFalse(util.cryptography.password_needs_rehash(password_hash))
+        # Hashes of other parameters, or of another hasher, are still verified, but should be replaced
+        self.assertTrue(util.cryptography.password_needs_rehash(password_hash))
+        with mock.patch.object(config, 'PASSWORD_HASHER', 'scrypt'):
+            self.assertTrue(util.cryptography.verify_password('password', password_hash))
+            self.assertTrue(util.cryptography.password_needs_rehash(password_hash))
+            with mock.patch.object(config, 'PASSWORD_SCRYPT_N', 1024):
+                scrypt_hash = util.cryptography.hash_password('password')
+                self.assertTrue(scrypt_hash.startswith('scrypt$1024$8$1$'))
+                self.assertFalse(util.cryptography.password_needs_rehash(scrypt_hash))
+        with mock.patch.object(config, 'PASSWORD_HASHER', 'unknown'):
+            self.assertRaises(ValueError, util.cryptography.hash_password, 'password')
+
+    def test_verify_legacy_password_hash(self):
+        legacy_hash = util.cryptography.secure_hash('password')
+        self.assertTrue(util.cryptography.verify_password('password', legacy_hash))
+        self.assertFalse(util.cryptography.verify_password('other password', legacy_hash))
+        self.assertTrue(util.cryptography.password_needs_rehash(legacy_hash))
+
+    def test_signed_token(self):
+        token = util.cryptography.generate_signed_token('message', 60)
+        self.assertTrue(util.cryptography.verify_signed_token(token, 'message'))
+        self.assertFalse(util.cryptography.verify_signed_token(token, 'other message'))
+        # Neither the expiry time nor the signature can be changed
+        expiry_time, signature = token.split('.')
+        self.assertFalse(util.cryptography.verify_signed_token(
+            '{expiry_time}.{signature}'.format(expiry_time=int(expiry_time) + 60, signature=signature),
+            'message',
+        ))
+        self.assertFalse(util.cryptography.verify_signed_token(expiry_time + '.' + signature[::-1], 'message'))
+        # Tokens are signed with a key derived from the secret key of the installation
+        with mock.patch.object(config, 'FLASK_SECRET_KEY', 'other secret key'):
+            self.assertFalse(util.cryptography.verify_signed_token(token, 'message'))
+
+        with mock.patch.object(time, 'time', return_value=time.time() + 61):
+            self.assertFalse(util.cryptography.verify_signed_token(token, 'message'))
+
+        for invalid_token in [None, '', 'invalid', 'a.b', '1.2.3', expiry_time + '.\u00e9']:
+            self.assertFalse(util.cryptography.verify_signed_token(invalid_token, 'message'))
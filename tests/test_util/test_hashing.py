@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+import sys
+import time
+import unittest
+
+import mock
+
+import config
+import util.cryptography
+import util.hashing
+from util.exception import *
+
+
+class TestHashing(unittest.TestCase):
+    def test_hashing_executor(self):
+        executor = util.hashing.HashingExecutor(max_workers=1, max_pending=1, timeout=30)
+        try:
+            # Functions are run by worker processes
+            self.assertNotEqual(os.getpid(), executor.run(os.getpid))
+            self.assertEqual(4, executor.run(pow, 2, 2))
+            stats = executor.stats()
+            self.assertEqual(0, stats['pending'])
+            self.assertEqual(2, stats['completed'])
+            self.assertGreater(stats['max_latency'], 0)
+            self.assertLessEqual(stats['median_latency'], stats['max_latency'])
+
+            # Calls that time out fail fast, but remain pending until they are actually done
+            executor.timeout = 0.1
+            self.assertRaises(PasswordHashingOverloadedException, executor.run, time.sleep, 1)
+            self.assertEqual(1, executor.stats()['pending'])
+            self.assertEqual(1, executor.stats()['timed_out'])
+            # Calls beyond the maximum number of pending calls are rejected right away
+            self.assertRaises(PasswordHashingOverloadedException, executor.run, os.getpid)
+            self.assertEqual(1, executor.stats()['rejected'])
+
+            executor.timeout = 30
+            for _ in range(50):
+                if not executor.stats()['pending']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(0, executor.stats()['pending'])
+            self.assertEqual(4, executor.run(pow, 2, 2))
+        finally:
+            executor.shutdown()
+
+    def test_get_hashing_executor(self):
+        self.assertIsNone(util.hashing.get_hashing_executor())
+        self.assertEqual(4, util.hashing.run(pow, 2, 2))
+
+        with mock.patch.object(config, 'PASSWORD_HASHING_PROCESSES', 2):
+            executor = util.hashing.get_hashing_executor()
+            self.assertEqual(2, executor.max_workers)
+            self.assertEqual(config.PASSWORD_HASHING_MAX_PENDING, executor.max_pending)
+            self.assertIs(executor, util.hashing.get_hashing_executor())
+            try:
+                # Passwords are hashed and verified by the executor
+                with mock.patch.object(config, 'PASSWORD_PBKDF2_ITERATIONS', 1000):
+                    password_hash = util.cryptography.hash_password('password')
+                self.assertTrue(password_hash.startswith('pbkdf2_sha256$1000$'))
+                self.assertTrue(util.cryptography.verify_password('password', password_hash))
+                self.assertFalse(util.cryptography.verify_password('other password', password_hash))
+                self.assertEqual(3, executor.stats()['completed'])
+            finally:
+                executor.shutdown()
+
+    def test_hashing_executor_python_executable(self):
+        with mock.patch.object(config, 'PASSWORD_HASHING_PROCESSES', 1), \
+                mock.patch.object(config, 'PASSWORD_HASHING_PYTHON_EXECUTABLE', sys.executable):
+            executor = util.hashing.get_hashing_executor()
+            self.assertEqual(sys.executable, executor.executable)
+            spawn_context = multiprocessing.get_context('spawn')
+            try:
+                # Worker processes are started with the configured interpreter
+                with mock.patch.object(spawn_context, 'set_executable', wraps=spawn_context.set_executable) as mock_set_executable:
+                    self.assertEqual(4, executor.run(pow, 2, 2))
+                    mock_set_executable.assert_called_once_with(sys.executable)
+            finally:
+                executor.shutdown()
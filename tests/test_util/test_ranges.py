@@ -0,0 +1,89 @@
+import datetime
+import io
+import unittest
+
+import util.ranges
+from util.exception import *
+
+
+class TestRanges(unittest.TestCase):
+    def test_parse_byte_ranges(self):
+        self.assertEqual([(0, 10)], util.ranges.parse_byte_ranges('bytes=0-9', 100))
+        self.assertEqual([(90, 100)], util.ranges.parse_byte_ranges('bytes=90-', 100))
+        self.assertEqual([(90, 100)], util.ranges.parse_byte_ranges('bytes=-10', 100))
+        self.assertEqual([(0, 100)], util.ranges.parse_byte_ranges('bytes=-1000', 100))
+        self.assertEqual([(50, 100)], util.ranges.parse_byte_ranges('bytes=50-1000', 100))
+        self.assertEqual([(0, 10), (20, 30)], util.ranges.parse_byte_ranges('bytes=0-9, 20-29', 100))
+
+        # Overlapping and adjacent ranges are coalesced
+        self.assertEqual([(0, 20)], util.ranges.parse_byte_ranges('bytes=0-9,10-19', 100))
+        self.assertEqual([(0, 10), (85, 100)], util.ranges.parse_byte_ranges('bytes=0-9,85-94,-10', 100))
+
+        # Ranges beyond the resource are dropped, unless no range overlaps it at all
+        self.assertEqual([(0, 10)], util.ranges.parse_byte_ranges('bytes=0-9,200-299', 100))
+        self.assertRaises(RangeNotSatisfiableException, util.ranges.parse_byte_ranges, 'bytes=100-', 100)
+        self.assertRaises(RangeNotSatisfiableException, util.ranges.parse_byte_ranges, 'bytes=0-', 0)
+
+        # Missing, malformed, or excessive ranges are ignored
+        self.assertIsNone(util.ranges.parse_byte_ranges(None, 100))
+        self.assertIsNone(util.ranges.parse_byte_ranges('bytes=9-0', 100))
+        self.assertIsNone(util.ranges.parse_byte_ranges('items=0-9', 100))
+        self.assertIsNone(util.ranges.parse_byte_ranges(
+            'bytes=' + ','.join('{start}-{start}'.format(start=start * 2) for start in range(util.ranges.MAX_RANGES + 1)),
+            100,
+        ))
+
+    def test_if_range_matches(self):
+        last_modified = datetime.datetime(2016, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertTrue(util.ranges.if_range_matches(None, 'etag', last_modified))
+        self.assertTrue(util.ranges.if_range_matches('"etag"', 'etag', last_modified))
+        self.assertFalse(util.ranges.if_range_matches('"other"', 'etag', last_modified))
+        self.assertFalse(util.ranges.if_range_matches('W/"etag"', 'etag', last_modified))
+        self.assertTrue(util.ranges.if_range_matches('Fri, 01 Jan 2016 00:00:00 GMT', 'etag', last_modified))
+        self.assertFalse(util.ranges.if_range_matches('Sat, 02 Jan 2016 00:00:00 GMT', 'etag', last_modified))
+
+    def test_content_range(self):
+        self.assertEqual('bytes 0-9/100', util.ranges.content_range(0, 10, 100))
+
+    def test_iter_file_range(self):
+        files = []
+
+        def open_file():
+            files.append(io.BytesIO(b'0123456789'))
+            return files[-1]
+
+        chunks = util.ranges.iter_file_range(open_file, 2, 9, chunk_size=3)
+        # The file is only opened once the range is read
+        self.assertEqual([], files)
+        self.assertEqual([b'234', b'567', b'8'], list(chunks))
+        self.assertTrue(files[0].closed)
+
+        # A truncated file ends the range early
+        self.assertEqual([b'89'], list(util.ranges.iter_file_range(open_file, 8, 20)))
+
+    def test_iter_multipart_byteranges(self):
+        boundary, length, body = util.ranges.iter_multipart_byteranges(
+            lambda: io.BytesIO(b'0123456789'),
+            [(0, 2), (5, 10)],
+            10,
+            'text/plain',
+            chunk_size=3,
+        )
+        data = b''.join(body)
+        self.assertEqual(length, len(data))
+        self.assertEqual(
+            (
+                '\r\n--{boundary}\r\n'
+                'Content-Type: text/plain\r\n'
+                'Content-Range: bytes 0-1/10\r\n'
+                '\r\n'
+                '01'
+                '\r\n--{boundary}\r\n'
+                'Content-Type: text/plain\r\n'
+                'Content-Range: bytes 5-9/10\r\n'
+                '\r\n'
+                '56789'
+                '\r\n--{boundary}--\r\n'
+            ).format(boundary=boundary).encode('latin-1'),
+            data,
+        )
@@ -0,0 +1,255 @@
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import mock
+import moto
+
+import util.storage
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    def read(self, size):
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorage(unittest.TestCase):
+    def test_shard_path(self):
+        self.assertEqual('/root/ab/cd/abcdef', util.storage.shard_path('/root', 'abcdef', 'abcdef'))
+        self.assertEqual('/root/12/34/name', util.storage.shard_path('/root', 'name', '123456'))
+
+    def test_local_storage_backend(self):
+        root_dir = os.path.join(tempfile.mkdtemp(), 'blobs')
+        storage = util.storage.LocalStorageBackend(root_dir)
+        self.assertFalse(storage.exists('abcdef'))
+        self.assertIsNone(storage.size('abcdef'))
+
+        storage.put('abcdef', [b'first ', b'chunk'])
+        self.assertTrue(storage.exists('abcdef'))
+        self.assertEqual(11, storage.size('abcdef'))
+        self.assertEqual(os.path.join(root_dir, 'ab', 'cd', 'abcdef'), storage.local_path('abcdef'))
+        with storage.open('abcdef') as object_file:
+            object_file.seek(6)
+            self.assertEqual(b'chunk', object_file.read())
+        self.assertIsNone(storage.redirect_url('abcdef', 'text/plain'))
+
+        with tempfile.NamedTemporaryFile(dir=storage.temp_dir(), delete=False) as temp_file:
+            temp_file.write(b'from file')
+        storage.put_file('123456', temp_file.name)
+        self.assertFalse(os.path.exists(temp_file.name))
+        with storage.open('123456') as object_file:
+            self.assertEqual(b'from file', object_file.read())
+
+        # Objects stored in the earlier layout are found as well
+        with open(os.path.join(root_dir, 'fedcba'), 'wb') as object_file:
+            object_file.write(b'unsharded')
+        self.assertTrue(storage.exists('fedcba'))
+        self.assertEqual(os.path.join(root_dir, 'fedcba'), storage.local_path('fedcba'))
+
+        storage.delete(['abcdef', 'fedcba', 'nonexistent'])
+        self.assertFalse(storage.exists('abcdef'))
+        self.assertFalse(storage.exists('fedcba'))
+        self.assertTrue(storage.exists('123456'))
+        shutil.rmtree(os.path.dirname(root_dir))
+
+    def test_local_storage_backend_put_failure(self):
+        root_dir = tempfile.mkdtemp()
+        storage = util.storage.LocalStorageBackend(root_dir)
+
+        def chunks():
+            yield b'partial'
+            raise ValueError
+
+        # Partially written objects are never visible
+        self.assertRaises(ValueError, storage.put, 'abcdef', chunks())
+        self.assertFalse(storage.exists('abcdef'))
+        self.assertEqual([], os.listdir(os.path.join(root_dir, 'ab', 'cd')))
+        shutil.rmtree(root_dir)
+
+    def test_local_storage_backend_durability(self):
+        root_dir = tempfile.mkdtemp()
+        storage = util.storage.LocalStorageBackend(root_dir)
+        with mock.patch.object(os, 'fsync') as mock_fsync:
+            storage.put('abcdef', [b'data'])
+            # The file, both levels of subdirectories, and the root directory
+            self.assertEqual(4, mock_fsync.call_count)
+        shutil.rmtree(root_dir)
+
+    def test_s3_storage_backend(self):
+        client = mock.Mock()
+        client.exceptions.ClientError = FakeClientError
+        storage = util.storage.S3StorageBackend('bucket', prefix='blobs/', presigned_url_ttl=60, client=client)
+
+        uploaded = []
+        client.upload_fileobj.side_effect = lambda file, bucket, key: uploaded.append((bucket, key, file.read()))
+        storage.put('abcdef', [b'first ', b'', b'chunk'])
+        self.assertEqual([('bucket', 'blobs/abcdef', b'first chunk')], uploaded)
+
+        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        temp_file.close()
+        storage.put_file('123456', temp_file.name)
+        client.upload_file.assert_called_with(temp_file.name, 'bucket', 'blobs/123456')
+        self.assertFalse(os.path.exists(temp_file.name))
+
+        client.head_object.return_value = {'ContentLength': 11}
+        self.assertEqual(11, storage.size('abcdef'))
+        self.assertTrue(storage.exists('abcdef'))
+        client.head_object.assert_called_with(Bucket='bucket', Key='blobs/abcdef')
+        client.head_object.side_effect = FakeClientError('404')
+        self.assertIsNone(storage.size('abcdef'))
+        self.assertFalse(storage.exists('abcdef'))
+        client.head_object.side_effect = FakeClientError('403')
+        self.assertRaises(FakeClientError, storage.exists, 'abcdef')
+
+        storage.delete(['key{index}'.format(index=index) for index in range(1500)])
+        self.assertEqual(2, client.delete_objects.call_count)
+        first_batch, second_batch = [call[1]['Delete']['Objects'] for call in client.delete_objects.call_args_list]
+        self.assertEqual(1000, len(first_batch))
+        self.assertEqual({'Key': 'blobs/key0'}, first_batch[0])
+        self.assertEqual(500, len(second_batch))
+
+        client.generate_presigned_url.return_value = 'https://bucket.example.com/blobs/abcdef?signature'
+        self.assertEqual('https://bucket.example.com/blobs/abcdef?signature', storage.redirect_url('abcdef', 'image/png'))
+        client.generate_presigned_url.assert_called_with(
+            'get_object',
+            Params={'Bucket': 'bucket', 'Key': 'blobs/abcdef', 'ResponseContentType': 'image/png'},
+            ExpiresIn=60,
+        )
+        storage.redirect_url('abcdef.gz', 'text/plain', 'gzip')
+        client.generate_presigned_url.assert_called_with(
+            'get_object',
+            Params={
+                'Bucket': 'bucket',
+                'Key': 'blobs/abcdef.gz',
+                'ResponseContentType': 'text/plain',
+                'ResponseContentEncoding': 'gzip',
+            },
+            ExpiresIn=60,
+        )
+        self.assertIsNone(storage.local_path('abcdef'))
+
+        storage.presigned_url_ttl = None
+        self.assertIsNone(storage.redirect_url('abcdef', 'image/png'))
+
+    def test_s3_storage_backend_open(self):
+        data = b'0123456789'
+        client = mock.Mock()
+        client.exceptions.ClientError = FakeClientError
+        bodies = []
+
+        def get_object(Bucket, Key, Range):
+            start = int(Range[len('bytes='):-1])
+            if start >= len(data):
+                raise FakeClientError('InvalidRange')
+            bodies.append(FakeBody(data[start:]))
+            return {'Body': bodies[-1]}
+
+        client.get_object.side_effect = get_object
+        storage = util.storage.S3StorageBackend('bucket', client=client)
+
+        with storage.open('key') as object_file:
+            # Nothing is requested until the object is read
+            self.assertEqual(0, client.get_object.call_count)
+            self.assertEqual(b'0123', object_file.read(4))
+            self.assertEqual(b'45', object_file.read(2))
+            self.assertEqual(1, client.get_object.call_count)
+
+            # Reads continue the same response, until the object is seeked elsewhere
+            object_file.seek(6)
+            self.assertEqual(b'67', object_file.read(2))
+            self.assertEqual(1, client.get_object.call_count)
+            object_file.seek(2)
+            self.assertTrue(bodies[0].closed)
+            self.assertEqual(b'23456789', object_file.read())
+            client.get_object.assert_called_with(Bucket='bucket', Key='key', Range='bytes=2-')
+
+            object_file.seek(20)
+            self.assertEqual(b'', object_file.read(2))
+        self.assertTrue(bodies[-1].closed)
+
+
+class S3StorageBackendServerTests:
+    """
+    Tests of S3StorageBackend against an S3-compatible server, whose responses, including the error responses handled
+    by the backend, are those of a real object store.
+    """
+
+    endpoint_url = None
+
+    def setUp(self):
+        self.storage = util.storage.S3StorageBackend(
+            bucket='modern-paste-test-{suffix}'.format(suffix=uuid.uuid4().hex),
+            prefix='blobs/',
+            endpoint_url=self.endpoint_url,
+            region_name='us-east-1',
+            presigned_url_ttl=60,
+        )
+        self.storage.client.create_bucket(Bucket=self.storage.bucket)
+
+    def tearDown(self):
+        for page in self.storage.client.get_paginator('list_objects_v2').paginate(Bucket=self.storage.bucket):
+            for entry in page.get('Contents', []):
+                self.storage.client.delete_object(Bucket=self.storage.bucket, Key=entry['Key'])
+        self.storage.client.delete_bucket(Bucket=self.storage.bucket)
+
+    def test_storage_backend(self):
+        data = os.urandom(3 * util.storage.CHUNK_SIZE)
+        self.assertFalse(self.storage.exists('abcdef'))
+        self.assertIsNone(self.storage.size('abcdef'))
+        self.storage.put('abcdef', [data[:1000], data[1000:]])
+        self.assertTrue(self.storage.exists('abcdef'))
+        self.assertEqual(len(data), self.storage.size('abcdef'))
+
+        with self.storage.open('abcdef') as object_file:
+            self.assertEqual(data, object_file.read())
+            object_file.seek(100)
+            self.assertEqual(data[100:200], object_file.read(100))
+            # Reading at or past the end of the object is answered with an InvalidRange error
+            object_file.seek(len(data))
+            self.assertEqual(b'', object_file.read(100))
+            object_file.seek(len(data) + 100)
+            self.assertEqual(b'', object_file.read())
+        self.assertIn('blobs/abcdef', self.storage.redirect_url('abcdef', 'application/octet-stream'))
+
+        self.storage.delete(['abcdef', 'nonexistent'])
+        self.assertFalse(self.storage.exists('abcdef'))
+
+    def test_storage_backend_errors(self):
+        # Objects that don't exist can't be read
+        with self.storage.open('nonexistent') as object_file:
+            with self.assertRaises(self.storage.client.exceptions.ClientError) as context:
+                object_file.read()
+        self.assertEqual('NoSuchKey', context.exception.response['Error']['Code'])
+
+
+class TestS3StorageBackendMoto(S3StorageBackendServerTests, unittest.TestCase):
+    def setUp(self):
+        # Requests are answered by moto's in-process implementation of S3
+        self.mock_aws = moto.mock_aws()
+        self.mock_aws.start()
+        self.addCleanup(self.mock_aws.stop)
+        super().setUp()
+
+
+@unittest.skipUnless(
+    os.environ.get('MODERN_PASTE_TEST_S3_ENDPOINT_URL'),
+    'Set MODERN_PASTE_TEST_S3_ENDPOINT_URL to the URL of a local S3-compatible server, e.g. MinIO or moto_server',
+)
+class TestS3StorageBackendServer(S3StorageBackendServerTests, unittest.TestCase):
+    endpoint_url = os.environ.get('MODERN_PASTE_TEST_S3_ENDPOINT_URL')
@@ -0,0 +1,97 @@
+import io
+import unittest
+
+import util.upload
+from util.exception import *
+
+
+class TestUpload(unittest.TestCase):
+    def test_iter_chunks(self):
+        self.assertEqual([b'abc', b'def', b'g'], list(util.upload.iter_chunks(io.BytesIO(b'abcdefg'), chunk_size=3)))
+        self.assertEqual([], list(util.upload.iter_chunks(io.BytesIO(b''))))
+
+    def test_iter_multipart_files(self):
+        body = (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="field"\r\n'
+            b'\r\n'
+            b'field value\r\n'
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="file.txt"\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'\r\n'
+            b'file contents\r\n'
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="file.bin"\r\n'
+            b'\r\n'
+            b'\x00\r\n\xff\r\n'
+            b'--boundary--\r\n'
+        )
+        # Boundaries and line breaks split across chunks are handled, wherever the chunks are split
+        for chunk_size in range(1, len(body) + 1):
+            files = [
+                (file_name, mime_type, b''.join(chunks))
+                for file_name, mime_type, chunks in util.upload.iter_multipart_files(
+                    io.BytesIO(body),
+                    'boundary',
+                    chunk_size=chunk_size,
+                )
+            ]
+            self.assertEqual([
+                ('file.txt', 'text/plain', b'file contents'),
+                ('file.bin', None, b'\x00\r\n\xff'),
+            ], files)
+
+    def test_iter_multipart_files_unconsumed(self):
+        body = (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="first"\r\n'
+            b'\r\n'
+            b'first contents\r\n'
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="second"\r\n'
+            b'\r\n'
+            b'second contents\r\n'
+            b'--boundary--\r\n'
+        )
+        files = util.upload.iter_multipart_files(io.BytesIO(body), 'boundary', chunk_size=4)
+        self.assertEqual('first', next(files)[0])
+        file_name, _, chunks = next(files)
+        self.assertEqual('second', file_name)
+        self.assertEqual(b'second contents', b''.join(chunks))
+        self.assertEqual([], list(files))
+
+    def test_iter_multipart_files_invalid(self):
+        body = (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="file"\r\n'
+            b'\r\n'
+            b'truncated'
+        )
+        files = util.upload.iter_multipart_files(io.BytesIO(body), 'boundary')
+        with self.assertRaises(ValueError):
+            for _, _, chunks in files:
+                list(chunks)
+
+    def test_iter_chunks_max_size(self):
+        self.assertEqual([b'abc', b'def'], list(util.upload.iter_chunks(io.BytesIO(b'abcdef'), chunk_size=3, max_size=6)))
+        chunks = util.upload.iter_chunks(io.BytesIO(b'abcdefg'), chunk_size=3, max_size=6)
+        self.assertEqual([b'abc', b'def'], [next(chunks), next(chunks)])
+        self.assertRaises(AttachmentUploadTooLargeException, next, chunks)
+
+    def test_iter_multipart_files_max_size(self):
+        body = (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="file"\r\n'
+            b'\r\n'
+            b'file contents\r\n'
+            b'--boundary--\r\n'
+        )
+        files = util.upload.iter_multipart_files(io.BytesIO(body), 'boundary', chunk_size=7, max_size=len(body))
+        self.assertEqual([b'file contents'], [b''.join(chunks) for _, _, chunks in files])
+
+        # The whole body is counted, not only the data of its files
+        files = util.upload.iter_multipart_files(io.BytesIO(body), 'boundary', chunk_size=7, max_size=len(body) - 1)
+        with self.assertRaises(AttachmentUploadTooLargeException):
+            for _, _, chunks in files:
+                list(chunks)
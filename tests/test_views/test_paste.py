@@ -1,15 +1,23 @@
 import io
 import base64
+import gzip
+import shutil
+import tempfile
 import time
 
 import flask
 import mock
 
+import config
 import database.attachment
 import database.paste
+import models
 import util.cryptography
 import util.testing
 import views.paste
+from modern_paste import app
+from modern_paste import db
+from util.exception import *
 
 
 class TestPaste(util.testing.DatabaseTestCase):
@@ -63,9 +71,22 @@ class TestPaste(util.testing.DatabaseTestCase):
             views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id)).data,
         )
 
+        # Views are only counted once the correct password has been supplied
+        self.assertEqual(0, database.paste.get_paste_by_id(paste.paste_id).views)
+
         # Password-protected, correct password supplied
         flask.request.args = {'password': 'password'}
         self.assertEqual(paste.contents.encode("utf8"), views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id)).data)
+        db.session.remove()
+        self.assertEqual(1, database.paste.get_paste_by_id(paste.paste_id).views)
+
+        # Not password-protected
+        paste = util.testing.PasteFactory.generate(password=None)
+        flask.request.args = {}
+        self.assertEqual(paste.contents.encode("utf8"), views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id)).data)
+        db.session.remove()
+        self.assertEqual(1, database.paste.get_paste_by_id(paste.paste_id).views)
+        paste = database.paste.get_paste_by_id(paste.paste_id)
 
         # Deactivated paste
         database.paste.deactivate_paste(paste.paste_id)
@@ -74,6 +95,327 @@ class TestPaste(util.testing.DatabaseTestCase):
             views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id)).data,
         )
 
+    def test_paste_view_raw_unlock_token(self):
+        paste = util.testing.PasteFactory.generate(contents='contents', password='password')
+        paste_id = util.cryptography.get_id_repr(paste.paste_id)
+        with app.test_request_context(query_string={'password': 'password'}):
+            resp = views.paste.paste_view_raw(paste_id)
+        self.assertEqual(b'contents', resp.data)
+        token = resp.headers['X-Paste-Unlock-Token']
+        self.assertIn('paste_unlock_{paste_id}={token}'.format(paste_id=paste_id, token=token), resp.headers['Set-Cookie'])
+        self.assertIn('HttpOnly', resp.headers['Set-Cookie'])
+
+        # The token is accepted in place of the password, as a cookie or a parameter, without checking the password
+        for request_context in [
+            app.test_request_context(headers={'Cookie': 'paste_unlock_{paste_id}={token}'.format(paste_id=paste_id, token=token)}),
+            app.test_request_context(query_string={'unlock_token': token}),
+        ]:
+            with request_context, mock.patch.object(util.cryptography, 'verify_password') as mock_verify_password:
+                resp = views.paste.paste_view_raw(paste_id)
+                self.assertEqual(b'contents', resp.data)
+                self.assertNotIn('Set-Cookie', resp.headers)
+                self.assertFalse(mock_verify_password.called)
+
+        # Tokens of other pastes are not accepted
+        other_paste = util.testing.PasteFactory.generate(password='password')
+        with app.test_request_context(query_string={'unlock_token': token}):
+            self.assertIn(
+                b'In order to view the raw contents of a password-protected paste',
+                views.paste.paste_view_raw(util.cryptography.get_id_repr(other_paste.paste_id)).data,
+            )
+
+        # Changing the password invalidates the token
+        database.paste.set_paste_password(paste.paste_id, 'new password')
+        with app.test_request_context(query_string={'unlock_token': token}):
+            self.assertIn(
+                b'In order to view the raw contents of a password-protected paste',
+                views.paste.paste_view_raw(paste_id).data,
+            )
+
+    def test_paste_view_raw_hashing_overloaded(self):
+        paste = util.testing.PasteFactory.generate(password='password')
+        with app.test_request_context(query_string={'password': 'password'}):
+            with mock.patch.object(util.cryptography, 'verify_password', side_effect=PasswordHashingOverloadedException):
+                resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual(0, database.paste.get_paste_by_id(paste.paste_id).views)
+
+    def test_paste_view_raw_conditional(self):
+        paste = util.testing.PasteFactory.generate(contents='contents', password=None)
+        resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+        self.assertEqual(200, resp.status_code)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+        # Revalidation with either validator is answered without the contents, but is still counted as a view
+        for headers in [{'If-None-Match': etag}, {'If-Modified-Since': last_modified}]:
+            db.session.remove()
+            with app.test_request_context(headers=headers):
+                with mock.patch.object(models.Paste, 'contents', new_callable=mock.PropertyMock) as mock_contents:
+                    resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+                    self.assertFalse(mock_contents.called)
+            self.assertEqual(304, resp.status_code)
+            self.assertEqual(b'', resp.data)
+            self.assertEqual(etag, resp.headers['ETag'])
+        db.session.remove()
+        self.assertEqual(3, database.paste.get_paste_by_id(paste.paste_id).views)
+
+        # A stale copy is replaced
+        with app.test_request_context(headers={'If-None-Match': '"stale"'}):
+            resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual(b'contents', resp.data)
+
+        # Pastes with identical contents have identical representations
+        other_paste = util.testing.PasteFactory.generate(contents='contents', password=None)
+        with app.test_request_context(headers={'If-None-Match': etag}):
+            resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(other_paste.paste_id))
+            self.assertEqual(304, resp.status_code)
+
+        # Deactivated pastes are no longer served, even to clients with a copy
+        database.paste.deactivate_paste(paste.paste_id)
+        with app.test_request_context(headers={'If-None-Match': etag}):
+            resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(b'This paste either does not exist or has been deleted.', resp.data)
+
+    def test_paste_view_raw_conditional_password(self):
+        paste = util.testing.PasteFactory.generate(contents='contents', password='password')
+        flask.request.args = {'password': 'password'}
+        resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+        etag = resp.headers['ETag']
+        self.assertIn('private', resp.headers['Cache-Control'])
+
+        # The password is checked before the client's copy is considered current
+        with app.test_request_context(headers={'If-None-Match': etag}):
+            resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(200, resp.status_code)
+            self.assertIn(b'In order to view the raw contents of a password-protected paste', resp.data)
+        with app.test_request_context(query_string={'password': 'password'}, headers={'If-None-Match': etag}):
+            resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(304, resp.status_code)
+
+    def test_paste_attachment_conditional(self):
+        paste = util.testing.PasteFactory.generate()
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        with mock.patch.object(database.attachment, 'get_attachment_file') as mock_get_attachment_file:
+            mock_get_attachment_file.return_value = ('/attachments/file.raw', True)
+            with mock.patch.object(flask, 'send_file', return_value=flask.Response(b'file contents')):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+                self.assertEqual(200, resp.status_code)
+                etag = resp.headers['ETag']
+                self.assertIn('Last-Modified', resp.headers)
+
+            with app.test_request_context(headers={'If-None-Match': etag}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            # The attachment file is only located for the full response
+            self.assertEqual(304, resp.status_code)
+            self.assertEqual(1, mock_get_attachment_file.call_count)
+
+    def test_paste_view_raw_range(self):
+        paste = util.testing.PasteFactory.generate(contents='0123456789', password=None)
+        resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+        self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+        etag = resp.headers['ETag']
+
+        with app.test_request_context(headers={'Range': 'bytes=2-4'}):
+            resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(206, resp.status_code)
+            self.assertEqual('bytes 2-4/10', resp.headers['Content-Range'])
+            self.assertEqual('text/plain; charset=utf-8', resp.headers['Content-Type'])
+            resp.direct_passthrough = False
+            self.assertEqual(b'234', resp.get_data())
+
+        # Ranges of a different version of the paste are not served
+        for if_range, status_code in [(etag, 206), ('"stale"', 200)]:
+            with app.test_request_context(headers={'Range': 'bytes=-2', 'If-Range': if_range}):
+                resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+                self.assertEqual(status_code, resp.status_code)
+
+        with app.test_request_context(headers={'Range': 'bytes=10-'}):
+            resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(416, resp.status_code)
+            self.assertEqual('bytes */10', resp.headers['Content-Range'])
+
+    def test_paste_attachment_range(self):
+        paste = util.testing.PasteFactory.generate()
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, mime_type='text/plain')
+        with mock.patch.object(database.attachment, 'get_attachment_file') as mock_get_attachment_file, \
+                tempfile.NamedTemporaryFile() as attachment_file:
+            attachment_file.write(b'0123456789')
+            attachment_file.flush()
+            mock_get_attachment_file.return_value = (attachment_file.name, True)
+
+            with app.test_request_context(headers={'Range': 'bytes=5-'}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+                self.assertEqual(206, resp.status_code)
+                self.assertEqual('bytes 5-9/10', resp.headers['Content-Range'])
+                self.assertEqual('text/plain', resp.headers['Content-Type'])
+                self.assertEqual(5, resp.content_length)
+                resp.direct_passthrough = False
+                self.assertEqual(b'56789', resp.get_data())
+
+            with app.test_request_context(headers={'Range': 'bytes=0-1,8-'}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+                self.assertEqual(206, resp.status_code)
+                self.assertTrue(resp.headers['Content-Type'].startswith('multipart/byteranges; boundary='))
+                resp.direct_passthrough = False
+                data = resp.get_data()
+                self.assertEqual(resp.content_length, len(data))
+                self.assertIn(b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n', data)
+                self.assertIn(b'Content-Range: bytes 8-9/10\r\n\r\n89\r\n', data)
+
+            # Without a Range header, the whole attachment is sent
+            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+            resp.direct_passthrough = False
+            self.assertEqual(b'0123456789', resp.get_data())
+            resp.close()
+
+            # Base64-encoded attachment files are served in ranges from memory
+            mock_get_attachment_file.return_value = ('/attachments/1/file', False)
+            with app.test_request_context(headers={'Range': 'bytes=-4'}), \
+                    mock.patch('builtins.open', return_value=io.StringIO(base64.b64encode(b'file contents').decode())):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+                self.assertEqual(206, resp.status_code)
+                resp.direct_passthrough = False
+                self.assertEqual(b'ents', resp.get_data())
+
+    def test_paste_attachment_sendfile(self):
+        paste = util.testing.PasteFactory.generate()
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        with mock.patch.object(database.attachment, 'get_attachment_file') as mock_get_attachment_file, \
+                mock.patch.object(config, 'ATTACHMENTS_DIR', '/attachments'):
+            mock_get_attachment_file.return_value = ('/attachments/1/file.raw', True)
+
+            config.ATTACHMENTS_SENDFILE_HEADER = 'X-Sendfile'
+            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            self.assertEqual('/attachments/1/file.raw', resp.headers['X-Sendfile'])
+            self.assertEqual(b'', resp.get_data())
+            self.assertEqual('image/png', resp.headers['Content-Type'])
+
+            config.ATTACHMENTS_SENDFILE_HEADER = 'X-Accel-Redirect'
+            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            self.assertEqual('/attachments-internal/1/file.raw', resp.headers['X-Accel-Redirect'])
+            self.assertEqual(b'', resp.get_data())
+
+            # Base64-encoded attachment files can't be sent by the web server
+            mock_get_attachment_file.return_value = ('/attachments/1/file', False)
+            with mock.patch('builtins.open', return_value=io.StringIO(base64.b64encode(b'file contents').decode())):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            self.assertNotIn('X-Accel-Redirect', resp.headers)
+            self.assertEqual(b'file contents', resp.get_data())
+
+    def test_paste_attachment_storage_backend(self):
+        paste = util.testing.PasteFactory.generate()
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, mime_type='text/plain')
+        storage = mock.Mock()
+        storage.local_path.return_value = None
+        storage.size.return_value = 10
+        storage.open.side_effect = lambda key: io.BytesIO(b'0123456789')
+        with mock.patch.object(database.attachment, 'get_storage_backend', return_value=storage):
+            # Downloads are redirected to the storage backend if it supports it
+            storage.redirect_url.return_value = 'https://storage.example.com/blobs/hash?signature'
+            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            self.assertEqual(302, resp.status_code)
+            self.assertEqual('https://storage.example.com/blobs/hash?signature', resp.headers['Location'])
+            storage.redirect_url.assert_called_with(attachment.content_hash, 'text/plain', None)
+
+            # Otherwise, they are streamed from the storage backend
+            storage.redirect_url.return_value = None
+            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual('text/plain', resp.headers['Content-Type'])
+            self.assertEqual(10, resp.content_length)
+            resp.direct_passthrough = False
+            self.assertEqual(b'0123456789', resp.get_data())
+            storage.open.assert_called_with(attachment.content_hash)
+
+            with app.test_request_context(headers={'Range': 'bytes=2-4'}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+                self.assertEqual(206, resp.status_code)
+                self.assertEqual('bytes 2-4/10', resp.headers['Content-Range'])
+                resp.direct_passthrough = False
+                self.assertEqual(b'234', resp.get_data())
+
+    def test_paste_attachment_compressed(self):
+        data = b'text data\n' * 1024
+        with mock.patch.object(config, 'ATTACHMENTS_DIR', tempfile.mkdtemp()), \
+                mock.patch.object(config, 'ENABLE_ATTACHMENT_COMPRESSION', True):
+            paste = util.testing.PasteFactory.generate()
+            attachment, _ = database.attachment.create_new_attachment_from_stream(
+                paste.paste_id,
+                'file.txt',
+                'text/plain',
+                [data],
+            )
+            self.assertEqual('gzip', attachment.content_encoding)
+
+            # Clients that accept gzip are sent the compressed attachment as is, in ranges if requested
+            with app.test_request_context(headers={'Accept-Encoding': 'gzip, deflate'}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file.txt')
+                self.assertEqual(200, resp.status_code)
+                self.assertEqual('gzip', resp.headers['Content-Encoding'])
+                self.assertEqual('text/plain', resp.headers['Content-Type'])
+                self.assertEqual('Accept-Encoding', resp.headers['Vary'])
+                self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+                gzip_etag = resp.get_etag()[0]
+                resp.direct_passthrough = False
+                compressed_data = resp.get_data()
+                self.assertLess(len(compressed_data), len(data))
+                self.assertEqual(data, gzip.decompress(compressed_data))
+                resp.close()
+            with app.test_request_context(headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file.txt')
+                self.assertEqual(206, resp.status_code)
+                self.assertEqual('gzip', resp.headers['Content-Encoding'])
+                self.assertEqual('bytes 0-9/{length}'.format(length=len(compressed_data)), resp.headers['Content-Range'])
+                resp.direct_passthrough = False
+                self.assertEqual(compressed_data[:10], resp.get_data())
+
+            # Other clients are sent the attachment decompressed on the fly, as a whole, under a distinct entity tag
+            for accept_encoding in [None, 'identity', 'gzip;q=0']:
+                headers = {'Range': 'bytes=0-9'}
+                if accept_encoding is not None:
+                    headers['Accept-Encoding'] = accept_encoding
+                with app.test_request_context(headers=headers):
+                    resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file.txt')
+                    self.assertEqual(200, resp.status_code)
+                    self.assertNotIn('Content-Encoding', resp.headers)
+                    self.assertEqual('text/plain', resp.headers['Content-Type'])
+                    self.assertEqual('none', resp.headers['Accept-Ranges'])
+                    self.assertEqual('Accept-Encoding', resp.headers['Vary'])
+                    self.assertNotEqual(gzip_etag, resp.get_etag()[0])
+                    resp.direct_passthrough = False
+                    self.assertEqual(data, resp.get_data())
+
+            # The compressed representation is revalidated by its own entity tag
+            with app.test_request_context(headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"{etag}"'.format(etag=gzip_etag)}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file.txt')
+                self.assertEqual(304, resp.status_code)
+            with app.test_request_context(headers={'If-None-Match': '"{etag}"'.format(etag=gzip_etag)}):
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file.txt')
+                self.assertEqual(200, resp.status_code)
+                resp.close()
+
+            # Remote storage backends serve the compressed attachment with its content encoding
+            storage = mock.Mock()
+            storage.local_path.return_value = None
+            storage.redirect_url.return_value = 'https://storage.example.com/blobs/hash.gz?signature'
+            storage.open.side_effect = lambda key: io.BytesIO(compressed_data)
+            with mock.patch.object(database.attachment, 'get_storage_backend', return_value=storage):
+                with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+                    resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file.txt')
+                    self.assertEqual(302, resp.status_code)
+                    storage.redirect_url.assert_called_with(attachment.content_hash + '.gz', 'text/plain', 'gzip')
+                resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file.txt')
+                self.assertEqual(200, resp.status_code)
+                resp.direct_passthrough = False
+                self.assertEqual(data, resp.get_data())
+                storage.open.assert_called_with(attachment.content_hash + '.gz')
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+
     def test_paste_attachment(self):
         paste = util.testing.PasteFactory.generate()
         attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
@@ -94,19 +436,23 @@ class TestPaste(util.testing.DatabaseTestCase):
         )
         self.assertEqual(404, resp[1])
 
-        # Valid input
-        with mock.patch('builtins.open') as mock_open:
-            mock_file_obj = mock.Mock(spec='file', wraps=io.StringIO(base64.b64encode(b'file contents').decode()))
-            mock_open.return_value = mock_file_obj
+        # Valid input, stored raw or base64-encoded
+        with mock.patch.object(database.attachment, 'get_attachment_file') as mock_get_attachment_file:
+            for data, is_raw in [(b'file contents', True), (base64.b64encode(b'file contents'), False)]:
+                with tempfile.NamedTemporaryFile() as attachment_file:
+                    attachment_file.write(data)
+                    attachment_file.flush()
+                    mock_get_attachment_file.return_value = (attachment_file.name, is_raw)
 
-            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
-            self.assertEqual(1, mock_open.call_count)
-            self.assertIsNotNone(resp)
-            self.assertEqual('file contents', resp.get_data())
-            self.assertEqual(200, resp.status_code)
+                    resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+                    resp.direct_passthrough = False
+                    self.assertEqual(b'file contents', resp.get_data())
+                    self.assertEqual('image/png', resp.headers['Content-Type'])
+                    self.assertEqual(200, resp.status_code)
+                    resp.close()
 
         # Undefined server error
-        with mock.patch.object(database.attachment, 'get_attachment_by_name') as mock_get_attachment:
+        with mock.patch.object(database.attachment, 'get_attachment_and_post_time_by_name') as mock_get_attachment:
             mock_get_attachment.side_effect = Exception
             resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
             self.assertIn(